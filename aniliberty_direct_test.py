@@ -2,46 +2,29 @@
 """
 Direct AniLiberty API v1 Testing
 Tests the specific endpoints mentioned in the review request
+
+Tests run concurrently with per-test SLO budgets (see api_test_runner.py).
+Record once against the live API and replay offline:
+    python aniliberty_direct_test.py --mode record
+    python aniliberty_direct_test.py --mode replay --json aniliberty-tests.json
 """
 
-import requests
-import json
-import time
-import sys
-from typing import Dict, List, Any, Optional
+import os
+
+from api_test_runner import AsyncApiTester, build_parser, run_main, slo_budget
 
 # AniLiberty API v1 endpoints from review request
-ANILIBERTY_BASE_URL = "https://aniliberty.top/api/v1"
+ANILIBERTY_BASE_URL = os.getenv("ANILIBERTY_BASE_URL", "https://aniliberty.top/api/v1")
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_fixtures", "aniliberty_direct_test.json")
 
-class AniLibertyTester:
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'Content-Type': 'application/json',
-            'User-Agent': 'AniLibertyTester/1.0'
-        })
-        self.results = []
-        
-    def log_result(self, test_name: str, success: bool, message: str, data: Any = None):
-        """Log test result"""
-        result = {
-            'test': test_name,
-            'success': success,
-            'message': message,
-            'data': data,
-            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')
-        }
-        self.results.append(result)
-        
-        status = "✅ PASS" if success else "❌ FAIL"
-        print(f"{status} {test_name}: {message}")
-        if not success and data:
-            print(f"   Error details: {data}")
-    
-    def test_latest_releases(self) -> bool:
+class AniLibertyTester(AsyncApiTester):
+    suite_name = "aniliberty-direct"
+    user_agent = "AniLibertyTester/1.0"
+
+    async def test_latest_releases(self) -> bool:
         """Test GET /anime/releases/latest?limit=10"""
         try:
-            response = self.session.get(f"{ANILIBERTY_BASE_URL}/anime/releases/latest?limit=10", timeout=15)
+            response = await self.get(f"{ANILIBERTY_BASE_URL}/anime/releases/latest?limit=10")
             
             if response.status_code == 200:
                 data = response.json()
@@ -88,11 +71,12 @@ class AniLibertyTester:
             self.log_result("Latest Releases", False, f"Request failed: {str(e)}")
             return False
     
-    def test_release_by_id(self) -> bool:
+    @slo_budget(8.0)
+    async def test_release_by_id(self) -> bool:
         """Test GET /anime/releases/{id}"""
         try:
             # First get a release ID
-            response = self.session.get(f"{ANILIBERTY_BASE_URL}/anime/releases/latest?limit=1", timeout=15)
+            response = await self.get(f"{ANILIBERTY_BASE_URL}/anime/releases/latest?limit=1")
             
             if response.status_code != 200:
                 self.log_result("Release By ID", False, "Could not get release list for ID test")
@@ -109,7 +93,7 @@ class AniLibertyTester:
                 return False
             
             # Now test getting by ID
-            response = self.session.get(f"{ANILIBERTY_BASE_URL}/anime/releases/{release_id}", timeout=15)
+            response = await self.get(f"{ANILIBERTY_BASE_URL}/anime/releases/{release_id}")
             
             if response.status_code == 200:
                 release_data = response.json()
@@ -136,11 +120,12 @@ class AniLibertyTester:
             self.log_result("Release By ID", False, f"Request failed: {str(e)}")
             return False
     
-    def test_release_with_episodes(self) -> bool:
+    @slo_budget(8.0)
+    async def test_release_with_episodes(self) -> bool:
         """Test GET /anime/releases/{id}?include=episodes"""
         try:
             # First get a release ID
-            response = self.session.get(f"{ANILIBERTY_BASE_URL}/anime/releases/latest?limit=1", timeout=15)
+            response = await self.get(f"{ANILIBERTY_BASE_URL}/anime/releases/latest?limit=1")
             
             if response.status_code != 200:
                 self.log_result("Release With Episodes", False, "Could not get release list for episodes test")
@@ -157,7 +142,7 @@ class AniLibertyTester:
                 return False
             
             # Now test getting with episodes
-            response = self.session.get(f"{ANILIBERTY_BASE_URL}/anime/releases/{release_id}?include=episodes", timeout=15)
+            response = await self.get(f"{ANILIBERTY_BASE_URL}/anime/releases/{release_id}?include=episodes")
             
             if response.status_code == 200:
                 release_data = response.json()
@@ -185,11 +170,12 @@ class AniLibertyTester:
             self.log_result("Release With Episodes", False, f"Request failed: {str(e)}")
             return False
     
-    def test_episode_by_id(self) -> bool:
+    @slo_budget(20.0)
+    async def test_episode_by_id(self) -> bool:
         """Test GET /anime/releases/episodes/{episodeId}"""
         try:
             # First get a release with episodes
-            response = self.session.get(f"{ANILIBERTY_BASE_URL}/anime/releases/latest?limit=5", timeout=15)
+            response = await self.get(f"{ANILIBERTY_BASE_URL}/anime/releases/latest?limit=5")
             
             if response.status_code != 200:
                 self.log_result("Episode By ID", False, "Could not get release list for episode test")
@@ -208,7 +194,7 @@ class AniLibertyTester:
                 release_id = release.get('id')
                 if release_id:
                     # Try to get episodes for this release
-                    ep_response = self.session.get(f"{ANILIBERTY_BASE_URL}/anime/releases/{release_id}?include=episodes", timeout=15)
+                    ep_response = await self.get(f"{ANILIBERTY_BASE_URL}/anime/releases/{release_id}?include=episodes")
                     if ep_response.status_code == 200:
                         ep_data = ep_response.json()
                         episodes = ep_data.get('episodes', [])
@@ -222,7 +208,7 @@ class AniLibertyTester:
                 return False
             
             # Now test getting episode by ID
-            response = self.session.get(f"{ANILIBERTY_BASE_URL}/anime/releases/episodes/{episode_id}", timeout=15)
+            response = await self.get(f"{ANILIBERTY_BASE_URL}/anime/releases/episodes/{episode_id}")
             
             if response.status_code == 200:
                 episode_data = response.json()
@@ -253,11 +239,12 @@ class AniLibertyTester:
             self.log_result("Episode By ID", False, f"Request failed: {str(e)}")
             return False
     
-    def test_search_releases(self) -> bool:
+    @slo_budget(8.0)
+    async def test_search_releases(self) -> bool:
         """Test GET /app/search/releases?search=query"""
         try:
             search_query = "аниме"
-            response = self.session.get(f"{ANILIBERTY_BASE_URL}/app/search/releases?search={search_query}", timeout=15)
+            response = await self.get(f"{ANILIBERTY_BASE_URL}/app/search/releases?search={search_query}")
             
             if response.status_code == 200:
                 data = response.json()
@@ -276,7 +263,7 @@ class AniLibertyTester:
                     return False
             elif response.status_code == 422:
                 # Try with a different query parameter format
-                response = self.session.get(f"{ANILIBERTY_BASE_URL}/app/search/releases?query={search_query}", timeout=15)
+                response = await self.get(f"{ANILIBERTY_BASE_URL}/app/search/releases?query={search_query}")
                 
                 if response.status_code == 200:
                     data = response.json()
@@ -298,64 +285,25 @@ class AniLibertyTester:
             self.log_result("Search Releases", False, f"Request failed: {str(e)}")
             return False
     
-    def run_all_tests(self) -> Dict[str, Any]:
+    async def run_all_tests(self):
         """Run all AniLiberty API v1 tests"""
         print("🚀 Testing AniLiberty API v1 Endpoints")
         print("=" * 50)
         print(f"Base URL: {ANILIBERTY_BASE_URL}")
-        print()
         
         # Test all endpoints mentioned in review request
-        self.test_latest_releases()
-        self.test_release_by_id()
-        self.test_release_with_episodes()
-        self.test_episode_by_id()
-        self.test_search_releases()
-        
-        return self.get_summary()
-    
-    def get_summary(self) -> Dict[str, Any]:
-        """Get test summary"""
-        total_tests = len(self.results)
-        passed_tests = len([r for r in self.results if r['success']])
-        failed_tests = total_tests - passed_tests
-        
-        summary = {
-            'total_tests': total_tests,
-            'passed': passed_tests,
-            'failed': failed_tests,
-            'success_rate': (passed_tests / total_tests * 100) if total_tests > 0 else 0,
-            'results': self.results
-        }
-        
-        print("\n" + "=" * 50)
-        print("📊 ANILIBERTY API v1 TEST SUMMARY")
-        print("=" * 50)
-        print(f"Total Tests: {total_tests}")
-        print(f"Passed: {passed_tests} ✅")
-        print(f"Failed: {failed_tests} ❌")
-        print(f"Success Rate: {summary['success_rate']:.1f}%")
-        
-        if failed_tests > 0:
-            print("\n❌ FAILED TESTS:")
-            for result in self.results:
-                if not result['success']:
-                    print(f"  • {result['test']}: {result['message']}")
-        
-        return summary
+        await self.run_group("🌐 AniLiberty API v1:", [
+            self.test_latest_releases,
+            self.test_release_by_id,
+            self.test_release_with_episodes,
+            self.test_episode_by_id,
+            self.test_search_releases,
+        ])
 
 def main():
     """Main test execution"""
-    tester = AniLibertyTester()
-    summary = tester.run_all_tests()
-    
-    # Exit with appropriate code
-    if summary['failed'] > 0:
-        print(f"\n❌ {summary['failed']} tests failed")
-        sys.exit(1)
-    else:
-        print(f"\n✅ All {summary['passed']} tests passed!")
-        sys.exit(0)
+    args = build_parser("Direct AniLiberty API v1 tests", FIXTURES_PATH).parse_args()
+    run_main(AniLibertyTester, args)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Async runner shared by backend_test.py and aniliberty_direct_test.py
+
+Runs test coroutines with bounded concurrency, times every test and HTTP call,
+fails tests that exceed their SLO budget, and writes JSON / JUnit reports.
+HTTP traffic can be recorded to a fixture file once and replayed offline.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+
+DEFAULT_TIMEOUT = 15.0
+DEFAULT_SLO_BUDGET = 5.0
+
+# Result record of the test that is currently running in this task
+_current_result: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar("current_result", default=None)
+
+
+def slo_budget(seconds: float):
+    """Per-test latency budget; a test slower than this fails even if its checks pass"""
+    def decorator(func):
+        func.slo_budget = seconds
+        return func
+    return decorator
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def timing_summary(values: List[float]) -> Dict[str, float]:
+    """p50/p95/p99/max in milliseconds"""
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 1),
+        'p95_ms': round(percentile(values, 95) * 1000, 1),
+        'p99_ms': round(percentile(values, 99) * 1000, 1),
+        'max_ms': round(max(values) * 1000, 1) if values else 0.0
+    }
+
+
+class HttpResponse:
+    """Minimal response object, identical for live, recorded and replayed requests"""
+
+    def __init__(self, status_code: int, text: str, headers: Optional[Dict[str, str]] = None, elapsed: float = 0.0):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+        self.elapsed = elapsed
+
+    def json(self) -> Any:
+        return json.loads(self.text)
+
+
+class FixtureStore:
+    """Recorded upstream responses keyed by method + URL, stored as one JSON file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.responses: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as fixture_file:
+                self.responses = json.load(fixture_file)
+
+    @staticmethod
+    def key(method: str, url: str) -> str:
+        return hashlib.sha1(f"{method.upper()} {url}".encode()).hexdigest()
+
+    def get(self, method: str, url: str) -> Optional[HttpResponse]:
+        entry = self.responses.get(self.key(method, url))
+        if entry is None:
+            return None
+        return HttpResponse(entry['status'], entry['body'], entry.get('headers'), entry.get('elapsed_ms', 0.0) / 1000)
+
+    def put(self, method: str, url: str, response: HttpResponse):
+        self.responses[self.key(method, url)] = {
+            'method': method.upper(),
+            'url': url,
+            'status': response.status_code,
+            'elapsed_ms': round(response.elapsed * 1000, 1),
+            'headers': {key: value for key, value in response.headers.items() if key.lower() == 'content-type'},
+            'body': response.text
+        }
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'w', encoding='utf-8') as fixture_file:
+            json.dump(self.responses, fixture_file, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+class AsyncApiTester:
+    """Base class: HTTP client with record/replay, result logging, SLO checks and reports"""
+
+    suite_name = "api-tests"
+    user_agent = "AsyncApiTester/1.0"
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.mode = args.mode
+        self.timeout = args.timeout
+        self.default_budget = args.slo
+        self.semaphore = asyncio.Semaphore(max(1, args.concurrency))
+        self.fixtures = FixtureStore(args.fixtures) if self.mode != 'live' else None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.results: List[Dict[str, Any]] = []
+        self.request_timings: List[float] = []
+        self.started_at = 0.0
+        self.finished_at = 0.0
+
+    # HTTP
+
+    async def get(self, url: str, timeout: Optional[float] = None) -> HttpResponse:
+        return await self.request('GET', url, timeout=timeout)
+
+    async def request(self, method: str, url: str, timeout: Optional[float] = None, **kwargs) -> HttpResponse:
+        """Live request, or a replayed fixture in replay mode; raises on network errors like requests did"""
+        if self.mode == 'replay':
+            response = self.fixtures.get(method, url)
+            if response is None:
+                raise LookupError(f"No recorded fixture for {method} {url}")
+            # Percentiles in replay mode describe the recorded upstream latency
+            self.request_timings.append(response.elapsed)
+            return response
+
+        if timeout is None:
+            timeout = self.timeout
+        async with self.semaphore:
+            # Time only the request itself, not the wait for a free --concurrency slot
+            started_at = time.perf_counter()
+            async with self.session.request(
+                method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs
+            ) as raw:
+                text = await raw.text(errors='replace')
+                response = HttpResponse(raw.status, text, dict(raw.headers), time.perf_counter() - started_at)
+        self.request_timings.append(response.elapsed)
+        if self.mode == 'record':
+            self.fixtures.put(method, url, response)
+        return response
+
+    # Results
+
+    def log_result(self, test_name: str, success: bool, message: str, data: Any = None):
+        """Log test result"""
+        result = _current_result.get()
+        if result is None:
+            result = {}
+            self.results.append(result)
+        result.update({
+            'test': test_name,
+            'success': success,
+            'message': message,
+            'data': data,
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')
+        })
+
+    def print_result(self, result: Dict[str, Any]):
+        status = "✅ PASS" if result['success'] else "❌ FAIL"
+        print(f"{status} {result['test']}: {result['message']} ({result['duration_ms']:.0f} ms)")
+        if not result['success'] and result.get('data'):
+            print(f"   Error details: {str(result['data'])[:500]}")
+
+    async def run_test(self, test: Callable[[], Awaitable[bool]]) -> Dict[str, Any]:
+        """Runs one test with timing and its SLO budget"""
+        budget = getattr(test, 'slo_budget', self.default_budget)
+        result: Dict[str, Any] = {'test': test.__name__, 'function': test.__name__}
+        self.results.append(result)
+        token = _current_result.set(result)
+        started_at = time.perf_counter()
+        try:
+            passed = await test()
+        except Exception as e:
+            passed = False
+            self.log_result(result.get('test', test.__name__), False, f"Request failed: {str(e) or type(e).__name__}")
+        finally:
+            duration = time.perf_counter() - started_at
+            _current_result.reset(token)
+        if 'success' not in result:
+            result.update({'success': bool(passed), 'message': "Test finished without logging a result", 'data': None})
+        result['duration_ms'] = round(duration * 1000, 1)
+        result['slo_budget_ms'] = round(budget * 1000, 1)
+        # Checks passed regardless of latency; callers gate later tests on this, not on 'success'
+        result['checks_passed'] = result['success']
+        result['slo_exceeded'] = False
+        # Replayed responses take no network time, so budgets only apply to live runs
+        if result['success'] and self.mode != 'replay' and duration > budget:
+            result['success'] = False
+            result['slo_exceeded'] = True
+            result['message'] += f" (SLO budget exceeded: {duration:.2f}s > {budget:.2f}s)"
+        self.print_result(result)
+        return result
+
+    async def run_group(self, title: str, tests: List[Callable[[], Awaitable[bool]]]) -> List[Dict[str, Any]]:
+        """Runs a group of independent tests concurrently (HTTP calls are bounded by --concurrency)"""
+        print(f"\n{title}")
+        print("-" * 40)
+        return await asyncio.gather(*(self.run_test(test) for test in tests))
+
+    def discover_tests(self) -> List[Callable[[], Awaitable[bool]]]:
+        """All test_* coroutine methods in definition order"""
+        names = []
+        for klass in reversed(type(self).__mro__):
+            for name, value in vars(klass).items():
+                if name.startswith('test_') and asyncio.iscoroutinefunction(value) and name not in names:
+                    names.append(name)
+        return [getattr(self, name) for name in names]
+
+    async def run_all_tests(self):
+        """Default: every test_* method in one concurrent group; suites override this for ordering"""
+        await self.run_group(f"🧪 {self.suite_name}:", self.discover_tests())
+
+    async def run(self) -> Dict[str, Any]:
+        self.started_at = time.perf_counter()
+        headers = {'Content-Type': 'application/json', 'User-Agent': self.user_agent}
+        connector = aiohttp.TCPConnector(limit=max(1, self.args.concurrency))
+        async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+            self.session = session
+            try:
+                await self.run_all_tests()
+            finally:
+                self.finished_at = time.perf_counter()
+                if self.mode == 'record':
+                    self.fixtures.save()
+                    print(f"\n📼 Recorded {len(self.fixtures.responses)} responses to {self.fixtures.path}")
+        summary = self.get_summary()
+        self.write_reports(summary)
+        return summary
+
+    # Reports
+
+    def get_summary(self) -> Dict[str, Any]:
+        """Get test summary"""
+        total_tests = len(self.results)
+        passed_tests = len([r for r in self.results if r['success']])
+        failed_tests = total_tests - passed_tests
+
+        summary = {
+            'suite': self.suite_name,
+            'mode': self.mode,
+            'total_tests': total_tests,
+            'passed': passed_tests,
+            'failed': failed_tests,
+            'success_rate': (passed_tests / total_tests * 100) if total_tests > 0 else 0,
+            'duration_seconds': round(self.finished_at - self.started_at, 3),
+            'timings': {
+                'tests': timing_summary([r.get('duration_ms', 0.0) / 1000 for r in self.results]),
+                'requests': timing_summary(self.request_timings)
+            },
+            'results': self.results
+        }
+
+        print("\n" + "=" * 60)
+        print(f"📊 {self.suite_name.upper()} SUMMARY")
+        print("=" * 60)
+        print(f"Total Tests: {total_tests}")
+        print(f"Passed: {passed_tests} ✅")
+        print(f"Failed: {failed_tests} ❌")
+        print(f"Success Rate: {summary['success_rate']:.1f}%")
+        print(f"Wall time: {summary['duration_seconds']:.2f}s ({self.mode})")
+        for kind, timing in summary['timings'].items():
+            print(f"{kind.capitalize()}: p50 {timing['p50_ms']} ms, p95 {timing['p95_ms']} ms, "
+                  f"p99 {timing['p99_ms']} ms, max {timing['max_ms']} ms (n={timing['count']})")
+
+        if failed_tests > 0:
+            print("\n❌ FAILED TESTS:")
+            for result in self.results:
+                if not result['success']:
+                    print(f"  • {result['test']}: {result['message']}")
+
+        return summary
+
+    def write_reports(self, summary: Dict[str, Any]):
+        if self.args.json:
+            with open(self.args.json, 'w', encoding='utf-8') as report:
+                json.dump(summary, report, ensure_ascii=False, indent=2, default=str)
+            print(f"\n📝 JSON report: {self.args.json}")
+        if self.args.junit:
+            self.write_junit(summary, self.args.junit)
+            print(f"📝 JUnit report: {self.args.junit}")
+
+    def write_junit(self, summary: Dict[str, Any], path: str):
+        suite = ET.Element('testsuite', {
+            'name': self.suite_name,
+            'tests': str(summary['total_tests']),
+            'failures': str(summary['failed']),
+            'errors': '0',
+            'time': f"{summary['duration_seconds']:.3f}"
+        })
+        properties = ET.SubElement(suite, 'properties')
+        ET.SubElement(properties, 'property', {'name': 'mode', 'value': self.mode})
+        for kind, timing in summary['timings'].items():
+            for name in ('p50_ms', 'p95_ms', 'p99_ms'):
+                ET.SubElement(properties, 'property', {'name': f"{kind}.{name}", 'value': str(timing[name])})
+        for result in self.results:
+            case = ET.SubElement(suite, 'testcase', {
+                'classname': f"{self.suite_name}.{result.get('function', result['test'])}",
+                'name': result['test'],
+                'time': f"{result.get('duration_ms', 0.0) / 1000:.3f}"
+            })
+            if not result['success']:
+                failure = ET.SubElement(case, 'failure', {'message': result['message']})
+                if result.get('data') is not None:
+                    failure.text = json.dumps(result['data'], ensure_ascii=False, default=str)[:4000]
+        ET.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+
+def build_parser(description: str, default_fixtures: str) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--mode', choices=('live', 'record', 'replay'), default=os.getenv('API_TEST_MODE', 'live'),
+                        help="live: real services; record: real services + save responses; replay: saved responses only")
+    parser.add_argument('--fixtures', default=default_fixtures, help="Fixture file for record/replay")
+    parser.add_argument('--concurrency', type=int, default=4, help="Max concurrent HTTP requests")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help="Per-request timeout, seconds")
+    parser.add_argument('--slo', type=float, default=DEFAULT_SLO_BUDGET, help="Default per-test latency budget, seconds")
+    parser.add_argument('--json', help="Write JSON report to this path")
+    parser.add_argument('--junit', help="Write JUnit XML report to this path")
+    return parser
+
+
+def run_main(tester_class, args: argparse.Namespace):
+    """Main test execution"""
+    summary = asyncio.run(tester_class(args).run())
+
+    # Exit with appropriate code
+    if summary['failed'] > 0:
+        print(f"\n❌ {summary['failed']} tests failed")
+        sys.exit(1)
+    else:
+        print(f"\n✅ All {summary['passed']} tests passed!")
+        sys.exit(0)
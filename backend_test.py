@@ -2,48 +2,32 @@
 """
 Backend API Testing for AniLiberty v1 Integration
 Tests the Node.js backend API endpoints that integrate with AniLiberty API v1
+
+Tests run concurrently with per-test SLO budgets (see api_test_runner.py).
+Record once against live services and replay offline:
+    python backend_test.py --mode record
+    python backend_test.py --mode replay --junit backend-tests.xml
 """
 
-import requests
-import json
-import time
-import sys
-from typing import Dict, List, Any, Optional
+import os
+
+from api_test_runner import AsyncApiTester, build_parser, run_main, slo_budget
 
 # Configuration
-BACKEND_BASE_URL = "http://localhost:5000"
+BACKEND_BASE_URL = os.getenv("BACKEND_BASE_URL", "http://localhost:5000")
 API_BASE_URL = f"{BACKEND_BASE_URL}/api"
-ANILIBERTY_DIRECT_URL = "https://aniliberty.top/api/v1"
+ANILIBERTY_DIRECT_URL = os.getenv("ANILIBERTY_DIRECT_URL", "https://aniliberty.top/api/v1")
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_fixtures", "backend_test.json")
 
-class BackendTester:
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'Content-Type': 'application/json',
-            'User-Agent': 'BackendTester/1.0'
-        })
-        self.results = []
-        
-    def log_result(self, test_name: str, success: bool, message: str, data: Any = None):
-        """Log test result"""
-        result = {
-            'test': test_name,
-            'success': success,
-            'message': message,
-            'data': data,
-            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')
-        }
-        self.results.append(result)
-        
-        status = "✅ PASS" if success else "❌ FAIL"
-        print(f"{status} {test_name}: {message}")
-        if not success and data:
-            print(f"   Error details: {data}")
-    
-    def test_backend_health(self) -> bool:
+class BackendTester(AsyncApiTester):
+    suite_name = "backend"
+    user_agent = "BackendTester/1.0"
+
+    @slo_budget(2.0)
+    async def test_backend_health(self) -> bool:
         """Test if backend server is running"""
         try:
-            response = self.session.get(f"{BACKEND_BASE_URL}/health", timeout=10)
+            response = await self.get(f"{BACKEND_BASE_URL}/health")
             if response.status_code == 200:
                 data = response.json()
                 self.log_result("Backend Health Check", True, 
@@ -57,10 +41,10 @@ class BackendTester:
             self.log_result("Backend Health Check", False, f"Cannot connect to backend: {str(e)}")
             return False
     
-    def test_anilibria_popular(self) -> bool:
+    async def test_anilibria_popular(self) -> bool:
         """Test AniLibria popular anime endpoint"""
         try:
-            response = self.session.get(f"{API_BASE_URL}/anilibria/popular?limit=5", timeout=15)
+            response = await self.get(f"{API_BASE_URL}/anilibria/popular?limit=5")
             
             if response.status_code == 200:
                 data = response.json()
@@ -97,10 +81,10 @@ class BackendTester:
             self.log_result("AniLibria Popular", False, f"Request failed: {str(e)}")
             return False
     
-    def test_anilibria_updates(self) -> bool:
+    async def test_anilibria_updates(self) -> bool:
         """Test AniLibria updates endpoint"""
         try:
-            response = self.session.get(f"{API_BASE_URL}/anilibria/updates?limit=5", timeout=15)
+            response = await self.get(f"{API_BASE_URL}/anilibria/updates?limit=5")
             
             if response.status_code == 200:
                 data = response.json()
@@ -127,11 +111,11 @@ class BackendTester:
             self.log_result("AniLibria Updates", False, f"Request failed: {str(e)}")
             return False
     
-    def test_anilibria_search(self) -> bool:
+    async def test_anilibria_search(self) -> bool:
         """Test AniLibria search endpoint"""
         try:
             search_query = "аниме"
-            response = self.session.get(f"{API_BASE_URL}/anilibria/search?search={search_query}&limit=3", timeout=15)
+            response = await self.get(f"{API_BASE_URL}/anilibria/search?search={search_query}&limit=3")
             
             if response.status_code == 200:
                 data = response.json()
@@ -155,11 +139,11 @@ class BackendTester:
             self.log_result("AniLibria Search", False, f"Request failed: {str(e)}")
             return False
     
-    def test_anilibria_search_fallback(self) -> bool:
+    async def test_anilibria_search_fallback(self) -> bool:
         """Test AniLibria search fallback endpoint"""
         try:
             search_query = "test"
-            response = self.session.get(f"{API_BASE_URL}/anilibria/search/fallback?query={search_query}&limit=3", timeout=15)
+            response = await self.get(f"{API_BASE_URL}/anilibria/search/fallback?query={search_query}&limit=3")
             
             if response.status_code == 200:
                 data = response.json()
@@ -183,11 +167,12 @@ class BackendTester:
             self.log_result("AniLibria Search Fallback", False, f"Request failed: {str(e)}")
             return False
     
-    def test_anilibria_by_id(self) -> bool:
+    @slo_budget(8.0)
+    async def test_anilibria_by_id(self) -> bool:
         """Test getting anime by ID from AniLibria"""
         try:
             # First get a list to find a valid ID
-            response = self.session.get(f"{API_BASE_URL}/anilibria/popular?limit=1", timeout=15)
+            response = await self.get(f"{API_BASE_URL}/anilibria/popular?limit=1")
             
             if response.status_code != 200:
                 self.log_result("AniLibria By ID", False, "Could not get anime list for ID test")
@@ -204,7 +189,7 @@ class BackendTester:
                 return False
             
             # Now test getting by ID
-            response = self.session.get(f"{API_BASE_URL}/anilibria/{anime_id}", timeout=15)
+            response = await self.get(f"{API_BASE_URL}/anilibria/{anime_id}")
             
             if response.status_code == 200:
                 data = response.json()
@@ -226,10 +211,10 @@ class BackendTester:
             self.log_result("AniLibria By ID", False, f"Request failed: {str(e)}")
             return False
     
-    def test_anilibria_random(self) -> bool:
+    async def test_anilibria_random(self) -> bool:
         """Test AniLibria random anime endpoint"""
         try:
-            response = self.session.get(f"{API_BASE_URL}/anilibria/random?limit=2", timeout=15)
+            response = await self.get(f"{API_BASE_URL}/anilibria/random?limit=2")
             
             if response.status_code == 200:
                 data = response.json()
@@ -252,10 +237,10 @@ class BackendTester:
             self.log_result("AniLibria Random", False, f"Request failed: {str(e)}")
             return False
     
-    def test_anilibria_genres(self) -> bool:
+    async def test_anilibria_genres(self) -> bool:
         """Test AniLibria genres endpoint"""
         try:
-            response = self.session.get(f"{API_BASE_URL}/anilibria/genres", timeout=15)
+            response = await self.get(f"{API_BASE_URL}/anilibria/genres")
             
             if response.status_code == 200:
                 data = response.json()
@@ -278,10 +263,10 @@ class BackendTester:
             self.log_result("AniLibria Genres", False, f"Request failed: {str(e)}")
             return False
     
-    def test_anilibria_schedule(self) -> bool:
+    async def test_anilibria_schedule(self) -> bool:
         """Test AniLibria schedule endpoint"""
         try:
-            response = self.session.get(f"{API_BASE_URL}/anilibria/schedule", timeout=15)
+            response = await self.get(f"{API_BASE_URL}/anilibria/schedule")
             
             if response.status_code == 200:
                 data = response.json()
@@ -304,10 +289,10 @@ class BackendTester:
             self.log_result("AniLibria Schedule", False, f"Request failed: {str(e)}")
             return False
     
-    def test_direct_aniliberty_api(self) -> bool:
+    async def test_direct_aniliberty_api(self) -> bool:
         """Test direct connection to AniLiberty API v1"""
         try:
-            response = self.session.get(f"{ANILIBERTY_DIRECT_URL}/anime/releases/latest?limit=3", timeout=15)
+            response = await self.get(f"{ANILIBERTY_DIRECT_URL}/anime/releases/latest?limit=3")
             
             if response.status_code == 200:
                 data = response.json()
@@ -338,11 +323,11 @@ class BackendTester:
             self.log_result("Direct AniLiberty API", False, f"Request failed: {str(e)}")
             return False
     
-    def test_aniliberty_search_direct(self) -> bool:
+    async def test_aniliberty_search_direct(self) -> bool:
         """Test direct AniLiberty search API"""
         try:
             search_query = "аниме"
-            response = self.session.get(f"{ANILIBERTY_DIRECT_URL}/app/search/releases?search={search_query}", timeout=15)
+            response = await self.get(f"{ANILIBERTY_DIRECT_URL}/app/search/releases?search={search_query}")
             
             if response.status_code == 200:
                 data = response.json()
@@ -364,80 +349,40 @@ class BackendTester:
             self.log_result("Direct AniLiberty Search", False, f"Request failed: {str(e)}")
             return False
     
-    def run_all_tests(self) -> Dict[str, Any]:
+    async def run_all_tests(self):
         """Run all backend tests"""
         print("🚀 Starting Backend API Tests for AniLiberty v1 Integration")
         print("=" * 60)
         
         # Test backend health first
-        if not self.test_backend_health():
+        health = await self.run_test(self.test_backend_health)
+        # A slow but healthy backend is reported as an SLO failure and the suite keeps going
+        if not health['checks_passed']:
             print("\n❌ Backend server is not running. Cannot proceed with API tests.")
-            return self.get_summary()
-        
-        print("\n📡 Testing Backend AniLibria API Integration:")
-        print("-" * 40)
+            return
         
         # Test all AniLibria endpoints through backend
-        self.test_anilibria_popular()
-        self.test_anilibria_updates()
-        self.test_anilibria_search()
-        self.test_anilibria_search_fallback()
-        self.test_anilibria_by_id()
-        self.test_anilibria_random()
-        self.test_anilibria_genres()
-        self.test_anilibria_schedule()
-        
-        print("\n🌐 Testing Direct AniLiberty API v1:")
-        print("-" * 40)
+        await self.run_group("📡 Testing Backend AniLibria API Integration:", [
+            self.test_anilibria_popular,
+            self.test_anilibria_updates,
+            self.test_anilibria_search,
+            self.test_anilibria_search_fallback,
+            self.test_anilibria_by_id,
+            self.test_anilibria_random,
+            self.test_anilibria_genres,
+            self.test_anilibria_schedule,
+        ])
         
         # Test direct AniLiberty API
-        self.test_direct_aniliberty_api()
-        self.test_aniliberty_search_direct()
-        
-        return self.get_summary()
-    
-    def get_summary(self) -> Dict[str, Any]:
-        """Get test summary"""
-        total_tests = len(self.results)
-        passed_tests = len([r for r in self.results if r['success']])
-        failed_tests = total_tests - passed_tests
-        
-        summary = {
-            'total_tests': total_tests,
-            'passed': passed_tests,
-            'failed': failed_tests,
-            'success_rate': (passed_tests / total_tests * 100) if total_tests > 0 else 0,
-            'results': self.results
-        }
-        
-        print("\n" + "=" * 60)
-        print("📊 TEST SUMMARY")
-        print("=" * 60)
-        print(f"Total Tests: {total_tests}")
-        print(f"Passed: {passed_tests} ✅")
-        print(f"Failed: {failed_tests} ❌")
-        print(f"Success Rate: {summary['success_rate']:.1f}%")
-        
-        if failed_tests > 0:
-            print("\n❌ FAILED TESTS:")
-            for result in self.results:
-                if not result['success']:
-                    print(f"  • {result['test']}: {result['message']}")
-        
-        return summary
+        await self.run_group("🌐 Testing Direct AniLiberty API v1:", [
+            self.test_direct_aniliberty_api,
+            self.test_aniliberty_search_direct,
+        ])
 
 def main():
     """Main test execution"""
-    tester = BackendTester()
-    summary = tester.run_all_tests()
-    
-    # Exit with appropriate code
-    if summary['failed'] > 0:
-        print(f"\n❌ {summary['failed']} tests failed")
-        sys.exit(1)
-    else:
-        print(f"\n✅ All {summary['passed']} tests passed!")
-        sys.exit(0)
+    args = build_parser("Backend API tests for the AniLiberty v1 integration", FIXTURES_PATH).parse_args()
+    run_main(BackendTester, args)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
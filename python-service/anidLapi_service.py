@@ -1,37 +1,803 @@
 import asyncio
+import atexit
+import base64
+import contextlib
+import contextvars
+import cProfile
+import hashlib
+import heapq
+import hmac
+import io
+import ipaddress
+import os
+import posixpath
+import pstats
+import queue
+import random
+import re
+import sys
+import tempfile
+import threading
 import time
-from typing import Dict, Any, Optional
+import traceback
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urljoin, urlsplit
+from typing import Any, AsyncIterator, Awaitable, Callable, Coroutine, Dict, List, Optional, Tuple
 from datetime import datetime, timedelta
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
 from fastapi import FastAPI, Query, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from starlette.routing import Match
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-from slowapi.middleware import SlowAPIMiddleware
+from pydantic import BaseModel, Field
+import aiofiles
+import aiofiles.os
 import aiohttp
-import aioredis
-from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
-from prometheus_client import start_http_server
+try:
+    # aioredis вошёл в redis-py как redis.asyncio (отдельный пакет не работает на Python 3.11)
+    from redis import asyncio as aioredis
+except ImportError:
+    aioredis = None
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import CollectorRegistry, REGISTRY, multiprocess, start_http_server
 from anicli_api import AnimeGo
 import json
+import uuid
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+# Логгеры: сообщения горячего пути (каждый запрос) идут в отдельный логгер,
+# чтобы их можно было разредить или понизить до DEBUG, не трогая остальные
 logger = logging.getLogger(__name__)
+request_logger = logging.getLogger(f"{__name__}.requests")
+
+# Настройки кэширования
+CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))
+CACHE_TTL_VIDEO = int(os.getenv("CACHE_TTL_VIDEO", str(CACHE_TTL)))
+CACHE_TTL_QUALITIES = int(os.getenv("CACHE_TTL_QUALITIES", str(CACHE_TTL)))
+CACHE_TTL_RELEASE = int(os.getenv("CACHE_TTL_RELEASE", str(CACHE_TTL)))
+# CACHE_TTL_VIDEO / CACHE_TTL_QUALITIES - мягкий TTL; ещё CACHE_STALE_TTL секунд запись
+# отдаётся устаревшей с обновлением в фоне. "Не найдено" кэшируется на CACHE_NEGATIVE_TTL
+CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", "3600"))
+CACHE_NEGATIVE_TTL = int(os.getenv("CACHE_NEGATIVE_TTL", "60"))
+
+# Базовые URL API провайдеров (Aniliberty - в порядке приоритета, через запятую)
+ANILIBERTY_API_URLS = [
+    url.strip().rstrip('/') for url in os.getenv(
+        "ANILIBERTY_API_URLS", "https://aniliberty.top/api/v1,https://api.anilibria.app/api/v1"
+    ).split(",") if url.strip()
+]
+ANILIBRIA_API_URL = os.getenv("ANILIBRIA_API_URL", "https://api.anilibria.tv/v3").rstrip('/')
+
+# CDN, относительно которого заданы пути HLS в ответах Aniliberty и Anilibria
+ANILIBERTY_CDN_URL = os.getenv("ANILIBERTY_CDN_URL", "https://cache.libria.fun")
+ANILIBRIA_CDN_URL = os.getenv("ANILIBRIA_CDN_URL", "https://cache.libria.fun")
+CACHE_L1_TTL = int(os.getenv("CACHE_L1_TTL", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CACHE_CLEANUP_INTERVAL = int(os.getenv("CACHE_CLEANUP_INTERVAL", "300"))
+
+# Настройки Redis (L2 кэш, общий для всех воркеров)
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_DB = int(os.getenv("REDIS_DB", "0"))
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "anidlapi:")
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.5"))
+REDIS_RETRY_INTERVAL = float(os.getenv("REDIS_RETRY_INTERVAL", "30"))
+
+# Настройки объединения одновременных запросов (single-flight)
+SINGLEFLIGHT_LOCK_TTL = float(os.getenv("SINGLEFLIGHT_LOCK_TTL", "30"))
+# Ожидание результата другого воркера; дольше RESOLVE_BUDGET ждать бессмысленно -
+# за это время лидер либо запишет результат, либо сам прекратит резолв
+SINGLEFLIGHT_WAIT_TIMEOUT = float(os.getenv("SINGLEFLIGHT_WAIT_TIMEOUT", "20"))
+SINGLEFLIGHT_POLL_INTERVAL = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL", "0.05"))
+
+# Стратегия опроса провайдеров: sequential - строго по очереди, hedged - следующий
+# провайдер стартует, если текущий не ответил за RESOLVE_HEDGE_DELAY, race - все сразу
+RESOLVE_STRATEGY = os.getenv("RESOLVE_STRATEGY", "hedged").lower()
+RESOLVE_HEDGE_DELAY = float(os.getenv("RESOLVE_HEDGE_DELAY", "1.5"))
+RESOLVE_BUDGET = float(os.getenv("RESOLVE_BUDGET", "20"))
+# Какие провайдеры опрашивать (например, без AnimeGo в изолированной сети)
+RESOLVE_PROVIDERS = [
+    name.strip() for name in os.getenv("RESOLVE_PROVIDERS", "anicli,aniliberty,anilibria_old").split(",") if name.strip()
+]
+RESOLVE_PROVIDER_TIMEOUTS = {
+    "anicli": float(os.getenv("RESOLVE_TIMEOUT_ANICLI", os.getenv("ANICLI_CALL_TIMEOUT", "15"))),
+    "aniliberty": float(os.getenv("RESOLVE_TIMEOUT_ANILIBERTY", "12")),
+    "anilibria_old": float(os.getenv("RESOLVE_TIMEOUT_ANILIBRIA", "10"))
+}
+# То же для базовых URL Aniliberty внутри одного запроса к API
+UPSTREAM_HEDGE_DELAY = float(os.getenv("UPSTREAM_HEDGE_DELAY", "1.0"))
+
+# Circuit breaker провайдеров и базовых URL: окно последних вызовов, доля ошибок
+# (включая вызовы дольше BREAKER_SLOW_CALL_SECONDS), после которой источник
+# пропускается на BREAKER_OPEN_SECONDS, и число пробных вызовов в half-open
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "true").lower() == "true"
+BREAKER_WINDOW_SIZE = int(os.getenv("BREAKER_WINDOW_SIZE", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "8"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+# Адаптивный порядок: сначала источник с лучшей EWMA доли успехов и задержки
+ADAPTIVE_ORDERING = os.getenv("ADAPTIVE_ORDERING", "true").lower() == "true"
+PROVIDER_EWMA_ALPHA = float(os.getenv("PROVIDER_EWMA_ALPHA", "0.2"))
+
+# Предзагрузка следующего эпизода: после /video эпизода N в фоне резолвится N+1
+# (и, при PREFETCH_MEDIA_SEGMENTS > 0, первые сегменты его HLS потока уходят в дисковый кэш)
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_MAX_INFLIGHT = int(os.getenv("PREFETCH_MAX_INFLIGHT", "8"))
+PREFETCH_HIT_WINDOW = float(os.getenv("PREFETCH_HIT_WINDOW", "1800"))
+PREFETCH_MEDIA_SEGMENTS = int(os.getenv("PREFETCH_MEDIA_SEGMENTS", "0"))
+PREFETCH_TRACK_MAX = int(os.getenv("PREFETCH_TRACK_MAX", "10000"))
+
+# Пакетный резолв эпизодов (POST /resolve)
+RESOLVE_BATCH_MAX_ITEMS = int(os.getenv("RESOLVE_BATCH_MAX_ITEMS", "200"))
+RESOLVE_BATCH_CONCURRENCY = int(os.getenv("RESOLVE_BATCH_CONCURRENCY", "8"))
+
+# Rate limiting входящих запросов: счётчики общие для воркеров (Redis, если задан),
+# IP клиента берётся из X-Forwarded-For только от доверенных прокси
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI") or os.getenv("REDIS_URL") or "memory://"
+RATE_LIMIT_STRATEGY = os.getenv("RATE_LIMIT_STRATEGY", "fixed-window")
+# Потоки для проверки лимитов с Redis (сетевой вызов не блокирует event loop)
+RATE_LIMIT_CHECK_THREADS = int(os.getenv("RATE_LIMIT_CHECK_THREADS", "8"))
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.getenv("TRUSTED_PROXIES", "127.0.0.1,::1").split(",") if network.strip()
+]
+
+# Исходящие лимиты: token bucket на хост провайдера, "хост=запросов_в_секунду:всплеск".
+# Запрос ждёт токен не дольше UPSTREAM_RATE_MAX_WAIT, иначе отбрасывается до отправки
+UPSTREAM_RATE_LIMITS = {
+    host.strip().lower(): tuple(float(part) for part in limit.split(":", 1))
+    for host, _, limit in (
+        item.partition("=") for item in os.getenv(
+            "UPSTREAM_RATE_LIMITS", "aniliberty.top=10:20,api.anilibria.app=10:20,api.anilibria.tv=5:10,animego=4:8"
+        ).split(",") if "=" in item
+    )
+}
+UPSTREAM_RATE_MAX_WAIT = float(os.getenv("UPSTREAM_RATE_MAX_WAIT", "2.0"))
+
+# Прогрев кэша: свежие релизы из ленты Aniliberty и самые запрашиваемые аниме.
+# Раз в WARM_INTERVAL (+-WARM_JITTER) резолвятся последние WARM_MAX_EPISODES эпизодов
+# не более чем WARM_MAX_RELEASES релизов, по WARM_CONCURRENCY одновременно
+WARM_ENABLED = os.getenv("WARM_ENABLED", "true").lower() == "true"
+WARM_INTERVAL = float(os.getenv("WARM_INTERVAL", "600"))
+WARM_JITTER = float(os.getenv("WARM_JITTER", "0.2"))
+WARM_CONCURRENCY = int(os.getenv("WARM_CONCURRENCY", "4"))
+WARM_MAX_RELEASES = int(os.getenv("WARM_MAX_RELEASES", "50"))
+WARM_MAX_EPISODES = int(os.getenv("WARM_MAX_EPISODES", "6"))
+WARM_LATEST_LIMIT = int(os.getenv("WARM_LATEST_LIMIT", "20"))
+WARM_TOP_N = int(os.getenv("WARM_TOP_N", "20"))
+# Токен административных эндпоинтов (POST /cache/warm, DELETE /cache/clear) в заголовке X-Admin-Token; не задан - они отключены
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Настройки пула соединений к внешним API
+UPSTREAM_POOL_LIMIT = int(os.getenv("UPSTREAM_POOL_LIMIT", "100"))
+UPSTREAM_POOL_LIMIT_PER_HOST = int(os.getenv("UPSTREAM_POOL_LIMIT_PER_HOST", "20"))
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.getenv("UPSTREAM_KEEPALIVE_TIMEOUT", "30"))
+UPSTREAM_DNS_CACHE_TTL = int(os.getenv("UPSTREAM_DNS_CACHE_TTL", "300"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", "10"))
+UPSTREAM_STREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_STREAM_READ_TIMEOUT", "30"))
+# Отдельный пул для медиа: долгие потоки не занимают соединения API-запросов.
+# MEDIA_POOL_LIMIT_PER_HOST=0 - без ограничения на хост (все зрители смотрят с одного CDN)
+MEDIA_POOL_LIMIT = int(os.getenv("MEDIA_POOL_LIMIT", "500"))
+MEDIA_POOL_LIMIT_PER_HOST = int(os.getenv("MEDIA_POOL_LIMIT_PER_HOST", "0"))
+# Retry-After для ответов 503, когда источник или пул соединений недоступен, сек
+UPSTREAM_RETRY_AFTER = int(os.getenv("UPSTREAM_RETRY_AFTER", "5"))
+
+# Заголовки, которые прокси передаёт между клиентом и источником видео
+PROXY_REQUEST_HEADERS = ('Range', 'If-Range', 'If-None-Match', 'If-Modified-Since')
+PROXY_RESPONSE_HEADERS = ('Content-Length', 'Content-Range', 'ETag', 'Last-Modified', 'Accept-Ranges')
+
+# Настройки стриминга медиа клиенту
+# 0 - отдавать данные кусками, как они пришли из сокета (iter_any, без перекопирования)
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(64 * 1024)))
+# Лимит буфера чтения из источника на один поток: при медленном клиенте aiohttp
+# перестаёт читать сокет, и TCP притормаживает источник
+STREAM_BUFFER_SIZE = int(os.getenv("STREAM_BUFFER_SIZE", str(256 * 1024)))
+
+# Настройки HLS прокси
+HLS_PROXY_ENABLED = os.getenv("HLS_PROXY_ENABLED", "true").lower() == "true"
+HLS_MANIFEST_TTL = int(os.getenv("HLS_MANIFEST_TTL", "10"))
+# Хосты (и их поддомены), которые /hls готов проксировать - защита от открытого прокси
+HLS_ALLOWED_HOSTS = [
+    host.strip().lower() for host in os.getenv("HLS_ALLOWED_HOSTS", "libria.fun").split(",") if host.strip()
+]
+
+# Настройки дискового кэша медиа (сегменты и файлы популярных эпизодов)
+MEDIA_CACHE_ENABLED = os.getenv("MEDIA_CACHE_ENABLED", "true").lower() == "true"
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "anidlapi-media"))
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+MEDIA_CACHE_MAX_OBJECT_BYTES = int(os.getenv("MEDIA_CACHE_MAX_OBJECT_BYTES", str(256 * 1024 ** 2)))
+
+# Настройки пула потоков для синхронного клиента AnimeGo (anicli_api)
+ANICLI_EXECUTOR_WORKERS = int(os.getenv("ANICLI_EXECUTOR_WORKERS", "4"))
+ANICLI_QUEUE_LIMIT = int(os.getenv("ANICLI_QUEUE_LIMIT", "32"))
+ANICLI_CALL_TIMEOUT = float(os.getenv("ANICLI_CALL_TIMEOUT", "15"))
+
+# Настройки метрик. С PROMETHEUS_MULTIPROC_DIR (каталог должен быть пуст при старте)
+# метрики всех воркеров uvicorn складываются в общий каталог и агрегируются при отдаче
+ENABLE_METRICS = os.getenv("ENABLE_METRICS", "true").lower() == "true"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "8001"))
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+METRICS_REFRESH_INTERVAL = float(os.getenv("METRICS_REFRESH_INTERVAL", "5"))
+# Сколько самых запрашиваемых аниме получают свою метку anime_id, остальные - "other"
+METRICS_TOP_ANIME = int(os.getenv("METRICS_TOP_ANIME", "20"))
+
+# Задержка event loop: периодическая задача меряет, насколько позже она просыпается;
+# поток-сторож пишет в лог стек event loop, если тот не отвечает дольше LOOP_BLOCK_THRESHOLD
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "true").lower() == "true"
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "1.0"))  # 0 - без сторожа
+
+# Диагностические эндпоинты /debug/* (стеки, профилирование). Требуют заголовок
+# X-Debug-Token со значением DEBUG_TOKEN; без токена не включаются
+DEBUG_ENDPOINTS_ENABLED = os.getenv("DEBUG_ENDPOINTS_ENABLED", "false").lower() == "true"
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN", "")
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+
+# Настройки логирования. Записи уходят в очередь и пишутся отдельным потоком;
+# при переполнении очереди записи отбрасываются, а не блокируют event loop
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_FILE = os.getenv("LOG_FILE")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Уровень сообщений по каждому запросу (debug - скрыть их при LOG_LEVEL=info)
+REQUEST_LOG_LEVEL = logging.getLevelName(os.getenv("REQUEST_LOG_LEVEL", "info").upper())
+# Доля сообщений ниже WARNING, которая проходит через логгер: "логгер=доля" через запятую
+LOG_SAMPLING = {
+    name.strip(): float(rate)
+    for name, _, rate in (item.partition("=") for item in os.getenv("LOG_SAMPLING", "").split(",") if "=" in item)
+}
+
+# Трассировка запросов: спаны в формате OpenTelemetry (OTLP/JSON) уходят в файл
+# (TRACING_EXPORTER=file) или в OTLP/HTTP коллектор (otlp); длительности этапов
+# запроса отдаются в заголовке Server-Timing независимо от экспорта
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none").lower()
+TRACING_FILE = os.getenv("TRACING_FILE", os.path.join(tempfile.gettempdir(), "anidlapi-traces.jsonl"))
+TRACING_OTLP_ENDPOINT = os.getenv("TRACING_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "anidlapi")
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "1.0"))
+TRACING_EXPORT_INTERVAL = float(os.getenv("TRACING_EXPORT_INTERVAL", "5"))
+TRACING_QUEUE_SIZE = int(os.getenv("TRACING_QUEUE_SIZE", "10000"))
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+
+UPSTREAM_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
 
 # Метрики Prometheus
+# Метки endpoint - шаблоны маршрутов, anime_id - только топ METRICS_TOP_ANIME, чтобы число серий было ограничено.
+# Gauge в режиме нескольких процессов агрегируются по живым воркерам (multiprocess_mode)
 REQUEST_COUNT = Counter('anidlapi_requests_total', 'Total requests', ['method', 'endpoint', 'status'])
-REQUEST_DURATION = Histogram('anidlapi_request_duration_seconds', 'Request duration')
-VIDEO_REQUESTS = Counter('anidlapi_video_requests_total', 'Total video requests', ['anime_id'])
+REQUEST_DURATION = Histogram(
+    'anidlapi_request_duration_seconds',
+    'Request duration until response headers, by route',
+    ['method', 'endpoint'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0)
+)
+VIDEO_REQUESTS = Counter('anidlapi_video_requests_total', 'Total video requests (top anime by ID, the rest as "other")', ['anime_id'])
 ERROR_COUNT = Counter('anidlapi_errors_total', 'Total errors', ['error_type'])
 API_SOURCE_COUNT = Counter('anidlapi_api_source_total', 'API source usage', ['source', 'endpoint'])
 ANILIBERTY_REQUESTS = Counter('anidlapi_aniliberty_requests_total', 'Aniliberty API requests', ['endpoint', 'status'])
+BATCH_RESOLVE_ITEMS = Counter('anidlapi_batch_resolve_items_total', 'Items resolved by POST /resolve', ['result'])
+PREFETCH_REQUESTS = Counter('anidlapi_prefetch_requests_total', 'Next-episode prefetch attempts', ['result'])
+PREFETCH_OUTCOMES = Counter(
+    'anidlapi_prefetch_outcomes_total', 'Prefetched episodes that were requested (used) or not within the window (expired)', ['result']
+)
+PREFETCH_INFLIGHT = Gauge('anidlapi_prefetch_inflight', 'Next-episode prefetches in progress', multiprocess_mode='livesum')
+PREFETCH_MEDIA_SEGMENTS_TOTAL = Counter('anidlapi_prefetch_media_segments_total', 'HLS segments pre-warmed into the disk cache', ['result'])
+CACHE_WARM_RUNS = Counter('anidlapi_cache_warm_runs_total', 'Cache warm-up runs', ['trigger'])
+CACHE_WARM_RELEASES = Counter('anidlapi_cache_warm_releases_total', 'Releases processed by cache warm-up', ['result'])
+CACHE_WARM_EPISODES = Counter('anidlapi_cache_warm_episodes_total', 'Episodes pre-resolved by cache warm-up')
+CACHE_WARM_DURATION = Histogram(
+    'anidlapi_cache_warm_duration_seconds',
+    'Cache warm-up run duration',
+    buckets=(0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0)
+)
+RELEASE_LOOKUPS = Counter('anidlapi_release_lookups_total', 'Aniliberty release lookups by ID', ['source'])
+UPSTREAM_POOL_OPEN = Gauge(
+    'anidlapi_upstream_pool_open_connections', 'Open upstream connections (in use + idle)', ['pool'], multiprocess_mode='livesum'
+)
+UPSTREAM_POOL_IDLE = Gauge(
+    'anidlapi_upstream_pool_idle_connections', 'Idle keep-alive upstream connections', ['pool'], multiprocess_mode='livesum'
+)
+UPSTREAM_POOL_WAITING = Gauge(
+    'anidlapi_upstream_pool_waiting_requests', 'Requests waiting for a free upstream connection', ['pool'], multiprocess_mode='livesum'
+)
+UPSTREAM_POOL_ACQUIRE_WAIT = Histogram(
+    'anidlapi_upstream_pool_acquire_wait_seconds',
+    'Time spent waiting for a free upstream connection when the pool is exhausted',
+    ['pool'],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+UPSTREAM_POOL_CONNECTIONS = Counter('anidlapi_upstream_pool_connections_total', 'Upstream connection acquisitions', ['pool', 'result'])
+CACHE_REQUESTS = Counter('anidlapi_cache_requests_total', 'Cache lookups by tier', ['tier', 'result'])
+CACHE_LATENCY = Histogram(
+    'anidlapi_cache_operation_duration_seconds',
+    'Cache operation latency by tier',
+    ['tier', 'operation'],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+)
+CACHE_EVICTIONS = Counter('anidlapi_cache_evictions_total', 'L1 cache entries evicted to stay within limits', ['reason'])
+UPSTREAM_THROTTLED = Counter(
+    'anidlapi_upstream_throttled_total', 'Outbound calls delayed (queued) or dropped (shed) by the per-host token bucket', ['host', 'result']
+)
+UPSTREAM_THROTTLE_WAIT = Histogram(
+    'anidlapi_upstream_throttle_wait_seconds',
+    'Time outbound calls waited for a token',
+    ['host'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0)
+)
+RESOLVED_CACHE_LOOKUPS = Counter(
+    'anidlapi_resolved_cache_lookups_total', 'Video URL / qualities cache lookups by freshness', ['kind', 'result']
+)
+CACHE_REVALIDATIONS = Counter('anidlapi_cache_revalidations_total', 'Background refreshes of stale resolved entries', ['kind', 'result'])
+CACHE_EXPIRATIONS = Counter('anidlapi_cache_expirations_total', 'L1 cache entries removed after TTL expiry')
+CACHE_L1_ENTRIES = Gauge('anidlapi_cache_l1_entries', 'Entries in the in-process L1 cache', multiprocess_mode='livesum')
+CACHE_L1_BYTES = Gauge('anidlapi_cache_l1_bytes', 'Estimated size of the in-process L1 cache in bytes', multiprocess_mode='livesum')
+STREAMS_ACTIVE = Gauge('anidlapi_streams_active', 'Media streams currently being proxied to clients', multiprocess_mode='livesum')
+STREAM_BYTES = Counter('anidlapi_stream_bytes_total', 'Bytes streamed to clients from upstream', ['kind'])
+STREAM_RESULTS = Counter('anidlapi_streams_total', 'Finished media streams', ['kind', 'result'])
+STREAM_DURATION = Histogram(
+    'anidlapi_stream_duration_seconds',
+    'Media stream lifetime',
+    ['kind'],
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+)
+STREAM_THROUGHPUT = Histogram(
+    'anidlapi_stream_throughput_bytes_per_second',
+    'Average throughput of finished media streams',
+    ['kind'],
+    buckets=(64e3, 256e3, 512e3, 1e6, 2e6, 5e6, 10e6, 25e6, 50e6, 100e6)
+)
+HLS_REQUESTS = Counter('anidlapi_hls_requests_total', 'HLS proxy requests', ['kind', 'status'])
+MEDIA_CACHE_REQUESTS = Counter('anidlapi_media_cache_requests_total', 'Disk media cache lookups', ['result'])
+MEDIA_CACHE_BYTES_SAVED = Counter('anidlapi_media_cache_bytes_saved_total', 'Bytes served from the disk media cache instead of upstream')
+MEDIA_CACHE_EVICTIONS = Counter('anidlapi_media_cache_evictions_total', 'Files evicted from the disk media cache')
+MEDIA_CACHE_SIZE = Gauge('anidlapi_media_cache_bytes', 'Size of the disk media cache known to this worker', multiprocess_mode='livemax')
+PROVIDER_WINS = Counter('anidlapi_provider_wins_total', 'Resolutions won by provider', ['scope', 'provider'])
+PROVIDER_ATTEMPTS = Histogram(
+    'anidlapi_provider_attempt_duration_seconds',
+    'Provider attempt duration by outcome',
+    ['scope', 'provider', 'result'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 20.0)
+)
+PROVIDER_BREAKER_STATE = Gauge(
+    'anidlapi_provider_breaker_state', 'Circuit breaker state (0 - closed, 1 - half-open, 2 - open), worst across workers', ['scope', 'provider'],
+    multiprocess_mode='livemax'
+)
+PROVIDER_EWMA_LATENCY = Gauge('anidlapi_provider_ewma_latency_seconds', 'EWMA of provider call latency', ['scope', 'provider'], multiprocess_mode='livemostrecent')
+PROVIDER_EWMA_SUCCESS = Gauge('anidlapi_provider_ewma_success_ratio', 'EWMA of provider calls that completed without error or timeout', ['scope', 'provider'], multiprocess_mode='livemostrecent')
+BREAKER_TRANSITIONS = Counter('anidlapi_breaker_transitions_total', 'Circuit breaker state changes', ['scope', 'provider', 'state'])
+BREAKER_REJECTED = Counter('anidlapi_breaker_rejected_total', 'Calls skipped because the circuit breaker was open', ['scope', 'provider'])
+HEDGES_LAUNCHED = Counter('anidlapi_hedges_launched_total', 'Attempts started early because the previous one was slow', ['scope'])
+HEDGE_TIME_SAVED = Histogram(
+    'anidlapi_hedge_time_saved_seconds',
+    'Lower-bound estimate of latency saved when a hedged attempt won while earlier ones were still running',
+    ['scope'],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+)
+SINGLEFLIGHT_REQUESTS = Counter(
+    'anidlapi_singleflight_requests_total',
+    'Upstream resolutions by single-flight role (leader or coalesced follower)',
+    ['kind', 'role']
+)
+ANICLI_QUEUE_DEPTH = Gauge('anidlapi_anicli_queue_depth', 'AnimeGo calls waiting for a free executor thread', multiprocess_mode='livesum')
+ANICLI_INFLIGHT = Gauge('anidlapi_anicli_inflight_calls', 'AnimeGo calls submitted to the executor and not finished yet', multiprocess_mode='livesum')
+ANICLI_QUEUE_DEPTH_OBSERVED = Histogram(
+    'anidlapi_anicli_queue_depth_observed',
+    'AnimeGo executor queue depth seen by each new call',
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64)
+)
+ANICLI_QUEUE_WAIT = Histogram(
+    'anidlapi_anicli_queue_wait_seconds',
+    'Time an AnimeGo call spent queued before a thread picked it up',
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+ANICLI_CALL_DURATION = Histogram(
+    'anidlapi_anicli_call_duration_seconds',
+    'AnimeGo call duration inside the executor',
+    ['method', 'status'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0)
+)
+ANICLI_REJECTED = Counter('anidlapi_anicli_rejected_total', 'AnimeGo calls rejected by the executor', ['reason'])
+LOG_RECORDS_DROPPED = Counter('anidlapi_log_records_dropped_total', 'Log records dropped by sampling or a full log queue', ['reason'])
+TRACE_SPANS = Counter('anidlapi_trace_spans_total', 'Finished trace spans by export result', ['result'])
+LOOP_LAG = Histogram(
+    'anidlapi_event_loop_lag_seconds',
+    'How late a periodic event loop callback wakes up compared to its schedule',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+LOOP_BLOCKED = Counter('anidlapi_event_loop_blocked_total', 'Times the event loop stayed unresponsive longer than LOOP_BLOCK_THRESHOLD')
+ASYNCIO_TASKS = Gauge('anidlapi_asyncio_tasks', 'Pending asyncio tasks in the worker event loop', multiprocess_mode='livesum')
+STREAM_BYTES_IN_FLIGHT = Gauge(
+    'anidlapi_stream_bytes_in_flight', 'Bytes read from media upstreams and not yet sent to clients', multiprocess_mode='livesum'
+)
+PROCESS_RSS = Gauge('anidlapi_process_resident_memory_bytes', 'Resident memory of the worker process', multiprocess_mode='livesum')
+
+# Настройка логирования: JSON (или текст) через очередь, с ID запроса
+request_id_var: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+
+class RequestIdFilter(logging.Filter):
+    """Подставляет ID текущего запроса; выполняется в потоке, где запись создана"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю rate записей ниже WARNING; предупреждения и ошибки - всегда"""
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or random.random() < self.rate:
+            return True
+        LOG_RECORDS_DROPPED.labels(reason="sampled").inc()
+        return False
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-")
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Кладёт запись в очередь без форматирования: сообщение собирается в потоке QueueListener"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels(reason="queue_full").inc()
+
+UVICORN_LOGGERS = ("uvicorn", "uvicorn.error", "uvicorn.access")
+
+def configure_logging() -> QueueListener:
+    if LOG_FORMAT == "json":
+        formatter: logging.Formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+    handlers: List[logging.Handler] = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        try:
+            os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+            handlers.append(logging.FileHandler(LOG_FILE, encoding="utf-8"))
+        except OSError as e:
+            print(f"Log file {LOG_FILE} is not writable: {e}", file=sys.stderr)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.addFilter(RequestIdFilter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # uvicorn к моменту импорта уже повесил свои синхронные StreamHandler на stderr:
+    # снимаем их, и записи uvicorn.error/uvicorn.access идут через ту же очередь
+    for name in UVICORN_LOGGERS:
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+    for name, rate in LOG_SAMPLING.items():
+        logging.getLogger(name).addFilter(SamplingFilter(rate))
+
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Дописываем очередь при завершении процесса
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
+
+def log_request_event(message: str, *args: Any):
+    """Сообщение по запросу: уровень REQUEST_LOG_LEVEL, аргументы форматируются только если запись пройдёт"""
+    request_logger.log(REQUEST_LOG_LEVEL, message, *args)
+
+# Трассировка: спаны совместимы с OpenTelemetry (W3C traceparent, OTLP/JSON)
+SPAN_KIND_INTERNAL, SPAN_KIND_SERVER, SPAN_KIND_CLIENT = 1, 2, 3
+TRACEPARENT_PATTERN = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+class RequestTrace:
+    """Трасса одного входящего запроса: суммы длительностей для Server-Timing.
+
+    После отправки заголовков ответа трасса закрыта: спаны, завершившиеся позже
+    (поток медиа, резолв, продолжившийся после отключения клиента), в Server-Timing не попадают.
+    """
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.timings: Dict[str, float] = {}
+        self.closed = False
+
+    def server_timing(self, total_ms: float) -> str:
+        entries = [f"{name};dur={duration:.1f}" for name, duration in self.timings.items()]
+        entries.append(f"total;dur={total_ms:.1f}")
+        return ", ".join(entries)
+
+class Span:
+    """Спан трассы; при завершении попадает в Server-Timing (если задан timing) и в экспорт"""
+    __slots__ = ("trace", "name", "span_id", "parent_id", "kind", "timing", "attributes",
+                 "start_ns", "end_ns", "error", "links")
+
+    def __init__(self, trace: RequestTrace, name: str, parent_id: Optional[str], kind: int,
+                 timing: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.timing = timing
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+        self.links: List[Tuple[str, str]] = []  # (trace_id, span_id) связанных спанов других трасс
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set(self, **attributes: Any):
+        self.attributes.update(attributes)
+
+    def fail(self, error: BaseException):
+        if isinstance(error, asyncio.CancelledError):
+            # Отменённая попытка (проиграла хеджирование, клиент отключился) - не ошибка
+            self.attributes["cancelled"] = True
+        else:
+            self.error = f"{type(error).__name__}: {error}"
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if self.timing and not self.trace.closed:
+            timings = self.trace.timings
+            timings[self.timing] = timings.get(self.timing, 0.0) + self.duration_ms
+        if self.trace.sampled:
+            tracer.export(self)
+
+    @staticmethod
+    def _otlp_value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [{"key": key, "value": self._otlp_value(value)} for key, value in self.attributes.items()],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.links:
+            span["links"] = [{"traceId": trace_id, "spanId": span_id} for trace_id, span_id in self.links]
+        return span
+
+current_span_var: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+class Tracer:
+    """Создаёт спаны и пачками экспортирует завершённые в файл или OTLP/HTTP коллектор.
+
+    Спаны создаются только внутри трассы: входящего запроса или фоновой задачи,
+    запущенной через spawn_background (своя трасса со ссылкой на спан запроса).
+    Задачи, запущенные из запроса напрямую через create_task, наследуют его
+    контекст - работа, которая переживает запрос, должна идти через spawn_background.
+    Экспорт идёт из фоновой задачи раз в TRACING_EXPORT_INTERVAL; при
+    переполнении очереди спаны отбрасываются.
+    """
+    def __init__(self):
+        self.exporter = TRACING_EXPORTER if TRACING_EXPORTER in ("file", "otlp") else None
+        self.pending: deque = deque()
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start_trace(self, name: str, traceparent: Optional[str], **attributes: Any) -> Optional[Span]:
+        """Корневой спан запроса; продолжает трассу из заголовка traceparent, если он есть"""
+        match = TRACEPARENT_PATTERN.match(traceparent or "")
+        if match and match.group(1) != "0" * 32:
+            trace_id, parent_id = match.group(1), match.group(2)
+            sampled = bool(int(match.group(3), 16) & 1)
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+            sampled = random.random() < TRACING_SAMPLE_RATE
+        sampled = sampled and self.exporter is not None
+        if not sampled and not SERVER_TIMING_ENABLED:
+            return None
+        return Span(RequestTrace(trace_id, sampled), name, parent_id, SPAN_KIND_SERVER, None, attributes)
+
+    def start_background(self, name: str, link: Optional[Span], **attributes: Any) -> Optional[Span]:
+        """Корневой спан фоновой задачи: новая трасса без Server-Timing, связанная со спаном link"""
+        if self.exporter is None:
+            return None
+        sampled = link.trace.sampled if link is not None else random.random() < TRACING_SAMPLE_RATE
+        if not sampled:
+            return None
+        trace = RequestTrace(os.urandom(16).hex(), True)
+        trace.closed = True
+        span = Span(trace, name, None, SPAN_KIND_INTERNAL, None, attributes)
+        if link is not None:
+            span.links.append((link.trace.trace_id, link.span_id))
+        return span
+
+    async def run_background(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        root = current_span_var.get()
+        if root is None:
+            return await coro
+        try:
+            return await coro
+        except BaseException as e:
+            root.fail(e)
+            raise
+        finally:
+            root.end()
+
+    def start_span(self, name: str, timing: Optional[str] = None, kind: int = SPAN_KIND_INTERNAL,
+                   **attributes: Any) -> Optional[Span]:
+        """Дочерний спан текущего; завершается вызовом end()"""
+        parent = current_span_var.get()
+        if parent is None:
+            return None
+        return Span(parent.trace, name, parent.span_id, kind, timing, attributes)
+
+    @contextlib.contextmanager
+    def span(self, name: str, timing: Optional[str] = None, kind: int = SPAN_KIND_INTERNAL, **attributes: Any):
+        span = self.start_span(name, timing, kind, **attributes)
+        if span is None:
+            yield None
+            return
+        token = current_span_var.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.fail(e)
+            raise
+        finally:
+            current_span_var.reset(token)
+            span.end()
+
+    def export(self, span: Span):
+        if len(self.pending) >= TRACING_QUEUE_SIZE:
+            TRACE_SPANS.labels(result="dropped").inc()
+            return
+        self.pending.append(span)
+
+    def _payload(self, spans: List[Span]) -> Dict[str, Any]:
+        """ExportTraceServiceRequest в JSON-кодировке OTLP"""
+        return {"resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": {"stringValue": TRACING_SERVICE_NAME}},
+                {"key": "process.pid", "value": {"intValue": str(os.getpid())}}
+            ]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp() for span in spans]}]
+        }]}
+
+    @staticmethod
+    def _append_file(line: str):
+        with open(TRACING_FILE, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    async def flush(self):
+        spans = []
+        while self.pending:
+            spans.append(self.pending.popleft())
+        if not spans:
+            return
+        payload = self._payload(spans)
+        try:
+            if self.exporter == "file":
+                # Формат строки - как у file exporter коллектора OpenTelemetry
+                await asyncio.to_thread(self._append_file, json.dumps(payload, ensure_ascii=False) + "\n")
+            else:
+                if self.session is None or self.session.closed:
+                    self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5))
+                async with self.session.post(TRACING_OTLP_ENDPOINT, json=payload) as response:
+                    if response.status >= 300:
+                        raise RuntimeError(f"collector returned status {response.status}")
+            TRACE_SPANS.labels(result="exported").inc(len(spans))
+        except Exception as e:
+            TRACE_SPANS.labels(result="failed").inc(len(spans))
+            logger.warning("Failed to export %s trace spans via %s: %s", len(spans), self.exporter, e)
 
-# Инициализация rate limiter
-limiter = Limiter(key_func=get_remote_address)
+    async def run_forever(self):
+        while True:
+            await asyncio.sleep(TRACING_EXPORT_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        if self.exporter is not None and self.task is None:
+            self.task = asyncio.create_task(self.run_forever())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.exporter is not None:
+            await self.flush()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "exporter": self.exporter or "none",
+            "sample_rate": TRACING_SAMPLE_RATE,
+            "server_timing": SERVER_TIMING_ENABLED,
+            "pending_spans": len(self.pending)
+        }
+
+tracer = Tracer()
+
+def spawn_background(coro: Coroutine[Any, Any, Any], name: str, **attributes: Any) -> asyncio.Task:
+    """Задача, которая может пережить запрос (предзагрузка, фоновое обновление кэша).
+
+    Контекст копируется (ID запроса остаётся в логах), но текущий спан
+    заменяется корнем отдельной трассы: работа задачи не попадает в спаны
+    и Server-Timing запроса.
+    """
+    context = contextvars.copy_context()
+    context.run(current_span_var.set, tracer.start_background(name, current_span_var.get(), **attributes))
+    return asyncio.create_task(tracer.run_background(coro), context=context)
+
+# IP клиента с учётом доверенных прокси
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+def client_ip(request: Request) -> str:
+    """Адрес клиента: X-Forwarded-For разбирается справа налево, пока адреса принадлежат доверенным прокси"""
+    peer = get_remote_address(request)
+    forwarded = request.headers.get("X-Forwarded-For")
+    if not forwarded or not _is_trusted_proxy(peer):
+        return peer
+    hops = [hop.strip() for hop in forwarded.split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not _is_trusted_proxy(hop):
+            return hop
+    return hops[0] if hops else peer
+
+# Инициализация rate limiter: счётчики в Redis общие для всех воркеров;
+# при недоступности Redis лимиты временно считаются в памяти воркера
+limiter = Limiter(
+    key_func=client_ip,
+    storage_uri=RATE_LIMIT_STORAGE_URI,
+    storage_options={"socket_timeout": REDIS_TIMEOUT, "socket_connect_timeout": REDIS_TIMEOUT}
+    if RATE_LIMIT_STORAGE_URI.startswith(("redis://", "rediss://")) else {},
+    strategy=RATE_LIMIT_STRATEGY,
+    key_prefix=f"{REDIS_KEY_PREFIX}ratelimit",
+    in_memory_fallback_enabled=True,
+    enabled=RATE_LIMIT_ENABLED
+)
 app = FastAPI(title="AnidLapi Service", version="1.0.0")
 
 # Настройка CORS
@@ -46,93 +812,1430 @@ app.add_middleware(
 # Добавление middleware для rate limiting
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-app.add_middleware(SlowAPIMiddleware)
 
-# Кэш в памяти с TTL
-class TTLCache:
-    def __init__(self, ttl: int = 3600):
-        self.cache: Dict[str, Dict[str, Any]] = {}
+class RouteLimitChecker:
+    """Проверка лимитов @limiter.limit до вызова эндпоинта.
+
+    Публичного API для этого у slowapi нет (его SlowAPIMiddleware делает то же
+    самое), поэтому все обращения к внутренностям собраны здесь: Limiter._route_limits,
+    Limiter._check_request_limit и флаг request.state._rate_limiting_complete.
+    Проверено на slowapi==0.1.9 из requirements.txt - при обновлении сверить их.
+    """
+    def __init__(self, limiter: Limiter):
+        self.limiter = limiter
+
+    def handler_for(self, request: Request) -> Optional[Callable]:
+        """Эндпоинт запроса, если на нём есть @limiter.limit"""
+        for route in app.router.routes:
+            match, _ = route.matches(request.scope)
+            if match == Match.FULL:
+                handler = getattr(route, "endpoint", None)
+                if handler is None or f"{handler.__module__}.{handler.__name__}" not in self.limiter._route_limits:
+                    return None
+                return handler
+        return None
+
+    def check(self, request: Request, handler: Callable):
+        """Учитывает запрос в лимитах эндпоинта; RateLimitExceeded, если лимит исчерпан"""
+        self.limiter._check_request_limit(request, handler, False)
+
+    @staticmethod
+    def mark_checked(request: Request):
+        """Декоратор @limiter.limit увидит флаг и повторно лимит не проверит"""
+        request.state._rate_limiting_complete = True
+
+route_limit_checker = RouteLimitChecker(limiter)
+
+# Проверка лимита slowapi синхронна: с Redis это сетевой вызов, поэтому он идёт
+# в отдельном пуле потоков, а не в event loop
+RATE_LIMIT_OFFLOAD = RATE_LIMIT_STORAGE_URI.startswith(("redis://", "rediss://"))
+rate_limit_executor = ThreadPoolExecutor(max_workers=RATE_LIMIT_CHECK_THREADS, thread_name_prefix="ratelimit")
+
+@app.middleware("http")
+async def rate_limit_middleware(request: Request, call_next):
+    if not limiter.enabled:
+        return await call_next(request)
+    handler = route_limit_checker.handler_for(request)
+    if handler is None:
+        return await call_next(request)
+    try:
+        if RATE_LIMIT_OFFLOAD:
+            await asyncio.get_running_loop().run_in_executor(
+                rate_limit_executor, route_limit_checker.check, request, handler
+            )
+        else:
+            route_limit_checker.check(request, handler)
+    except RateLimitExceeded as e:
+        return _rate_limit_exceeded_handler(request, e)
+    route_limit_checker.mark_checked(request)
+    return await call_next(request)
+
+# Запись L1 кэша
+class CacheEntry:
+    __slots__ = ('value', 'expires_at', 'size')
+
+    def __init__(self, value: Any, expires_at: float, size: int):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+
+# Ограниченный LRU кэш в памяти с TTL
+class LRUTTLCache:
+    """O(1) get/set, вытеснение по LRU при превышении max_entries/max_bytes.
+
+    Истёкшие записи удаляются по куче сроков жизни, без полного обхода кэша.
+    """
+    ENTRY_OVERHEAD = 200  # Примерный расход памяти на запись, ключ и элемент кучи
+
+    def __init__(self, ttl: int = 3600, max_entries: int = 10000, max_bytes: int = 64 * 1024 * 1024):
         self.ttl = ttl
-    
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.expiry_heap: list = []
+        self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def keys(self) -> list:
+        return list(self.entries.keys())
+
+    @classmethod
+    def _estimate_size(cls, key: str, value: Any) -> int:
+        if isinstance(value, str):
+            value_size = len(value)
+        else:
+            value_size = len(json.dumps(value, separators=(',', ':')))
+        return cls.ENTRY_OVERHEAD + len(key) + value_size
+
+    def _remove(self, key: str) -> CacheEntry:
+        entry = self.entries.pop(key)
+        self.bytes -= entry.size
+        return entry
+
     def get(self, key: str) -> Optional[Any]:
-        if key in self.cache:
-            if time.time() - self.cache[key]['timestamp'] < self.ttl:
-                return self.cache[key]['data']
-            else:
-                del self.cache[key]
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() >= entry.expires_at:
+            self._remove(key)
+            CACHE_EXPIRATIONS.inc()
+            return None
+        self.entries.move_to_end(key)
+        return entry.value
+
+    def set(self, key: str, value: Any, ttl: Optional[int] = None):
+        size = self._estimate_size(key, value)
+        if key in self.entries:
+            self._remove(key)
+        if size > self.max_bytes:
+            CACHE_EVICTIONS.labels(reason="too_large").inc()
+            return
+        expires_at = time.monotonic() + (ttl if ttl is not None else self.ttl)
+        self.entries[key] = CacheEntry(value, expires_at, size)
+        self.bytes += size
+        heapq.heappush(self.expiry_heap, (expires_at, key))
+        self._evict()
+        # Перезаписанные ключи оставляют устаревшие элементы в куче - периодически пересобираем её
+        if len(self.expiry_heap) > 2 * len(self.entries) + 64:
+            self.expiry_heap = [(entry.expires_at, k) for k, entry in self.entries.items()]
+            heapq.heapify(self.expiry_heap)
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            CACHE_EVICTIONS.labels(reason="max_entries").inc()
+        while self.bytes > self.max_bytes and self.entries:
+            self._remove(next(iter(self.entries)))
+            CACHE_EVICTIONS.labels(reason="max_bytes").inc()
+
+    def clear_expired(self) -> int:
+        """Удаляет истёкшие записи за O(k log n), где k - число истёкших элементов кучи"""
+        now = time.monotonic()
+        removed = 0
+        heap = self.expiry_heap
+        while heap and heap[0][0] <= now:
+            expires_at, key = heapq.heappop(heap)
+            entry = self.entries.get(key)
+            # Элемент кучи мог устареть: ключ перезаписан или уже вытеснен
+            if entry is not None and entry.expires_at == expires_at:
+                self._remove(key)
+                removed += 1
+        if removed:
+            CACHE_EXPIRATIONS.inc(removed)
+        return removed
+
+    def clear(self):
+        self.entries.clear()
+        self.expiry_heap = []
+        self.bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes
+        }
+
+# Ошибки связи с Redis: после них L2 отключается на REDIS_RETRY_INTERVAL.
+# Ошибка команды или скрипта (ResponseError) о недоступности Redis не говорит
+REDIS_CONNECTION_ERRORS = (OSError, asyncio.TimeoutError) + (
+    (aioredis.ConnectionError, aioredis.TimeoutError) if aioredis is not None else ()
+)
+
+# Двухуровневый кэш: L1 в памяти процесса, L2 в Redis
+class TieredCache:
+    """Кэш, общий для всех воркеров uvicorn, с деградацией до L1 при недоступном Redis"""
+    def __init__(self, l1: LRUTTLCache, key_ttls: Dict[str, int], l1_ttl: int):
+        self.l1 = l1
+        self.key_ttls = key_ttls
+        self.l1_ttl = l1_ttl
+        self.redis = None
+        self.redis_down_until = 0.0
+
+    def ttl_for(self, key: str) -> int:
+        """TTL по типу ключа: префикс до первого '_' (video, qualities, ...)"""
+        return self.key_ttls.get(key.split('_', 1)[0], self.l1.ttl)
+
+    async def connect(self):
+        if not REDIS_URL or aioredis is None:
+            logger.info("Redis L2 cache disabled, using in-process cache only")
+            return
+        self.redis = aioredis.from_url(
+            REDIS_URL,
+            db=REDIS_DB,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT
+        )
+        try:
+            await self.redis.ping()
+            logger.info("Redis L2 cache connected")
+        except Exception as e:
+            self.mark_down(e)
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.close()
+            self.redis = None
+
+    def _redis_available(self) -> bool:
+        return self.redis is not None and time.monotonic() >= self.redis_down_until
+
+    def l2_client(self):
+        """Клиент Redis, если L2 сейчас доступен, иначе None"""
+        return self.redis if self._redis_available() else None
+
+    async def _decode_l2(self, key: str, raw: Any) -> Optional[Any]:
+        """Значение из Redis; битое (чужая запись, обрезка) удаляется и считается промахом"""
+        try:
+            return json.loads(raw)
+        except ValueError as e:
+            CACHE_REQUESTS.labels(tier="l2", result="corrupt").inc()
+            logger.warning("Corrupt L2 cache entry %s dropped: %s", key, e)
+        try:
+            await self.redis.delete(REDIS_KEY_PREFIX + key)
+        except Exception as e:
+            self.mark_down(e)
         return None
-    
-    def set(self, key: str, value: Any):
-        self.cache[key] = {
-            'data': value,
-            'timestamp': time.time()
+
+    async def peek_l2(self, key: str) -> Optional[Any]:
+        """Чтение из L2 без учёта в метриках попаданий (для ожидания чужого резолва)"""
+        redis = self.l2_client()
+        if redis is None:
+            return None
+        try:
+            raw = await redis.get(REDIS_KEY_PREFIX + key)
+        except Exception as e:
+            self.mark_down(e)
+            return None
+        if raw is None:
+            return None
+        value = await self._decode_l2(key, raw)
+        if value is None:
+            return None
+        self.l1.set(key, value, min(self.l1_ttl, self.ttl_for(key)))
+        return value
+
+    def mark_down(self, error: Exception):
+        """Отключает L2 на REDIS_RETRY_INTERVAL, чтобы не ждать таймаут Redis на каждом запросе"""
+        self.redis_down_until = time.monotonic() + REDIS_RETRY_INTERVAL
+        CACHE_REQUESTS.labels(tier="l2", result="error").inc()
+        logger.warning("Redis L2 cache unavailable, retry in %ss: %s", REDIS_RETRY_INTERVAL, error)
+
+    async def get(self, key: str) -> Optional[Any]:
+        with tracer.span("cache.l1", timing="cache_l1", key=key) as span:
+            start = time.perf_counter()
+            value = self.l1.get(key)
+            CACHE_LATENCY.labels(tier="l1", operation="get").observe(time.perf_counter() - start)
+            if span is not None:
+                span.set(hit=value is not None)
+        if value is not None:
+            CACHE_REQUESTS.labels(tier="l1", result="hit").inc()
+            return value
+        CACHE_REQUESTS.labels(tier="l1", result="miss").inc()
+
+        if not self._redis_available():
+            return None
+        with tracer.span("cache.l2", timing="cache_l2", kind=SPAN_KIND_CLIENT, key=key) as span:
+            start = time.perf_counter()
+            try:
+                raw = await self.redis.get(REDIS_KEY_PREFIX + key)
+            except Exception as e:
+                self.mark_down(e)
+                if span is not None:
+                    span.fail(e)
+                return None
+            finally:
+                CACHE_LATENCY.labels(tier="l2", operation="get").observe(time.perf_counter() - start)
+            if span is not None:
+                span.set(hit=raw is not None)
+        if raw is None:
+            CACHE_REQUESTS.labels(tier="l2", result="miss").inc()
+            return None
+        value = await self._decode_l2(key, raw)
+        if value is None:
+            return None
+        CACHE_REQUESTS.labels(tier="l2", result="hit").inc()
+        self.l1.set(key, value, min(self.l1_ttl, self.ttl_for(key)))
+        return value
+
+    async def set(self, key: str, value: Any, ttl: Optional[int] = None):
+        ttl = ttl if ttl is not None else self.ttl_for(key)
+        self.l1.set(key, value, min(self.l1_ttl, ttl))
+        if not self._redis_available():
+            return
+        start = time.perf_counter()
+        try:
+            await self.redis.set(REDIS_KEY_PREFIX + key, json.dumps(value), ex=ttl)
+        except Exception as e:
+            self.mark_down(e)
+        finally:
+            CACHE_LATENCY.labels(tier="l2", operation="set").observe(time.perf_counter() - start)
+
+    async def clear(self):
+        self.l1.clear()
+        if not self._redis_available():
+            return
+        try:
+            keys = [key async for key in self.redis.scan_iter(match=REDIS_KEY_PREFIX + "*", count=500)]
+            if keys:
+                await self.redis.delete(*keys)
+        except Exception as e:
+            self.mark_down(e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "l1": self.l1.stats(),
+            "l2_enabled": self.redis is not None,
+            "l2_available": self._redis_available()
         }
-    
-    def clear_expired(self):
-        current_time = time.time()
-        expired_keys = [
-            key for key, item in self.cache.items()
-            if current_time - item['timestamp'] >= self.ttl
-        ]
-        for key in expired_keys:
-            del self.cache[key]
 
 # Глобальный кэш
-cache = TTLCache(ttl=3600)
+cache = TieredCache(
+    LRUTTLCache(ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES),
+    key_ttls={
+        "video": CACHE_TTL_VIDEO,
+        "qualities": CACHE_TTL_QUALITIES,
+        "release": CACHE_TTL_RELEASE,
+        "episodes": CACHE_TTL_RELEASE,
+        "hls": HLS_MANIFEST_TTL
+    },
+    l1_ttl=CACHE_L1_TTL
+)
+
+# Объединение одновременных промахов кэша (single-flight)
+class SingleFlight:
+    """Одновременные запросы одного ключа ждут одно обращение к провайдерам.
+
+    Внутри воркера запросы ждут общую задачу, между воркерами - Redis-блокировку
+    и результат лидера в L2 кэше.
+    """
+    RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+    def __init__(self, cache: TieredCache):
+        self.cache = cache
+        self.inflight: Dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, resolver: Callable[[], Awaitable[Any]]) -> Any:
+        """Возвращает результат resolver() для ключа, выполняя его не более одного раза одновременно"""
+        kind = key.split('_', 1)[0]
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._resolve(key, kind, resolver))
+            self.inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            SINGLEFLIGHT_REQUESTS.labels(kind=kind, role="coalesced_local").inc()
+        # shield: отмена одного клиента не отменяет резолв для остальных
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+        if not task.cancelled():
+            task.exception()
+
+    async def _resolve(self, key: str, kind: str, resolver: Callable[[], Awaitable[Any]]) -> Any:
+        redis = self.cache.l2_client()
+        if redis is None:
+            SINGLEFLIGHT_REQUESTS.labels(kind=kind, role="leader").inc()
+            return await resolver()
+
+        lock_key = f"{REDIS_KEY_PREFIX}lock:{key}"
+        token = uuid.uuid4().hex
+        try:
+            acquired = await redis.set(lock_key, token, nx=True, px=int(SINGLEFLIGHT_LOCK_TTL * 1000))
+        except Exception as e:
+            self.cache.mark_down(e)
+            SINGLEFLIGHT_REQUESTS.labels(kind=kind, role="leader").inc()
+            return await resolver()
+
+        if acquired:
+            SINGLEFLIGHT_REQUESTS.labels(kind=kind, role="leader").inc()
+            try:
+                return await resolver()
+            finally:
+                await self._release(redis, lock_key, token)
+
+        # Другой воркер уже резолвит этот ключ - ждём его результат в L2
+        SINGLEFLIGHT_REQUESTS.labels(kind=kind, role="coalesced_remote").inc()
+        deadline = time.monotonic() + min(SINGLEFLIGHT_WAIT_TIMEOUT, RESOLVE_BUDGET)
+        while time.monotonic() < deadline:
+            await asyncio.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+            value = await self.cache.peek_l2(key)
+            if value is not None:
+                return value
+            try:
+                if not await redis.exists(lock_key):
+                    break
+            except Exception as e:
+                self.cache.mark_down(e)
+                break
+        # Лидер ничего не нашёл или не уложился в ожидание - резолвим сами
+        return await resolver()
+
+    async def _release(self, redis, lock_key: str, token: str):
+        """Снимает свою блокировку. Если скрипт не выполнился, снимает её GET и DEL
+        с проверкой токена, чтобы остальные воркеры не ждали истечения TTL"""
+        try:
+            await redis.eval(self.RELEASE_SCRIPT, 1, lock_key, token)
+            return
+        except Exception as e:
+            logger.warning("Failed to release single-flight lock %s by script, falling back to DEL: %s", lock_key, e)
+        try:
+            # Без атомарности скрипта: чужую блокировку удалим, только если наша истекла между GET и DEL
+            if await redis.get(lock_key) == token.encode():
+                await redis.delete(lock_key)
+        except REDIS_CONNECTION_ERRORS as e:
+            self.cache.mark_down(e)
+        except Exception as e:
+            logger.warning("Failed to release single-flight lock %s, it expires in %ss: %s", lock_key, SINGLEFLIGHT_LOCK_TTL, e)
+
+# Глобальный single-flight
+single_flight = SingleFlight(cache)
+
+# Дисковый кэш проксируемых медиа
+class MediaCacheWriter:
+    """Записывает поток во временный файл и атомарно публикует его после полной загрузки"""
+    def __init__(self, media_cache: "MediaDiskCache", key: str, meta: Dict[str, Any]):
+        self.media_cache = media_cache
+        self.key = key
+        self.meta = meta
+        self.tmp_path = f"{media_cache.data_path(key)}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        self.file = None
+        self.written = 0
+        self.failed = False
+
+    async def write(self, chunk: bytes):
+        if self.failed:
+            return
+        try:
+            if self.file is None:
+                await aiofiles.os.makedirs(os.path.dirname(self.tmp_path), exist_ok=True)
+                self.file = await aiofiles.open(self.tmp_path, 'wb')
+            await self.file.write(chunk)
+            self.written += len(chunk)
+        except Exception as e:
+            logger.warning("Media cache write failed for %s: %s", self.key, e)
+            await self.abort()
+
+    async def commit(self):
+        if self.failed or self.file is None:
+            return await self.abort()
+        await self.file.close()
+        self.file = None
+        if self.written != self.meta['size']:
+            return await self.abort()
+        try:
+            await aiofiles.os.replace(self.tmp_path, self.media_cache.data_path(self.key))
+            await self.media_cache.add(self.key, self.meta)
+        except Exception as e:
+            logger.warning("Media cache commit failed for %s: %s", self.key, e)
+            await self.abort()
+
+    async def abort(self):
+        self.failed = True
+        if self.file is not None:
+            await self.file.close()
+            self.file = None
+        try:
+            await aiofiles.os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+class MediaDiskCache:
+    """LRU кэш медиа на диске с бюджетом по размеру.
+
+    Каждая запись - файл данных и JSON с заголовками; файлы публикуются через
+    os.replace, поэтому каталог можно разделять между воркерами. Порядок LRU
+    хранится в mtime файлов и пересчитывается периодическим rescan(): попадание
+    обновляет mtime (не чаще TOUCH_INTERVAL на файл), чтобы после перезапуска
+    вытеснялись давно не читавшиеся файлы, а не давно записанные.
+    """
+    TOUCH_INTERVAL = 60.0
+    # Ответ 206 на Range: bytes=0- (так запрашивает <video>) содержит объект целиком
+    FULL_CONTENT_RANGE = re.compile(r'^bytes 0-(\d+)/(\d+)$')
+
+    def __init__(self, directory: str, max_bytes: int, max_object_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes
+        self.index: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.total_bytes = 0
+        # Ключи, которые сейчас записываются этим воркером, и время начала записи
+        self.writing: Dict[str, float] = {}
+        # Когда этот воркер последний раз обновлял mtime файла
+        self.touched_at: Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def data_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def meta_path(self, key: str) -> str:
+        return self.data_path(key) + '.json'
+
+    def _load_entry(self, key: str, touch: bool = True) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.meta_path(key)) as f:
+                meta = json.load(f)
+            if os.path.getsize(self.data_path(key)) != meta['size']:
+                return None
+            if touch:
+                os.utime(self.data_path(key))
+            return meta
+        except (OSError, ValueError, KeyError):
+            return None
+
+    async def lookup(self, url: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """Путь к файлу и его заголовки, если URL уже есть в кэше"""
+        key = self.key_for(url)
+        meta = self.index.get(key)
+        if meta is not None:
+            if os.path.exists(self.data_path(key)):
+                self.index.move_to_end(key)
+                await self._touch(key)
+                self.hits += 1
+                MEDIA_CACHE_REQUESTS.labels(result="hit").inc()
+                return self.data_path(key), meta
+            self._forget(key)
+        else:
+            # Файл мог сохранить другой воркер
+            meta = await asyncio.to_thread(self._load_entry, key)
+            if meta is not None:
+                self._remember(key, meta)
+                self.touched_at[key] = time.monotonic()
+                self.hits += 1
+                MEDIA_CACHE_REQUESTS.labels(result="hit").inc()
+                return self.data_path(key), meta
+        self.misses += 1
+        MEDIA_CACHE_REQUESTS.labels(result="miss").inc()
+        return None
+
+    async def _touch(self, key: str):
+        """Обновляет mtime файла при попадании: по нему rescan() восстанавливает порядок LRU"""
+        now = time.monotonic()
+        if now - self.touched_at.get(key, 0.0) < self.TOUCH_INTERVAL:
+            return
+        self.touched_at[key] = now
+        try:
+            await asyncio.to_thread(os.utime, self.data_path(key))
+        except OSError:
+            pass
+
+    def writer_for(self, url: str, response: aiohttp.ClientResponse) -> Optional[MediaCacheWriter]:
+        """Writer для прогрева кэша, если ответ содержит объект целиком:
+        200 или 206 с Content-Range от нулевого до последнего байта"""
+        length = response.headers.get('Content-Length')
+        if not length or not length.isdigit():
+            return None
+        size = int(length)
+        if response.status == 206:
+            match = self.FULL_CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+            if match is None or int(match.group(1)) + 1 != size or int(match.group(2)) != size:
+                return None
+        elif response.status != 200:
+            return None
+        key = self.key_for(url)
+        if size == 0 or size > self.max_object_bytes:
+            return None
+        # Запись, начатая более часа назад, считается брошенной (поток не был прочитан)
+        started_at = self.writing.get(key)
+        if started_at is not None and time.monotonic() - started_at < 3600:
+            return None
+        meta = {
+            'size': size,
+            'content_type': response.headers.get('Content-Type'),
+            'ETag': response.headers.get('ETag'),
+            'Last-Modified': response.headers.get('Last-Modified')
+        }
+        self.writing[key] = time.monotonic()
+        return MediaCacheWriter(self, key, meta)
+
+    def _remember(self, key: str, meta: Dict[str, Any]):
+        if key in self.index:
+            self.total_bytes -= self.index[key]['size']
+        self.index[key] = meta
+        self.total_bytes += meta['size']
+        MEDIA_CACHE_SIZE.set(self.total_bytes)
+
+    def _forget(self, key: str) -> Optional[Dict[str, Any]]:
+        self.touched_at.pop(key, None)
+        meta = self.index.pop(key, None)
+        if meta is not None:
+            self.total_bytes -= meta['size']
+            MEDIA_CACHE_SIZE.set(self.total_bytes)
+        return meta
+
+    async def add(self, key: str, meta: Dict[str, Any]):
+        def write_meta():
+            tmp_path = f"{self.meta_path(key)}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, self.meta_path(key))
+
+        await asyncio.to_thread(write_meta)
+        self._remember(key, meta)
+        await self.evict()
+
+    async def evict(self):
+        victims = []
+        while self.total_bytes > self.max_bytes and self.index:
+            key = next(iter(self.index))
+            self._forget(key)
+            victims.append(key)
+        if victims:
+            MEDIA_CACHE_EVICTIONS.inc(len(victims))
+            await asyncio.to_thread(self._remove_files, victims)
+
+    def _remove_files(self, keys: list):
+        for key in keys:
+            for path in (self.meta_path(key), self.data_path(key)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _scan(self) -> list:
+        """Записи на диске в порядке LRU (по mtime); заодно удаляет брошенные .tmp"""
+        entries = []
+        stale_before = time.time() - 3600
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    try:
+                        if os.path.getmtime(path) < stale_before:
+                            os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                if name.endswith('.json'):
+                    continue
+                meta = self._load_entry(name, touch=False)
+                if meta is not None:
+                    entries.append((os.path.getmtime(path), name, meta))
+        entries.sort()
+        return entries
+
+    async def rescan(self):
+        """Синхронизирует индекс с диском (файлы других воркеров, удалённые файлы)"""
+        await aiofiles.os.makedirs(self.directory, exist_ok=True)
+        entries = await asyncio.to_thread(self._scan)
+        self.index.clear()
+        self.touched_at.clear()
+        self.total_bytes = 0
+        for _, key, meta in entries:
+            self._remember(key, meta)
+        await self.evict()
+
+    async def clear(self):
+        keys = list(self.index.keys())
+        self.index.clear()
+        self.touched_at.clear()
+        self.total_bytes = 0
+        MEDIA_CACHE_SIZE.set(0)
+        await asyncio.to_thread(self._remove_files, keys)
+
+    def contains(self, url: str) -> bool:
+        """Есть ли URL в кэше (без учёта в статистике попаданий)"""
+        key = self.key_for(url)
+        return key in self.index or os.path.exists(self.meta_path(key))
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": MEDIA_CACHE_ENABLED,
+            "files": len(self.index),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+        }
+
+# Глобальный дисковый кэш медиа
+media_cache = MediaDiskCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_MAX_OBJECT_BYTES)
+
+# Общий пул соединений к внешним API
+class UpstreamPool:
+    """aiohttp-сессия на время жизни приложения с keep-alive и DNS-кэшем.
+
+    Пулов два: "api" для коротких запросов к API провайдеров и "media" для
+    проксируемых потоков, чтобы зрители одного CDN не исчерпали соединения API.
+    """
+    def __init__(self, name: str, limit: int, limit_per_host: int, timeout: aiohttp.ClientTimeout):
+        self.name = name
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.connector: Optional[aiohttp.TCPConnector] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        """Трассировка выдачи соединений для метрик пула"""
+        trace_config = aiohttp.TraceConfig()
+        pool = self.name
+
+        async def on_queued_start(session, ctx, params):
+            ctx.queued_at = time.monotonic()
+
+        async def on_queued_end(session, ctx, params):
+            UPSTREAM_POOL_ACQUIRE_WAIT.labels(pool=pool).observe(time.monotonic() - ctx.queued_at)
+
+        async def on_create_end(session, ctx, params):
+            UPSTREAM_POOL_CONNECTIONS.labels(pool=pool, result="new").inc()
+
+        async def on_reuse(session, ctx, params):
+            UPSTREAM_POOL_CONNECTIONS.labels(pool=pool, result="reused").inc()
+
+        trace_config.on_connection_queued_start.append(on_queued_start)
+        trace_config.on_connection_queued_end.append(on_queued_end)
+        trace_config.on_connection_create_end.append(on_create_end)
+        trace_config.on_connection_reuseconn.append(on_reuse)
+        return trace_config
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Возвращает общую сессию, создавая её при первом обращении"""
+        if self.session is None or self.session.closed:
+            self.connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+                use_dns_cache=True,
+                ttl_dns_cache=UPSTREAM_DNS_CACHE_TTL,
+                enable_cleanup_closed=True
+            )
+            self.session = aiohttp.ClientSession(
+                connector=self.connector,
+                timeout=self.timeout,
+                headers=UPSTREAM_HEADERS,
+                trace_configs=[self._trace_config()]
+            )
+        return self.session
+
+    async def start(self):
+        self.get_session()
+        logger.info("Upstream %s pool started (limit=%s, per_host=%s)", self.name, self.limit, self.limit_per_host or "unlimited")
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.connector = None
+
+    def stats(self) -> Dict[str, int]:
+        """Текущее состояние пула: открытые, простаивающие и ожидающие соединения"""
+        connector = self.connector
+        if connector is None or connector.closed:
+            return {"open": 0, "idle": 0, "in_use": 0, "waiting": 0}
+        # Публичного API у TCPConnector для этого нет, а хуки TraceConfig не видят
+        # возврат соединения в пул; поэтому внутренние поля читаются осторожно,
+        # и если в другой версии aiohttp их нет, показатель просто равен 0
+        idle = self._count(connector, "_conns", nested=True)
+        in_use = self._count(connector, "_acquired")
+        waiting = self._count(connector, "_waiters", nested=True)
+        return {"open": idle + in_use, "idle": idle, "in_use": in_use, "waiting": waiting}
+
+    @staticmethod
+    def _count(connector: aiohttp.TCPConnector, attr: str, nested: bool = False) -> int:
+        """Размер внутренней коллекции коннектора (словарь списков при nested), 0 если её нет"""
+        value = getattr(connector, attr, None)
+        try:
+            if nested:
+                return sum(len(items) for items in value.values())
+            return len(value)
+        except (AttributeError, TypeError):
+            return 0
+
+# Глобальные пулы соединений: API провайдеров и HLS плейлисты / проксируемые медиа
+upstream_pool = UpstreamPool(
+    "api", UPSTREAM_POOL_LIMIT, UPSTREAM_POOL_LIMIT_PER_HOST,
+    aiohttp.ClientTimeout(total=UPSTREAM_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT)
+)
+# Для медиа ограничены только установка соединения (включая ожидание свободного) и пауза в чтении
+media_pool = UpstreamPool(
+    "media", MEDIA_POOL_LIMIT, MEDIA_POOL_LIMIT_PER_HOST,
+    aiohttp.ClientTimeout(total=None, connect=UPSTREAM_CONNECT_TIMEOUT, sock_read=UPSTREAM_STREAM_READ_TIMEOUT)
+)
+
+class AnicliOverloadedError(Exception):
+    """Очередь пула AnimeGo заполнена, вызов отклонён без ожидания"""
+
+class UpstreamUnavailableError(Exception):
+    """Источник не ответил: таймаут, сетевая ошибка или 5xx/429 (в отличие от честного 'не найдено')"""
+
+class MediaUnavailableError(UpstreamUnavailableError):
+    """Источник медиа не принял соединение вовремя (в том числе исчерпан пул соединений)"""
+
+class UpstreamThrottledError(UpstreamUnavailableError):
+    """Запрос отброшен собственным лимитом на хост ещё до отправки; источник не виноват"""
+
+# Исходящие лимиты на хосты провайдеров
+class TokenBucket:
+    """Token bucket с резервированием: токен можно занять наперёд, если ждать его не дольше max_wait"""
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """Сколько ждать выданного токена; None - ждать пришлось бы дольше max_wait"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        wait = max(0.0, (1 - self.tokens) / self.rate)
+        if wait > max_wait:
+            return None
+        self.tokens -= 1
+        return wait
+
+class UpstreamRateLimiter:
+    """Token bucket на хост. При доступном Redis ведро общее для воркеров (Lua-скрипт
+    с той же логикой), иначе - ведро воркера"""
+    RESERVE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local max_wait = tonumber(ARGV[4])
+local state = redis.call("hmget", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(state[1]) or burst
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local wait = math.max(0, (1 - tokens) / rate)
+if wait > max_wait then
+    return "-1"
+end
+redis.call("hset", KEYS[1], "tokens", tostring(tokens - 1), "updated_at", tostring(now))
+redis.call("expire", KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+    def __init__(self, limits: Dict[str, Tuple[float, ...]], max_wait: float):
+        self.limits = {host: (limit[0], limit[1] if len(limit) > 1 else max(1.0, limit[0])) for host, limit in limits.items()}
+        self.max_wait = max_wait
+        self.buckets: Dict[str, TokenBucket] = {}
+
+    def _limit_for(self, host: str) -> Optional[Tuple[str, float, float]]:
+        host = host.lower()
+        for name, (rate, burst) in self.limits.items():
+            if rate > 0 and (host == name or host.endswith('.' + name)):
+                return name, rate, burst
+        return None
+
+    async def _reserve(self, name: str, rate: float, burst: float) -> Optional[float]:
+        redis = cache.l2_client()
+        if redis is not None:
+            try:
+                wait = float(await redis.eval(
+                    self.RESERVE_SCRIPT, 1, f"{REDIS_KEY_PREFIX}bucket:{name}", rate, burst, time.time(), self.max_wait
+                ))
+                return None if wait < 0 else wait
+            except REDIS_CONNECTION_ERRORS as e:
+                cache.mark_down(e)
+            except Exception as e:
+                # Сбой скрипта не отключает L2 для всего кэша - лимит считает ведро воркера
+                logger.warning("Shared rate limit for %s failed, using worker bucket: %s", name, e)
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            bucket = self.buckets[name] = TokenBucket(rate, burst)
+        return bucket.reserve(self.max_wait)
+
+    async def acquire(self, host: Optional[str]):
+        """Ждёт токен для хоста или выбрасывает UpstreamThrottledError"""
+        limit = self._limit_for(host or "")
+        if limit is None:
+            return
+        name, rate, burst = limit
+        wait = await self._reserve(name, rate, burst)
+        if wait is None:
+            UPSTREAM_THROTTLED.labels(host=name, result="shed").inc()
+            raise UpstreamThrottledError(f"Outbound rate limit for {name} exceeded")
+        if wait > 0:
+            UPSTREAM_THROTTLED.labels(host=name, result="queued").inc()
+            UPSTREAM_THROTTLE_WAIT.labels(host=name).observe(wait)
+            await asyncio.sleep(wait)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            name: {"rate": rate, "burst": burst, "local_tokens": round(self.buckets[name].tokens, 2) if name in self.buckets else burst}
+            for name, (rate, burst) in self.limits.items()
+        }
+
+# Глобальные исходящие лимиты
+upstream_limiter = UpstreamRateLimiter(UPSTREAM_RATE_LIMITS, UPSTREAM_RATE_MAX_WAIT)
+
+# Выделенный пул потоков для синхронного клиента AnimeGo
+class AnicliExecutor:
+    """Выполняет блокирующие вызовы AnimeGo вне event loop с ограничением очереди и таймаутом"""
+    def __init__(self, max_workers: int, queue_limit: int, timeout: float):
+        self.max_workers = max_workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="anicli")
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.running = 0
+
+    def _client(self) -> AnimeGo:
+        """Клиент AnimeGo переиспользуется внутри своего потока"""
+        client = getattr(self.local, "client", None)
+        if client is None:
+            client = AnimeGo()
+            self.local.client = client
+        return client
+
+    def _update_gauges(self):
+        ANICLI_INFLIGHT.set(self.inflight)
+        ANICLI_QUEUE_DEPTH.set(self.inflight - self.running)
+
+    def _run(self, method: str, submitted_at: float, args: tuple):
+        started_at = time.monotonic()
+        ANICLI_QUEUE_WAIT.observe(started_at - submitted_at)
+        with self.lock:
+            self.running += 1
+            self._update_gauges()
+        status = "error"
+        try:
+            result = getattr(self._client(), method)(*args)
+            status = "ok" if result else "empty"
+            return result
+        finally:
+            ANICLI_CALL_DURATION.labels(method=method, status=status).observe(time.monotonic() - started_at)
+            with self.lock:
+                self.running -= 1
+                self.inflight -= 1
+                self._update_gauges()
+
+    async def call(self, method: str, *args) -> Any:
+        """Вызывает метод AnimeGo в пуле потоков, не блокируя event loop"""
+        await upstream_limiter.acquire("animego")
+        with self.lock:
+            depth = self.inflight - self.running
+            if self.inflight >= self.max_workers + self.queue_limit:
+                ANICLI_REJECTED.labels(reason="queue_full").inc()
+                raise AnicliOverloadedError(f"AnimeGo executor queue is full ({depth} waiting)")
+            self.inflight += 1
+            self._update_gauges()
+        ANICLI_QUEUE_DEPTH_OBSERVED.observe(depth)
+
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self._run, method, time.monotonic(), args
+        )
+        try:
+            # shield: по таймауту поток не прерывается, слот освобождается после его завершения
+            return await asyncio.wait_for(asyncio.shield(future), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            ANICLI_REJECTED.labels(reason="timeout").inc()
+            # Результат брошенного вызова забираем, чтобы asyncio не ругался на неполученное исключение
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            raise
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "workers": self.max_workers,
+                "running": self.running,
+                "queued": self.inflight - self.running,
+                "queue_limit": self.queue_limit
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# Глобальный пул AnimeGo
+anicli_executor = AnicliExecutor(ANICLI_EXECUTOR_WORKERS, ANICLI_QUEUE_LIMIT, ANICLI_CALL_TIMEOUT)
+
+# Circuit breaker и EWMA-оценка каждого источника
+BREAKER_STATE_CODES = {"closed": 0, "half_open": 1, "open": 2}
+
+class CircuitBreaker:
+    """Состояние одного источника: closed -> open при доле ошибок в окне, open -> half_open
+    по истечении BREAKER_OPEN_SECONDS, half_open -> closed/open по результату пробных вызовов"""
+
+    def __init__(self, scope: str, name: str):
+        self.scope = scope
+        self.name = name
+        self.state = "closed"
+        self.outcomes: deque = deque(maxlen=BREAKER_WINDOW_SIZE)
+        self.opened_at = 0.0
+        self.probes = 0
+        self.ewma_latency: Optional[float] = None
+        self.ewma_success: Optional[float] = None
+        PROVIDER_BREAKER_STATE.labels(scope=scope, provider=name).set(0)
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        logger.warning("Circuit breaker %s/%s: %s -> %s", self.scope, self.name, self.state, state)
+        self.state = state
+        if state == "open":
+            self.opened_at = time.monotonic()
+        if state != "half_open":
+            self.probes = 0
+        if state == "closed":
+            self.outcomes.clear()
+        BREAKER_TRANSITIONS.labels(scope=self.scope, provider=self.name, state=state).inc()
+        PROVIDER_BREAKER_STATE.labels(scope=self.scope, provider=self.name).set(BREAKER_STATE_CODES[state])
+
+    def acquire(self) -> bool:
+        """Можно ли вызвать источник сейчас; в half_open занимает слот пробного вызова"""
+        if not BREAKER_ENABLED:
+            return True
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < BREAKER_OPEN_SECONDS:
+                BREAKER_REJECTED.labels(scope=self.scope, provider=self.name).inc()
+                return False
+            self._transition("half_open")
+        if self.state == "half_open":
+            if self.probes >= BREAKER_HALF_OPEN_PROBES:
+                BREAKER_REJECTED.labels(scope=self.scope, provider=self.name).inc()
+                return False
+            self.probes += 1
+        return True
+
+    def release(self):
+        """Вызов отменён, не дойдя до результата - освобождаем слот пробного вызова"""
+        if self.state == "half_open":
+            self.probes = max(0, self.probes - 1)
+
+    def record(self, failed: bool, latency: float):
+        """Итог вызова: failed - ошибка или таймаут. Ответ "не найдено" - успех:
+        источник исправен, просто у него нет этого эпизода"""
+        alpha = PROVIDER_EWMA_ALPHA
+        success = 0.0 if failed else 1.0
+        if self.ewma_latency is None:
+            self.ewma_latency, self.ewma_success = latency, success
+        else:
+            self.ewma_latency += alpha * (latency - self.ewma_latency)
+            self.ewma_success += alpha * (success - self.ewma_success)
+        PROVIDER_EWMA_LATENCY.labels(scope=self.scope, provider=self.name).set(self.ewma_latency)
+        PROVIDER_EWMA_SUCCESS.labels(scope=self.scope, provider=self.name).set(self.ewma_success)
+
+        if not BREAKER_ENABLED:
+            return
+        failed = failed or latency > BREAKER_SLOW_CALL_SECONDS
+        if self.state == "half_open":
+            self.probes = max(0, self.probes - 1)
+            self._transition("open" if failed else "closed")
+            return
+        self.outcomes.append(failed)
+        if self.state == "closed" and len(self.outcomes) >= BREAKER_MIN_CALLS:
+            if sum(self.outcomes) / len(self.outcomes) >= BREAKER_ERROR_RATE:
+                self._transition("open")
+
+    def score(self) -> Optional[float]:
+        """Ожидаемая цена вызова: EWMA задержки, делённая на EWMA доли успехов; None - данных нет"""
+        if self.ewma_latency is None:
+            return None
+        return self.ewma_latency / max(self.ewma_success, 0.05)
+
+    def stats(self) -> Dict[str, Any]:
+        retry_in = None
+        if self.state == "open":
+            retry_in = round(max(0.0, BREAKER_OPEN_SECONDS - (time.monotonic() - self.opened_at)), 2)
+        return {
+            "state": self.state,
+            "window_calls": len(self.outcomes),
+            "window_error_rate": round(sum(self.outcomes) / len(self.outcomes), 3) if self.outcomes else 0.0,
+            "retry_in_seconds": retry_in,
+            "ewma_latency_seconds": round(self.ewma_latency, 4) if self.ewma_latency is not None else None,
+            "ewma_success": round(self.ewma_success, 3) if self.ewma_success is not None else None,
+            "score": round(self.score(), 4) if self.score() is not None else None
+        }
+
+class ProviderHealth:
+    """Реестр circuit breaker'ов по (область, источник) и адаптивный порядок опроса"""
+
+    def __init__(self):
+        self.breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+
+    def breaker(self, scope: str, name: str) -> CircuitBreaker:
+        key = (scope, name)
+        if key not in self.breakers:
+            self.breakers[key] = CircuitBreaker(scope, name)
+        return self.breakers[key]
+
+    def order(self, scope: str, attempts: List[Tuple[str, Callable[[], Awaitable[Any]]]]) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+        """Проверенные источники по возрастанию цены, затем непроверенные; при равенстве - исходный приоритет"""
+        if not ADAPTIVE_ORDERING:
+            return list(attempts)
+
+        def key(item):
+            index, (name, _) = item
+            score = self.breaker(scope, name).score()
+            return (score is None, score or 0.0, index)
+
+        return [attempt for _, attempt in sorted(enumerate(attempts), key=key)]
+
+    def degraded(self, scope: str) -> bool:
+        """Не меньше половины известных источников области с открытым или полуоткрытым breaker"""
+        states = [breaker.state for (breaker_scope, _), breaker in self.breakers.items() if breaker_scope == scope]
+        return bool(states) and 2 * sum(state != "closed" for state in states) >= len(states)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        result: Dict[str, Dict[str, Any]] = {}
+        for (scope, name), breaker in self.breakers.items():
+            result.setdefault(scope, {})[name] = breaker.stats()
+        return result
+
+# Глобальный реестр состояния источников
+provider_health = ProviderHealth()
+
+# Опрос нескольких источников со стратегиями sequential / hedged / race
+async def first_successful(
+    attempts: List[Tuple[str, Callable[[], Awaitable[Any]]]],
+    scope: str,
+    strategy: str,
+    hedge_delay: float,
+    timeouts: Dict[str, float],
+    budget: float,
+    breaker_scope: Optional[str] = None
+) -> Tuple[Optional[str], Any]:
+    """Возвращает (имя, результат) первой попытки с непустым результатом.
+
+    Каждая попытка ограничена своим таймаутом, все вместе - общим бюджетом.
+    Исключение или пустой результат попытки сразу запускает следующую.
+    С breaker_scope источники опрашиваются в адаптивном порядке, источники
+    с открытым circuit breaker пропускаются; если ни один источник не ответил
+    из-за ошибок, выбрасывается UpstreamUnavailableError.
+    """
+    started_at = time.monotonic()
+    deadline = started_at + budget
+    pending: Dict[asyncio.Task, Tuple[str, float]] = {}
+    next_index = 0
+    failures = 0
+    throttled = 0
+    answered = False  # хотя бы один источник ответил, пусть и пустым результатом
+    if breaker_scope:
+        attempts = provider_health.order(breaker_scope, attempts)
+
+    async def run(name: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        # Спан попытки - родитель спанов внутри неё (кэш, запрос к базовому URL)
+        with tracer.span(f"{scope}.{name}", timing=f"{scope}.{name}", scope=scope, provider=name) as span:
+            result = await asyncio.wait_for(factory(), timeout=timeouts.get(name, budget))
+            if span is not None:
+                span.set(outcome="ok" if result else "empty")
+            return result
+
+    def launch() -> bool:
+        """Запускает следующую попытку, пропуская источники с открытым breaker"""
+        nonlocal next_index
+        while next_index < len(attempts):
+            name, factory = attempts[next_index]
+            next_index += 1
+            if breaker_scope and not provider_health.breaker(breaker_scope, name).acquire():
+                log_request_event("%s: skipping %s, circuit breaker is open", scope, name)
+                continue
+            pending[asyncio.create_task(run(name, factory))] = (name, time.monotonic())
+            return True
+        return False
+
+    try:
+        launch()
+        if strategy == "race":
+            while launch():
+                pass
+
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning("%s: resolution budget of %ss exhausted", scope, budget)
+                break
+            wait_timeout = remaining
+            if strategy == "hedged" and next_index < len(attempts):
+                wait_timeout = min(remaining, hedge_delay)
+            done, _ = await asyncio.wait(pending, timeout=wait_timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                if strategy == "hedged" and launch():
+                    HEDGES_LAUNCHED.labels(scope=scope).inc()
+                continue
+
+            for task in done:
+                name, attempt_started_at = pending.pop(task)
+                now = time.monotonic()
+                try:
+                    result = task.result()
+                    outcome = "ok" if result else "empty"
+                except asyncio.TimeoutError:
+                    result, outcome = None, "timeout"
+                    logger.warning("%s: %s timed out", scope, name)
+                except UpstreamThrottledError as e:
+                    result, outcome = None, "throttled"
+                    logger.warning("%s: %s throttled: %s", scope, name, e)
+                except Exception as e:
+                    result, outcome = None, "error"
+                    logger.warning("%s: %s failed: %s", scope, name, e)
+                PROVIDER_ATTEMPTS.labels(scope=scope, provider=name, result=outcome).observe(now - attempt_started_at)
+                if outcome in ("timeout", "error", "throttled"):
+                    failures += 1
+                    throttled += outcome == "throttled"
+                else:
+                    answered = True
+                if breaker_scope and outcome == "throttled":
+                    # Собственный лимит - не ошибка источника, breaker его не учитывает
+                    provider_health.breaker(breaker_scope, name).release()
+                elif breaker_scope:
+                    provider_health.breaker(breaker_scope, name).record(
+                        failed=outcome in ("timeout", "error"), latency=now - attempt_started_at
+                    )
+                if result:
+                    PROVIDER_WINS.labels(scope=scope, provider=name).inc()
+                    # Более ранние попытки ещё идут: последовательно победитель стартовал бы не раньше,
+                    # чем сейчас, и занял бы не меньше собственного времени
+                    if any(other_started < attempt_started_at for _, other_started in pending.values()):
+                        HEDGE_TIME_SAVED.labels(scope=scope).observe(now - attempt_started_at)
+                    return name, result
+
+            # Неудача - сразу пробуем следующий источник, не дожидаясь задержки хеджирования
+            if strategy != "race":
+                launch()
+
+        if breaker_scope and not answered:
+            if failures and throttled == failures:
+                raise UpstreamThrottledError(f"{scope}: all providers throttled")
+            raise UpstreamUnavailableError(f"{scope}: no provider answered ({failures} failed)")
+        return None, None
+    finally:
+        now = time.monotonic()
+        for task, (name, attempt_started_at) in pending.items():
+            task.cancel()
+            if breaker_scope:
+                breaker = provider_health.breaker(breaker_scope, name)
+                # Отменённая попытка, которая уже дольше порога медленных вызовов, считается медленной
+                if now - attempt_started_at > BREAKER_SLOW_CALL_SECONDS:
+                    breaker.record(failed=True, latency=now - attempt_started_at)
+                else:
+                    breaker.release()
+
+# Разбор эпизодов релиза: все карты качеств за один проход
+QUALITY_KEYS = ('fhd', 'hd', 'sd')
+
+def _episode_number(value: Any) -> Optional[str]:
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value) if value is not None else None
+
+def extract_episode_qualities(release: dict) -> Dict[str, Dict[str, Optional[str]]]:
+    """Карта 'номер эпизода' -> {fhd, hd, sd} из player.list и episodes релиза"""
+    episodes: Dict[str, Dict[str, Optional[str]]] = {}
+    player_list = (release.get('player') or {}).get('list') or {}
+    if isinstance(player_list, list):
+        player_list = {_episode_number(item.get('episode')): item for item in player_list if isinstance(item, dict)}
+    for number, episode_data in player_list.items():
+        hls = (episode_data or {}).get('hls') or {}
+        if number is not None and any(hls.get(quality) for quality in QUALITY_KEYS):
+            episodes[str(number)] = {quality: hls.get(quality) for quality in QUALITY_KEYS}
+
+    for episode_data in release.get('episodes') or []:
+        number = _episode_number(episode_data.get('ordinal'))
+        if number is None or number in episodes:
+            continue
+        hls = (episode_data.get('player') or {}).get('hls') or {
+            'fhd': episode_data.get('hls_1080'),
+            'hd': episode_data.get('hls_720'),
+            'sd': episode_data.get('hls_480')
+        }
+        if any(hls.get(quality) for quality in QUALITY_KEYS):
+            episodes[number] = {quality: hls.get(quality) for quality in QUALITY_KEYS}
+    return episodes
+
+def best_video_url(qualities: Dict[str, Optional[str]], cdn_url: str) -> Optional[str]:
+    """Ссылка на лучшее доступное качество; относительные пути - от CDN"""
+    for quality in QUALITY_KEYS:
+        path = qualities.get(quality)
+        if path:
+            return path if path.startswith(('http://', 'https://')) else f"{cdn_url}{path}"
+    return None
+
+def _subtitle_tracks(episode_data: dict) -> List[Dict[str, Optional[str]]]:
+    tracks = []
+    for track in episode_data.get('subtitles') or []:
+        if isinstance(track, str):
+            track = {'url': track}
+        if isinstance(track, dict) and (track.get('url') or track.get('src')):
+            tracks.append({
+                'language': track.get('language') or track.get('lang') or 'ru',
+                'url': track.get('url') or track.get('src'),
+                'format': track.get('format') or posixpath.splitext(urlsplit(track.get('url') or track.get('src')).path)[1].lstrip('.') or None
+            })
+    return tracks
+
+def extract_release_meta(release: dict) -> Dict[str, Any]:
+    """Озвучившие релиз (members Aniliberty или team старого API) и субтитры эпизодов, если они есть"""
+    voice_actors: List[str] = []
+    for member in release.get('members') or []:
+        role = member.get('role') or {}
+        role = role.get('value') if isinstance(role, dict) else role
+        if role == 'voicing' and member.get('nickname'):
+            voice_actors.append(member['nickname'])
+    voice_actors.extend(name for name in (release.get('team') or {}).get('voice') or [] if isinstance(name, str))
+
+    subtitles: Dict[str, List[Dict[str, Optional[str]]]] = {}
+    player_list = (release.get('player') or {}).get('list') or {}
+    if isinstance(player_list, dict):
+        player_list = [dict(item or {}, episode=item.get('episode', number)) for number, item in player_list.items()]
+    for episode_data in list(player_list) + list(release.get('episodes') or []):
+        if not isinstance(episode_data, dict):
+            continue
+        number = _episode_number(episode_data.get('episode', episode_data.get('ordinal')))
+        tracks = _subtitle_tracks(episode_data)
+        if number is not None and tracks and number not in subtitles:
+            subtitles[number] = tracks
+    return {"voice_actors": voice_actors, "subtitles": subtitles}
 
 # Новый Aniliberty API клиент
 class AnilibertyAPI:
     def __init__(self):
-        self.base_urls = [
-            "https://aniliberty.top/api/v1",
-            "https://api.anilibria.app/api/v1"
-        ]
+        self.base_urls = list(ANILIBERTY_API_URLS)
         self.current_base_url = self.base_urls[0]
     
-    async def _make_request(self, endpoint: str, method: str = "GET", data: dict = None) -> Optional[dict]:
-        """Выполняет HTTP запрос к API с fallback на альтернативный URL"""
-        for base_url in self.base_urls:
-            try:
-                url = f"{base_url}{endpoint}"
-                logger.info(f"Making {method} request to Aniliberty API: {url}")
-                
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-                    if method == "POST":
-                        async with session.post(url, json=data, headers={
-                            'Content-Type': 'application/json',
-                            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                        }) as response:
-                            ANILIBERTY_REQUESTS.labels(endpoint=endpoint, status=str(response.status)).inc()
-                            if response.status == 200:
-                                result = await response.json()
-                                logger.info(f"Aniliberty API request successful: {endpoint}")
-                                return result
-                            else:
-                                logger.warning(f"Aniliberty API returned status {response.status} for {endpoint}")
-                    else:
-                        async with session.get(url, headers={
-                            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                        }) as response:
-                            ANILIBERTY_REQUESTS.labels(endpoint=endpoint, status=str(response.status)).inc()
-                            if response.status == 200:
-                                result = await response.json()
-                                logger.info(f"Aniliberty API request successful: {endpoint}")
-                                return result
-                            else:
-                                logger.warning(f"Aniliberty API returned status {response.status} for {endpoint}")
-            except asyncio.TimeoutError:
-                logger.warning(f"Aniliberty API request timeout for {base_url}{endpoint}")
-                ERROR_COUNT.labels(error_type="aniliberty_timeout").inc()
-            except Exception as e:
-                logger.warning(f"Aniliberty API request failed for {base_url}{endpoint}: {e}")
-                ERROR_COUNT.labels(error_type="aniliberty_request_error").inc()
-                continue
-        
-        logger.error(f"All Aniliberty API endpoints failed for {endpoint}")
+    async def _request_base_url(self, base_url: str, endpoint: str, method: str, data: Optional[dict]) -> Optional[dict]:
+        """Один запрос к одному базовому URL; None при статусе 4xx.
+
+        Таймаут, сетевая ошибка и 5xx/429 выбрасывают UpstreamUnavailableError,
+        чтобы circuit breaker базового URL их учёл.
+        """
+        await upstream_limiter.acquire(urlsplit(base_url).hostname)
+        try:
+            url = f"{base_url}{endpoint}"
+            log_request_event("Making %s request to Aniliberty API: %s", method, url)
+            
+            session = upstream_pool.get_session()
+            # Спан попытки базового URL создан в first_successful; здесь дополняем его деталями запроса
+            span = current_span_var.get()
+            async with session.request(method, url, json=data if method == "POST" else None) as response:
+                ANILIBERTY_REQUESTS.labels(endpoint=endpoint_label(endpoint), status=str(response.status)).inc()
+                if span is not None:
+                    span.set(**{"http.method": method, "http.url": url, "http.status_code": response.status})
+                if response.status == 200:
+                    result = await response.json()
+                    log_request_event("Aniliberty API request successful: %s", endpoint)
+                    return result
+                logger.warning("Aniliberty API returned status %s for %s", response.status, endpoint)
+                if response.status >= 500 or response.status == 429:
+                    raise UpstreamUnavailableError(f"{base_url} returned status {response.status}")
+        except UpstreamUnavailableError:
+            raise
+        except asyncio.TimeoutError:
+            logger.warning("Aniliberty API request timeout for %s%s", base_url, endpoint)
+            ERROR_COUNT.labels(error_type="aniliberty_timeout").inc()
+            raise UpstreamUnavailableError(f"{base_url} timed out")
+        except Exception as e:
+            logger.warning("Aniliberty API request failed for %s%s: %s", base_url, endpoint, e)
+            ERROR_COUNT.labels(error_type="aniliberty_request_error").inc()
+            raise UpstreamUnavailableError(f"{base_url} request failed: {e}")
         return None
     
+    async def _make_request(self, endpoint: str, method: str = "GET", data: dict = None) -> Optional[dict]:
+        """Выполняет HTTP запрос к API с fallback на альтернативный URL.
+
+        При медленном основном URL запрос к запасному стартует через UPSTREAM_HEDGE_DELAY
+        (стратегия RESOLVE_STRATEGY), а не после полного таймаута. URL с открытым
+        circuit breaker пропускается сразу; если не ответил ни один URL -
+        UpstreamUnavailableError.
+        """
+        attempts = [
+            (urlsplit(base_url).hostname or base_url,
+             lambda base_url=base_url: self._request_base_url(base_url, endpoint, method, data))
+            for base_url in self.base_urls
+        ]
+        try:
+            _, result = await first_successful(
+                attempts,
+                scope="aniliberty_base_url",
+                strategy=RESOLVE_STRATEGY,
+                hedge_delay=UPSTREAM_HEDGE_DELAY,
+                timeouts={},
+                budget=UPSTREAM_TIMEOUT * len(attempts),
+                breaker_scope="aniliberty_base_url"
+            )
+        except UpstreamUnavailableError:
+            logger.error("All Aniliberty API endpoints failed for %s", endpoint)
+            raise
+        return result
+    
+    # Поля релиза, нужные для поиска эпизодов - без них ответ в разы больше
+    RELEASE_FIELDS = "id,names,player,episodes,members"
+
+    async def index_releases(self, releases: list):
+        """Кладёт релизы из ответа каталога в индекс ID -> релиз"""
+        for release in releases:
+            if isinstance(release, dict) and isinstance(release.get('id'), int):
+                await cache.set(f"release_{release['id']}", release)
+
+    async def get_release(self, anime_id: int) -> Optional[dict]:
+        """Релиз по ID: индекс в кэше, затем прямой запрос, затем поиск по каталогу"""
+        cache_key = f"release_{anime_id}"
+        release = await cache.get(cache_key)
+        if release:
+            RELEASE_LOOKUPS.labels(source="cache").inc()
+            return release
+
+        release = await self._make_request(f"/anime/releases/{anime_id}?include={self.RELEASE_FIELDS}")
+        if release and release.get('id') == anime_id:
+            await cache.set(cache_key, release)
+            RELEASE_LOOKUPS.labels(source="direct").inc()
+            return release
+
+        release = await self.search_anime_by_id(anime_id)
+        RELEASE_LOOKUPS.labels(source="search" if release else "miss").inc()
+        return release
+
     async def search_anime_by_id(self, anime_id: int) -> Optional[dict]:
-        """Поиск аниме по ID через каталог"""
+        """Поиск аниме по ID через каталог (запасной путь, если прямой запрос не сработал)"""
         try:
             # Используем POST запрос для поиска с фильтрами
             search_data = {
@@ -141,95 +2244,83 @@ class AnilibertyAPI:
                 "f": {
                     "search": str(anime_id)  # Попробуем поиск по ID как строке
                 },
-                "include": "id,names,player,episodes"
+                "include": self.RELEASE_FIELDS
             }
             
             result = await self._make_request("/anime/catalog/releases", "POST", search_data)
             if result and 'data' in result and result['data']:
-                # Ищем точное совпадение по ID
+                # Все найденные релизы пригодятся для следующих запросов по ID
+                await self.index_releases(result['data'])
+                # Возвращаем только точное совпадение по ID: первый результат поиска
+                # по строке с числом почти всегда другой релиз
                 for anime in result['data']:
                     if anime.get('id') == anime_id:
                         return anime
-                # Если точного совпадения нет, возвращаем первый результат
-                return result['data'][0]
             return None
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
-            logger.error(f"Aniliberty search anime by ID error: {e}")
+            logger.error("Aniliberty search anime by ID error: %s", e)
             return None
     
+    async def get_episode_map(self, anime_id: int) -> Dict[str, Dict[str, Optional[str]]]:
+        """Карты качеств всех эпизодов релиза; общий кэш для /video, /qualities и пакетных запросов"""
+        cache_key = f"episodes_aniliberty_{anime_id}"
+        episodes = await cache.get(cache_key)
+        if episodes is not None:
+            return episodes
+
+        async def load() -> Dict[str, Dict[str, Optional[str]]]:
+            anime_data = await self.get_release(anime_id)
+            if not anime_data:
+                return {}
+            episodes = extract_episode_qualities(anime_data)
+            if episodes:
+                await cache.set(cache_key, episodes)
+            return episodes
+
+        # Одновременные запросы эпизодов одного релиза ждут одну загрузку
+        return await single_flight.do(cache_key, load)
+
+    async def get_feed_release_ids(self, latest_limit: int) -> List[int]:
+        """ID свежих релизов (лента последних и расписание на вчера/сегодня); релизы ленты попадают в индекс"""
+        ids: List[int] = []
+        latest = await self._make_request(f"/anime/releases/latest?limit={latest_limit}&include={self.RELEASE_FIELDS}")
+        if isinstance(latest, dict):
+            latest = latest.get('data')
+        if isinstance(latest, list):
+            await self.index_releases(latest)
+            ids.extend(release['id'] for release in latest if isinstance(release, dict) and isinstance(release.get('id'), int))
+
+        schedule = await self._make_request("/anime/schedule/now")
+        if isinstance(schedule, dict):
+            for day in ('today', 'yesterday'):
+                for item in schedule.get(day) or []:
+                    release = item.get('release') if isinstance(item, dict) else None
+                    if isinstance(release, dict) and isinstance(release.get('id'), int):
+                        ids.append(release['id'])
+        return list(dict.fromkeys(ids))
+
+    async def get_release_meta(self, anime_id: int) -> Dict[str, Any]:
+        """Озвучка и субтитры из того же релиза, что и карта эпизодов"""
+        release = await self.get_release(anime_id)
+        return extract_release_meta(release) if release else {}
+
     async def get_episode_video(self, anime_id: int, episode: int) -> Optional[str]:
         """Получение ссылки на видео эпизода"""
-        try:
-            # Сначала найдем аниме
-            anime_data = await self.search_anime_by_id(anime_id)
-            if not anime_data:
-                return None
-            
-            # Ищем эпизод в данных аниме
-            if 'player' in anime_data and 'list' in anime_data['player']:
-                episodes = anime_data['player']['list']
-                episode_key = str(episode)
-                
-                if episode_key in episodes:
-                    episode_data = episodes[episode_key]
-                    if 'hls' in episode_data:
-                        # Возвращаем лучшее качество
-                        hls_data = episode_data['hls']
-                        if 'fhd' in hls_data and hls_data['fhd']:
-                            return f"https://cache.libria.fun{hls_data['fhd']}"
-                        elif 'hd' in hls_data and hls_data['hd']:
-                            return f"https://cache.libria.fun{hls_data['hd']}"
-                        elif 'sd' in hls_data and hls_data['sd']:
-                            return f"https://cache.libria.fun{hls_data['sd']}"
-            
-            # Альтернативный способ - через episodes API
-            if 'episodes' in anime_data:
-                for ep in anime_data['episodes']:
-                    if ep.get('ordinal') == episode:
-                        episode_id = ep.get('id')
-                        if episode_id:
-                            episode_details = await self._make_request(f"/anime/releases/episodes/{episode_id}")
-                            if episode_details and 'player' in episode_details:
-                                player_data = episode_details['player']
-                                if 'hls' in player_data:
-                                    hls_data = player_data['hls']
-                                    if 'fhd' in hls_data and hls_data['fhd']:
-                                        return f"https://cache.libria.fun{hls_data['fhd']}"
-                                    elif 'hd' in hls_data and hls_data['hd']:
-                                        return f"https://cache.libria.fun{hls_data['hd']}"
-                                    elif 'sd' in hls_data and hls_data['sd']:
-                                        return f"https://cache.libria.fun{hls_data['sd']}"
-            
-            return None
-        except Exception as e:
-            logger.error(f"Aniliberty get episode video error: {e}")
-            return None
+        qualities = await self.get_episode_qualities(anime_id, episode)
+        return best_video_url(qualities, ANILIBERTY_CDN_URL) if qualities else None
     
     async def get_episode_qualities(self, anime_id: int, episode: int) -> Optional[Dict]:
         """Получение доступных качеств видео для эпизода"""
         try:
-            # Сначала найдем аниме
-            anime_data = await self.search_anime_by_id(anime_id)
-            if not anime_data:
-                return None
-            
-            # Ищем эпизод в данных аниме
-            if 'player' in anime_data and 'list' in anime_data['player']:
-                episodes = anime_data['player']['list']
-                episode_key = str(episode)
-                
-                if episode_key in episodes:
-                    episode_data = episodes[episode_key]
-                    if 'hls' in episode_data:
-                        hls_data = episode_data['hls']
-                        return {
-                            "fhd": hls_data.get('fhd'),
-                            "hd": hls_data.get('hd'),
-                            "sd": hls_data.get('sd')
-                        }
+            episodes = await self.get_episode_map(anime_id)
+            if str(episode) in episodes:
+                return episodes[str(episode)]
             
-            # Альтернативный способ - через episodes API
-            if 'episodes' in anime_data:
+            # Альтернативный способ - через episodes API, если в релизе нет ссылок на эпизод
+            anime_data = await self.get_release(anime_id)
+            if anime_data and 'episodes' in anime_data:
                 for ep in anime_data['episodes']:
                     if ep.get('ordinal') == episode:
                         episode_id = ep.get('id')
@@ -246,56 +2337,1030 @@ class AnilibertyAPI:
                                     }
             
             return None
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
-            logger.error(f"Aniliberty get episode qualities error: {e}")
+            logger.error("Aniliberty get episode qualities error: %s", e)
             return None
 
 # Fallback Anilibria API клиент (старый)
 class AnilibriaFallback:
+    # Поля тайтла, нужные для эпизодов, озвучки и субтитров
+    TITLE_FIELDS = "id,player,team"
+
     def __init__(self):
-        self.base_url = "https://api.anilibria.tv/v3"
+        self.base_url = ANILIBRIA_API_URL
+
+    async def get_title(self, anime_id: int) -> Optional[dict]:
+        """Тайтл старого API (только TITLE_FIELDS), общий для карты эпизодов и метаданных"""
+        cache_key = f"release_anilibria_{anime_id}"
+        title = await cache.get(cache_key)
+        if title is not None:
+            return title
+
+        async def load() -> Optional[dict]:
+            await upstream_limiter.acquire(urlsplit(self.base_url).hostname)
+            session = upstream_pool.get_session()
+            # Получаем информацию об аниме
+            try:
+                async with session.get(f"{self.base_url}/title", params={"id": anime_id, "filter": self.TITLE_FIELDS}) as response:
+                    if response.status >= 500 or response.status == 429:
+                        raise UpstreamUnavailableError(f"Anilibria returned status {response.status}")
+                    if response.status != 200:
+                        return None
+                    data = await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise UpstreamUnavailableError(f"Anilibria request failed: {e!r}")
+            if data:
+                await cache.set(cache_key, data)
+            return data
+
+        return await single_flight.do(cache_key, load)
+
+    async def get_episode_map(self, anime_id: int) -> Dict[str, Dict[str, Optional[str]]]:
+        """Карты качеств всех эпизодов тайтла за один запрос /title"""
+        cache_key = f"episodes_anilibria_{anime_id}"
+        episodes = await cache.get(cache_key)
+        if episodes is not None:
+            return episodes
+
+        title = await self.get_title(anime_id)
+        episodes = extract_episode_qualities(title) if title else {}
+        if episodes:
+            await cache.set(cache_key, episodes)
+        return episodes
+
+    async def get_release_meta(self, anime_id: int) -> Dict[str, Any]:
+        title = await self.get_title(anime_id)
+        return extract_release_meta(title) if title else {}
     
     async def get_episode_video(self, anime_id: int, episode: int) -> Optional[str]:
-        try:
-            async with aiohttp.ClientSession() as session:
-                # Получаем информацию об аниме
-                async with session.get(f"{self.base_url}/title?id={anime_id}") as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if 'player' in data and 'list' in data['player']:
-                            episodes = data['player']['list']
-                            if str(episode) in episodes:
-                                episode_data = episodes[str(episode)]
-                                if 'hls' in episode_data:
-                                    return f"https://cache.libria.fun{episode_data['hls']['fhd']}"
-        except Exception as e:
-            logger.error(f"Anilibria fallback error: {e}")
-        return None
+        qualities = await self.get_episode_qualities(anime_id, episode)
+        return best_video_url(qualities, ANILIBRIA_CDN_URL) if qualities else None
     
     async def get_episode_qualities(self, anime_id: int, episode: int) -> Optional[Dict]:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.base_url}/title?id={anime_id}") as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if 'player' in data and 'list' in data['player']:
-                            episodes = data['player']['list']
-                            if str(episode) in episodes:
-                                episode_data = episodes[str(episode)]
-                                if 'hls' in episode_data:
-                                    return {
-                                        "fhd": episode_data['hls'].get('fhd'),
-                                        "hd": episode_data['hls'].get('hd'),
-                                        "sd": episode_data['hls'].get('sd')
-                                    }
+            episodes = await self.get_episode_map(anime_id)
+            return episodes.get(str(episode))
+        except UpstreamUnavailableError:
+            raise
         except Exception as e:
-            logger.error(f"Anilibria fallback qualities error: {e}")
+            logger.error("Anilibria fallback qualities error: %s", e)
         return None
 
 # Инициализация API клиентов
 aniliberty_api = AnilibertyAPI()
 anilibria_fallback = AnilibriaFallback()
 
+# Резолв ссылок через провайдеров с fallback: AnimeGo -> Aniliberty -> Anilibria (старый)
+async def cached_release_qualities(anime_id: int, episode: int) -> Optional[Tuple[Dict, str]]:
+    """Качества эпизода из уже разобранного релиза Aniliberty или Anilibria и CDN источника.
+
+    Релиз разбирается целиком, поэтому /qualities и /video любого его эпизода
+    обслуживаются без обращения к провайдерам.
+    """
+    for source, cdn_url in (("aniliberty", ANILIBERTY_CDN_URL), ("anilibria", ANILIBRIA_CDN_URL)):
+        episodes = await cache.get(f"episodes_{source}_{anime_id}")
+        if episodes and episodes.get(str(episode)):
+            return episodes[str(episode)], cdn_url
+    return None
+
+def provider_attempts(kind: str, anime_id: int, episode: int) -> List[Tuple[str, Callable[[], Awaitable[Any]]]]:
+    """Попытки провайдеров в порядке приоритета: AnimeGo -> Aniliberty -> Anilibria (старый), только из RESOLVE_PROVIDERS"""
+    if kind == "video":
+        attempts = [
+            ("anicli", lambda: anicli_executor.call("get_episode_video", anime_id, episode)),
+            ("aniliberty", lambda: aniliberty_api.get_episode_video(anime_id, episode)),
+            ("anilibria_old", lambda: anilibria_fallback.get_episode_video(anime_id, episode))
+        ]
+    else:
+        attempts = [
+            ("anicli", lambda: anicli_executor.call("get_episode_qualities", anime_id, episode)),
+            ("aniliberty", lambda: aniliberty_api.get_episode_qualities(anime_id, episode)),
+            ("anilibria_old", lambda: anilibria_fallback.get_episode_qualities(anime_id, episode))
+        ]
+    return [(name, attempt) for name, attempt in attempts if name in RESOLVE_PROVIDERS]
+
+async def resolve_video_url(anime_id: int, episode: int) -> Optional[str]:
+    """Получает ссылку на видео у провайдеров (кэширует resolved_cache)"""
+    cached_release = await cached_release_qualities(anime_id, episode)
+    if cached_release:
+        video_url = best_video_url(*cached_release)
+        if video_url:
+            API_SOURCE_COUNT.labels(source="release_cache", endpoint="video").inc()
+            return video_url
+
+    winner, video_url = await first_successful(
+        provider_attempts("video", anime_id, episode),
+        scope="video",
+        strategy=RESOLVE_STRATEGY,
+        hedge_delay=RESOLVE_HEDGE_DELAY,
+        timeouts=RESOLVE_PROVIDER_TIMEOUTS,
+        budget=RESOLVE_BUDGET,
+        breaker_scope="provider"
+    )
+    if video_url:
+        API_SOURCE_COUNT.labels(source=winner, endpoint="video").inc()
+        log_request_event("Got video URL from %s for %s:%s", winner, anime_id, episode)
+    return video_url
+
+async def resolve_qualities(anime_id: int, episode: int) -> Optional[Dict]:
+    """Получает карту качеств у провайдеров (кэширует resolved_cache)"""
+    cached_release = await cached_release_qualities(anime_id, episode)
+    if cached_release:
+        qualities = cached_release[0]
+        API_SOURCE_COUNT.labels(source="release_cache", endpoint="qualities").inc()
+        return qualities
+
+    winner, qualities = await first_successful(
+        provider_attempts("qualities", anime_id, episode),
+        scope="qualities",
+        strategy=RESOLVE_STRATEGY,
+        hedge_delay=RESOLVE_HEDGE_DELAY,
+        timeouts=RESOLVE_PROVIDER_TIMEOUTS,
+        budget=RESOLVE_BUDGET,
+        breaker_scope="provider"
+    )
+    if qualities:
+        API_SOURCE_COUNT.labels(source=winner, endpoint="qualities").inc()
+        log_request_event("Got qualities from %s for %s:%s", winner, anime_id, episode)
+    return qualities
+
+# Кэш результатов резолва: stale-while-revalidate и негативное кэширование
+class ResolvedCache:
+    """Ссылки на видео и карты качеств с мягким и жёстким TTL.
+
+    Запись хранится как {"value", "fresh_until"} (время по часам, общим для воркеров).
+    До fresh_until она свежая, затем до жёсткого TTL отдаётся как есть, а резолв
+    повторяется в фоне. "Не найдено" хранится с value=None на CACHE_NEGATIVE_TTL;
+    недоступность провайдеров (UpstreamUnavailableError) не кэшируется.
+    """
+    def __init__(self, cache: TieredCache, single_flight: SingleFlight):
+        self.cache = cache
+        self.single_flight = single_flight
+        self.revalidating: Dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def _is_entry(entry: Any) -> bool:
+        # Записи старого формата (голое значение) считаем промахом
+        return isinstance(entry, dict) and "fresh_until" in entry
+
+    async def get(self, key: str, resolver: Callable[[], Awaitable[Any]]) -> Optional[Any]:
+        """Значение ключа: свежее или устаревшее из кэша, иначе резолв через single-flight"""
+        kind = key.split('_', 1)[0]
+        entry = await self.cache.get(key)
+        if self._is_entry(entry):
+            if time.time() < entry["fresh_until"]:
+                result = "fresh" if entry["value"] is not None else "negative"
+                RESOLVED_CACHE_LOOKUPS.labels(kind=kind, result=result).inc()
+                return entry["value"]
+            if entry["value"] is not None:
+                RESOLVED_CACHE_LOOKUPS.labels(kind=kind, result="stale").inc()
+                self._revalidate(key, kind, resolver)
+                return entry["value"]
+        RESOLVED_CACHE_LOOKUPS.labels(kind=kind, result="miss").inc()
+        entry = await self.single_flight.do(key, lambda: self._refresh(key, resolver))
+        return entry["value"]
+
+    async def peek(self, key: str) -> Optional[Any]:
+        """Значение из кэша (в том числе устаревшее) без резолва и фонового обновления"""
+        entry = await self.cache.get(key)
+        return entry["value"] if self._is_entry(entry) else None
+
+    async def _refresh(self, key: str, resolver: Callable[[], Awaitable[Any]]) -> Dict[str, Any]:
+        value = await resolver()
+        if value:
+            soft_ttl = self.cache.ttl_for(key)
+            entry = {"value": value, "fresh_until": time.time() + soft_ttl}
+            await self.cache.set(key, entry, soft_ttl + CACHE_STALE_TTL)
+        else:
+            entry = {"value": None, "fresh_until": time.time() + CACHE_NEGATIVE_TTL}
+            if CACHE_NEGATIVE_TTL > 0:
+                await self.cache.set(key, entry, CACHE_NEGATIVE_TTL)
+        return entry
+
+    def _revalidate(self, key: str, kind: str, resolver: Callable[[], Awaitable[Any]]):
+        if key in self.revalidating:
+            return
+        task = spawn_background(self._revalidate_task(key, kind, resolver), "cache.revalidate", key=key)
+        self.revalidating[key] = task
+        task.add_done_callback(lambda t: self.revalidating.pop(key, None))
+
+    async def _revalidate_task(self, key: str, kind: str, resolver: Callable[[], Awaitable[Any]]):
+        try:
+            # Другой воркер мог уже обновить запись в L2
+            entry = await self.cache.peek_l2(key)
+            if self._is_entry(entry) and time.time() < entry["fresh_until"]:
+                result = "fresh_elsewhere"
+            else:
+                entry = await self.single_flight.do(key, lambda: self._refresh(key, resolver))
+                result = "ok" if entry["value"] is not None else "not_found"
+        except Exception as e:
+            result = "error"
+            logger.warning("Background refresh of %s failed, serving stale value: %s", key, e)
+        CACHE_REVALIDATIONS.labels(kind=kind, result=result).inc()
+
+# Глобальный кэш результатов резолва
+resolved_cache = ResolvedCache(cache, single_flight)
+
+# Пакетный резолв: один релиз на аниме, ограниченная параллельность
+class ResolveItem(BaseModel):
+    anime_id: int
+    episode: int
+
+class ResolveBatchRequest(BaseModel):
+    items: List[ResolveItem] = Field(..., min_length=1, max_length=RESOLVE_BATCH_MAX_ITEMS)
+    video: bool = False  # заодно резолвить ссылки на видео, чтобы /video отвечал из кэша
+
+def compact_qualities(qualities: Dict[str, Optional[str]]) -> Dict[str, str]:
+    return {quality: url for quality, url in qualities.items() if url}
+
+async def load_episode_map(anime_id: int) -> Tuple[Optional[str], Dict[str, Dict[str, Optional[str]]]]:
+    """Карты качеств всех эпизодов одним запросом релиза: Aniliberty, затем старый Anilibria"""
+    failed = []
+    for source, api in (("aniliberty", aniliberty_api), ("anilibria_old", anilibria_fallback)):
+        try:
+            episodes = await api.get_episode_map(anime_id)
+        except UpstreamUnavailableError as e:
+            logger.warning("Episode map of %s from %s unavailable: %s", anime_id, source, e)
+            failed.append(source)
+            continue
+        if episodes:
+            return source, episodes
+    if len(failed) == 2:
+        raise UpstreamUnavailableError(f"episode map of {anime_id}: {', '.join(failed)} unavailable")
+    return None, {}
+
+def release_api(source: str):
+    return aniliberty_api if source == "aniliberty" else anilibria_fallback
+
+async def load_episode_meta(anime_id: int, episode: int) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Источник и метаданные релиза, если эпизод в нём есть; (None, {}) - эпизода нет"""
+    source, episodes = await load_episode_map(anime_id)
+    if str(episode) not in episodes:
+        return None, {}
+    return source, await release_api(source).get_release_meta(anime_id)
+
+async def resolve_batch(items: List[ResolveItem], with_video: bool) -> List[Dict[str, Any]]:
+    """Результат по каждому эпизоду: ok (с картой качеств), not_found, unavailable или error.
+
+    При промахе кэша релиз аниме загружается один раз на весь пакет, после чего
+    эпизоды разбираются из его карты без обращения к провайдерам по каждому эпизоду.
+    """
+    semaphore = asyncio.Semaphore(RESOLVE_BATCH_CONCURRENCY)
+    map_loads: Dict[int, asyncio.Task] = {}
+
+    async def resolver(kind: str, anime_id: int, episode: int) -> Any:
+        if anime_id not in map_loads:
+            map_loads[anime_id] = asyncio.create_task(load_episode_map(anime_id))
+        try:
+            await asyncio.shield(map_loads[anime_id])
+        except UpstreamUnavailableError:
+            pass  # провайдеры по эпизоду ещё могут ответить
+        if kind == "video":
+            return await resolve_video_url(anime_id, episode)
+        return await resolve_qualities(anime_id, episode)
+
+    async def resolve_item(item: ResolveItem) -> Dict[str, Any]:
+        anime_id, episode = item.anime_id, item.episode
+        result: Dict[str, Any] = {"anime_id": anime_id, "episode": episode}
+        async with semaphore:
+            try:
+                qualities = await resolved_cache.get(
+                    f"qualities_{anime_id}_{episode}", lambda: resolver("qualities", anime_id, episode)
+                )
+                if with_video and qualities:
+                    video_url = await resolved_cache.get(
+                        f"video_{anime_id}_{episode}", lambda: resolver("video", anime_id, episode)
+                    )
+                    result["video"] = bool(video_url)
+            except UpstreamUnavailableError:
+                qualities, result["status"] = None, "unavailable"
+            except Exception as e:
+                logger.error("Batch resolve error for %s:%s: %s", anime_id, episode, e)
+                qualities, result["status"] = None, "error"
+        if "status" not in result:
+            result["status"] = "ok" if qualities else "not_found"
+        if qualities:
+            result["qualities"] = compact_qualities(qualities)
+        BATCH_RESOLVE_ITEMS.labels(result=result["status"]).inc()
+        return result
+
+    try:
+        return await asyncio.gather(*(resolve_item(item) for item in items))
+    finally:
+        for task in map_loads.values():
+            if task.done() and not task.cancelled():
+                task.exception()
+            else:
+                task.cancel()
+
+# Фоновый прогрев кэша для свежих и популярных релизов
+def _warm_episode(label: str) -> Optional[int]:
+    """Номер эпизода из метки карты релиза; None для "12.5", "OVA" и т.п. - их не отдаёт /video"""
+    if label.isdecimal() and str(int(label)) == label:
+        return int(label)
+    return None
+
+class CacheWarmer:
+    """Заранее резолвит карты качеств и ссылки на видео, пока их никто не запросил.
+
+    Популярность аниме считается по запросам /video этого воркера и затухает вдвое
+    после каждого прогрева. Воркеры прогревают независимо: повторная работа
+    отсекается общим L2 кэшем и single-flight.
+    """
+    def __init__(self):
+        self.popularity: Dict[int, float] = {}
+        self.top_labels: set = set()
+        self.top_checked_at = float('-inf')
+        self.task: Optional[asyncio.Task] = None
+        self.running = False
+        self.last_run: Optional[Dict[str, Any]] = None
+
+    def record(self, anime_id: int):
+        self.popularity[anime_id] = self.popularity.get(anime_id, 0.0) + 1.0
+
+    def top_ids(self, limit: int) -> List[int]:
+        return heapq.nlargest(limit, self.popularity, key=self.popularity.get)
+
+    def metric_label(self, anime_id: int) -> str:
+        """anime_id для метрик: свой ID только у топ METRICS_TOP_ANIME, топ пересчитывается раз в минуту"""
+        now = time.monotonic()
+        if now - self.top_checked_at > 60:
+            self.top_labels = set(self.top_ids(METRICS_TOP_ANIME))
+            self.top_checked_at = now
+        return str(anime_id) if anime_id in self.top_labels else "other"
+
+    def _decay(self):
+        self.popularity = {anime_id: count / 2 for anime_id, count in self.popularity.items() if count >= 1.0}
+
+    async def warm_release(self, anime_id: int) -> int:
+        """Резолвит последние WARM_MAX_EPISODES эпизодов релиза; возвращает их число"""
+        _, episodes = await load_episode_map(anime_id)
+        # Нечисловые метки пропускаем, а не прерываем прогрев всего релиза
+        numbers = sorted(number for number in map(_warm_episode, episodes) if number is not None)
+        numbers = numbers[-WARM_MAX_EPISODES:] if WARM_MAX_EPISODES > 0 else []
+        for episode in numbers:
+            # Карта релиза уже в кэше, поэтому резолв обходится без запросов к провайдерам
+            await resolved_cache.get(f"qualities_{anime_id}_{episode}", lambda: resolve_qualities(anime_id, episode))
+            await resolved_cache.get(f"video_{anime_id}_{episode}", lambda: resolve_video_url(anime_id, episode))
+        CACHE_WARM_EPISODES.inc(len(numbers))
+        return len(numbers)
+
+    async def warm(self, anime_ids: Optional[List[int]] = None, trigger: str = "schedule") -> Dict[str, Any]:
+        """Прогрев переданных ID или ленты свежих релизов и самых запрашиваемых аниме"""
+        started_at = time.monotonic()
+        CACHE_WARM_RUNS.labels(trigger=trigger).inc()
+        if anime_ids is None:
+            anime_ids = []
+            try:
+                anime_ids.extend(await aniliberty_api.get_feed_release_ids(WARM_LATEST_LIMIT))
+            except Exception as e:
+                logger.warning("Cache warm-up: release feed unavailable: %s", e)
+            anime_ids.extend(self.top_ids(WARM_TOP_N))
+            self._decay()
+        anime_ids = list(dict.fromkeys(anime_ids))[:WARM_MAX_RELEASES]
+
+        semaphore = asyncio.Semaphore(WARM_CONCURRENCY)
+        results: Dict[str, int] = {}
+        warmed_episodes = 0
+
+        async def warm_one(anime_id: int):
+            nonlocal warmed_episodes
+            async with semaphore:
+                try:
+                    count = await self.warm_release(anime_id)
+                    result = "ok" if count else "empty"
+                    warmed_episodes += count
+                except UpstreamUnavailableError:
+                    result = "unavailable"
+                except Exception as e:
+                    logger.warning("Cache warm-up of %s failed: %s", anime_id, e)
+                    result = "error"
+            results[result] = results.get(result, 0) + 1
+            CACHE_WARM_RELEASES.labels(result=result).inc()
+
+        self.running = True
+        try:
+            await asyncio.gather(*(warm_one(anime_id) for anime_id in anime_ids))
+        finally:
+            self.running = False
+        duration = time.monotonic() - started_at
+        CACHE_WARM_DURATION.observe(duration)
+        self.last_run = {
+            "trigger": trigger,
+            "finished_at": datetime.utcnow().isoformat(),
+            "duration_seconds": round(duration, 3),
+            "releases": len(anime_ids),
+            "episodes": warmed_episodes,
+            "results": results
+        }
+        logger.info("Cache warm-up (%s) finished: %s releases, %s episodes in %.1fs", trigger, len(anime_ids), warmed_episodes, duration)
+        return self.last_run
+
+    async def run_forever(self):
+        # Случайный сдвиг, чтобы воркеры и их запросы к ленте не совпадали по времени
+        await asyncio.sleep(random.uniform(0, WARM_INTERVAL * WARM_JITTER) + 5)
+        while True:
+            try:
+                await self.warm()
+            except Exception as e:
+                logger.error("Cache warm-up run failed: %s", e)
+            await asyncio.sleep(WARM_INTERVAL * random.uniform(1 - WARM_JITTER, 1 + WARM_JITTER))
+
+    def start(self):
+        if WARM_ENABLED and self.task is None:
+            self.task = asyncio.create_task(self.run_forever())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": WARM_ENABLED,
+            "running": self.running,
+            "tracked_releases": len(self.popularity),
+            "top": self.top_ids(10),
+            "last_run": self.last_run
+        }
+
+# Глобальный планировщик прогрева
+cache_warmer = CacheWarmer()
+
+# Проксирование медиа с источника через общий пул соединений
+class ProxyStreamingResponse(StreamingResponse):
+    """StreamingResponse, закрывающий тело сразу по окончании ответа.
+
+    При отключении клиента Starlette лишь отменяет отправку, а генератор
+    закрывается сборщиком мусора; здесь aclose() сразу освобождает
+    соединение с источником - в том числе когда клиент ушёл до первого куска
+    и генератор не запускался (это обрабатывает UpstreamStream.aclose).
+    """
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
+# Потоки воркера для /debug/runtime; байты в пути попадают в gauge при refresh_process_gauges,
+# а не на каждый кусок
+stream_state = {"active": 0, "bytes_in_flight": 0}
+
+class UpstreamStream:
+    """Тело ответа источника для ProxyStreamingResponse.
+
+    Следующий кусок читается только после отправки предыдущего, так что
+    медленный клиент тормозит чтение из источника, а не растит буфер.
+    finish() освобождает соединение, завершает запись в кэш и спан span ровно
+    один раз: из генератора или из aclose(), если клиент отключился до первого
+    куска и генератор так и не запустился (его finally тогда не выполняется).
+    """
+    def __init__(self, upstream_response: aiohttp.ClientResponse, kind: str,
+                 writer: Optional["MediaCacheWriter"] = None, span: Optional[Span] = None):
+        self.upstream_response = upstream_response
+        self.kind = kind
+        self.writer = writer
+        self.span = span
+        self.chunks: Optional[AsyncIterator[bytes]] = None
+        self.started_at = time.monotonic()
+        self.sent = 0
+        self.finished = False
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        self.chunks = self._stream()
+        return self.chunks
+
+    async def _stream(self) -> AsyncIterator[bytes]:
+        content = self.upstream_response.content
+        chunks = content.iter_chunked(STREAM_CHUNK_SIZE) if STREAM_CHUNK_SIZE > 0 else content.iter_any()
+        self.started_at = time.monotonic()
+        result = "disconnected"
+        STREAMS_ACTIVE.inc()
+        stream_state["active"] += 1
+        try:
+            async for chunk in chunks:
+                if self.span is not None and not self.sent:
+                    self.span.set(first_byte_ms=round((time.monotonic() - self.started_at) * 1000, 1))
+                # Кусок прочитан из источника, но ещё не отправлен клиенту
+                stream_state["bytes_in_flight"] += len(chunk)
+                try:
+                    if self.writer is not None:
+                        await self.writer.write(chunk)
+                    yield chunk
+                finally:
+                    stream_state["bytes_in_flight"] -= len(chunk)
+                self.sent += len(chunk)
+            result = "completed"
+        except Exception as e:
+            result = "upstream_error"
+            logger.warning("Upstream stream for %s failed after %s bytes: %s", self.upstream_response.url, self.sent, e)
+            raise
+        finally:
+            STREAMS_ACTIVE.dec()
+            stream_state["active"] -= 1
+            await self.finish(result)
+
+    async def aclose(self):
+        if self.chunks is not None:
+            await self.chunks.aclose()
+        await self.finish("disconnected")
+
+    async def finish(self, result: str):
+        if self.finished:
+            return
+        self.finished = True
+        if result == "completed":
+            self.upstream_response.release()
+        else:
+            # Недочитанное соединение нельзя вернуть в пул
+            self.upstream_response.close()
+        duration = time.monotonic() - self.started_at
+        STREAM_BYTES.labels(kind=self.kind).inc(self.sent)
+        STREAM_RESULTS.labels(kind=self.kind, result=result).inc()
+        STREAM_DURATION.labels(kind=self.kind).observe(duration)
+        if duration > 0 and self.sent:
+            STREAM_THROUGHPUT.labels(kind=self.kind).observe(self.sent / duration)
+        if self.span is not None:
+            self.span.set(result=result, bytes=self.sent)
+            self.span.end()
+        if self.writer is not None:
+            media_cache.writing.pop(self.writer.key, None)
+            # При отключении клиента задача запроса уже отменена - доводим запись в кэш под shield
+            await asyncio.shield(self.writer.commit() if result == "completed" else self.writer.abort())
+
+async def proxy_media(request: Request, url: str, default_type: str = 'video/mp4', kind: str = 'video') -> Response:
+    """Стримит ответ источника клиенту, передавая Range и условные заголовки.
+
+    Соединение с источником живёт, пока клиент читает поток, и закрывается
+    при отключении клиента. Полные ответы попутно сохраняются в дисковый кэш,
+    повторные запросы отдаются с диска.
+    """
+    if MEDIA_CACHE_ENABLED:
+        with tracer.span("media_cache.lookup", timing="media_cache") as span:
+            cached = await media_cache.lookup(url)
+            if span is not None:
+                span.set(hit=cached is not None)
+        if cached is not None:
+            return serve_cached_media(request, *cached)
+
+    upstream_headers = {
+        name: request.headers[name] for name in PROXY_REQUEST_HEADERS if name in request.headers
+    }
+    # Без сжатия, иначе Content-Length и Content-Range не совпадут с отдаваемыми байтами
+    upstream_headers['Accept-Encoding'] = 'identity'
+    session = media_pool.get_session()
+    # Время до заголовков ответа источника (соединение + TTFB) - в Server-Timing как upstream_ttfb
+    with tracer.span("upstream.ttfb", timing="upstream_ttfb", kind=SPAN_KIND_CLIENT, **{"http.url": url}) as span:
+        try:
+            upstream_response = await session.get(url, headers=upstream_headers, read_bufsize=STREAM_BUFFER_SIZE)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            # Таймаут соединения включает ожидание свободного соединения пула
+            ERROR_COUNT.labels(error_type="media_upstream_unavailable").inc()
+            raise MediaUnavailableError(f"Media upstream {urlsplit(url).hostname} unavailable: {e!r}")
+        if span is not None:
+            span.set(**{"http.status_code": upstream_response.status})
+    response_headers = {
+        name: upstream_response.headers[name] for name in PROXY_RESPONSE_HEADERS if name in upstream_response.headers
+    }
+    response_headers.setdefault('Accept-Ranges', 'bytes')
+    response_headers['Cache-Control'] = 'public, max-age=3600'
+
+    if upstream_response.status in (200, 206):
+        content_type = upstream_response.headers.get('Content-Type', default_type)
+        # Кэшируем только ответ с объектом целиком (200 или 206 на bytes=0-), иначе на диск попадёт кусок файла
+        writer = media_cache.writer_for(url, upstream_response) if MEDIA_CACHE_ENABLED else None
+
+        # Спан потока живёт дольше запроса: завершается, когда клиент дочитал или отключился
+        stream_span = tracer.start_span("upstream.stream", kind=SPAN_KIND_CLIENT, stream_kind=kind)
+        return ProxyStreamingResponse(
+            UpstreamStream(upstream_response, kind, writer, stream_span),
+            status_code=upstream_response.status,
+            media_type=content_type,
+            headers=response_headers
+        )
+    elif upstream_response.status in (304, 416):
+        # Клиентская копия актуальна или запрошен диапазон за пределами файла
+        upstream_response.release()
+        response_headers.pop('Content-Length', None)
+        return Response(status_code=upstream_response.status, headers=response_headers)
+    else:
+        upstream_response.release()
+        ERROR_COUNT.labels(error_type="video_stream_error").inc()
+        raise HTTPException(status_code=upstream_response.status, detail="Failed to stream video")
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Разбирает одиночный диапазон 'bytes=a-b'. None - диапазон невыполним,
+    ValueError - заголовок не поддерживается (тогда отдаётся весь файл)."""
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        raise ValueError(f"Unsupported Range header: {header}")
+    start_text, _, end_text = spec.strip().partition('-')
+    if not start_text:
+        suffix = int(end_text)
+        if suffix == 0:
+            return None
+        return max(size - suffix, 0), size - 1
+    start = int(start_text)
+    end = min(int(end_text), size - 1) if end_text else size - 1
+    if start >= size or start > end:
+        return None
+    return start, end
+
+async def read_file_range(path: str, start: int, end: int, chunk_size: int = STREAM_CHUNK_SIZE or 64 * 1024):
+    async with aiofiles.open(path, 'rb') as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def serve_cached_media(request: Request, path: str, meta: Dict[str, Any]) -> Response:
+    """Отдаёт файл из дискового кэша с поддержкой Range, If-Range и If-None-Match"""
+    size = meta['size']
+    etag = meta.get('ETag')
+    last_modified = meta.get('Last-Modified')
+    media_type = meta.get('content_type') or 'application/octet-stream'
+    headers = {'Accept-Ranges': 'bytes', 'Cache-Control': 'public, max-age=3600'}
+    if etag:
+        headers['ETag'] = etag
+    if last_modified:
+        headers['Last-Modified'] = last_modified
+
+    if etag and request.headers.get('If-None-Match') == etag:
+        return Response(status_code=304, headers=headers)
+
+    byte_range = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if byte_range and (not if_range or if_range in (etag, last_modified)):
+        try:
+            parsed = parse_byte_range(byte_range, size)
+        except ValueError:
+            parsed = (0, size - 1)
+            byte_range = None
+        if parsed is None:
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status_code=416, headers=headers)
+        if byte_range:
+            start, end = parsed
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            headers['Content-Length'] = str(end - start + 1)
+            MEDIA_CACHE_BYTES_SAVED.inc(end - start + 1)
+            return ProxyStreamingResponse(
+                read_file_range(path, start, end),
+                status_code=206,
+                media_type=media_type,
+                headers=headers
+            )
+
+    MEDIA_CACHE_BYTES_SAVED.inc(size)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+# HLS: плейлисты переписываются так, чтобы сегменты шли через /hls/... этого сервиса
+HLS_URI_ATTRIBUTE = re.compile(r'URI="([^"]+)"')
+
+def is_hls_url(url: str) -> bool:
+    return urlsplit(url).path.lower().endswith('.m3u8')
+
+def hls_host_allowed(url: str) -> bool:
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    return parts.scheme in ('http', 'https') and any(
+        host == allowed or host.endswith('.' + allowed) for allowed in HLS_ALLOWED_HOSTS
+    )
+
+def encode_hls_token(url: str) -> str:
+    return base64.urlsafe_b64encode(url.encode()).decode().rstrip('=')
+
+def decode_hls_token(token: str) -> str:
+    return base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+
+def rewrite_hls_playlist(text: str, base_url: str, prefix: str) -> str:
+    """Заменяет URI вариантов, сегментов, ключей и init-секций на ссылки /hls/{token}/{имя}.
+
+    prefix - относительный путь до /hls/ от адреса, по которому отдаётся плейлист,
+    чтобы ссылки работали и за обратным прокси с префиксом.
+    """
+    def proxied(uri: str) -> str:
+        absolute = urljoin(base_url, uri.strip())
+        if not hls_host_allowed(absolute):
+            return absolute
+        name = posixpath.basename(urlsplit(absolute).path) or 'index'
+        return f"{prefix}{encode_hls_token(absolute)}/{quote(name)}"
+
+    lines = []
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            lines.append(line)
+        elif stripped.startswith('#'):
+            lines.append(HLS_URI_ATTRIBUTE.sub(lambda m: f'URI="{proxied(m.group(1))}"', line))
+        else:
+            lines.append(proxied(stripped))
+    return "\n".join(lines) + "\n"
+
+async def fetch_hls_playlist(url: str) -> Optional[str]:
+    """Загружает плейлист с источника; ненадолго кэширует исходный текст"""
+    cache_key = f"hls_{hashlib.sha1(url.encode()).hexdigest()}"
+    playlist = await cache.get(cache_key)
+    if playlist:
+        return playlist
+
+    async def load() -> Optional[str]:
+        session = upstream_pool.get_session()
+        with tracer.span("hls.playlist", timing="hls_playlist", kind=SPAN_KIND_CLIENT, **{"http.url": url}) as span:
+            async with session.get(url) as response:
+                if span is not None:
+                    span.set(**{"http.status_code": response.status})
+                if response.status != 200:
+                    logger.warning("HLS playlist %s returned status %s", url, response.status)
+                    return None
+                text = await response.text()
+        await cache.set(cache_key, text)
+        return text
+
+    return await single_flight.do(cache_key, load)
+
+async def hls_playlist_response(url: str, prefix: str) -> Response:
+    playlist = await fetch_hls_playlist(url)
+    if not playlist:
+        HLS_REQUESTS.labels(kind="playlist", status="error").inc()
+        raise HTTPException(status_code=502, detail="Failed to fetch HLS playlist")
+    HLS_REQUESTS.labels(kind="playlist", status="ok").inc()
+    return Response(
+        content=rewrite_hls_playlist(playlist, url, prefix),
+        media_type='application/vnd.apple.mpegurl',
+        headers={'Cache-Control': f'public, max-age={HLS_MANIFEST_TTL}'}
+    )
+
+# Предзагрузка следующего эпизода
+async def prewarm_media(url: str) -> bool:
+    """Скачивает URL в дисковый кэш медиа (без клиента); False - не закэширован"""
+    if media_cache.contains(url):
+        return True
+    session = media_pool.get_session()
+    async with session.get(url, headers={'Accept-Encoding': 'identity'}, read_bufsize=STREAM_BUFFER_SIZE) as response:
+        writer = media_cache.writer_for(url, response)
+        if writer is None:
+            return False
+        completed = False
+        try:
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE or 64 * 1024):
+                await writer.write(chunk)
+            completed = True
+        finally:
+            media_cache.writing.pop(writer.key, None)
+            await asyncio.shield(writer.commit() if completed else writer.abort())
+    return media_cache.contains(url)
+
+async def prewarm_hls_segments(url: str, count: int) -> int:
+    """Первые count сегментов HLS потока (первого варианта мастер-плейлиста) в дисковый кэш"""
+    playlist = await fetch_hls_playlist(url)
+    if playlist and '#EXT-X-STREAM-INF' in playlist:
+        variant = next((line.strip() for line in playlist.splitlines() if line.strip() and not line.startswith('#')), None)
+        if variant is None:
+            return 0
+        url = urljoin(url, variant)
+        playlist = await fetch_hls_playlist(url) if hls_host_allowed(url) else None
+    if not playlist:
+        return 0
+    segments = [urljoin(url, line.strip()) for line in playlist.splitlines() if line.strip() and not line.startswith('#')]
+    warmed = 0
+    for segment_url in segments[:count]:
+        if not hls_host_allowed(segment_url):
+            continue
+        try:
+            cached = await prewarm_media(segment_url)
+        except Exception as e:
+            logger.warning("Prefetch of segment %s failed: %s", segment_url, e)
+            cached = False
+        PREFETCH_MEDIA_SEGMENTS_TOTAL.labels(result="cached" if cached else "failed").inc()
+        warmed += cached
+    return warmed
+
+class NextEpisodePrefetcher:
+    """После запроса эпизода N резолвит N+1, пока зритель смотрит N.
+
+    Не больше PREFETCH_MAX_INFLIGHT предзагрузок одновременно; при деградации
+    провайдеров предзагрузка пропускается. Предзагруженный эпизод, запрошенный
+    в течение PREFETCH_HIT_WINDOW, считается попаданием (used), иначе - expired.
+    """
+    def __init__(self):
+        self.inflight: Dict[str, asyncio.Task] = {}
+        # Обработанные ключи: время и флаг "предзагружен и ещё не запрошен"
+        self.handled: "OrderedDict[str, Tuple[float, bool]]" = OrderedDict()
+
+    def _trim(self):
+        now = time.monotonic()
+        while self.handled:
+            key, (handled_at, pending_use) = next(iter(self.handled.items()))
+            if now - handled_at < PREFETCH_HIT_WINDOW and len(self.handled) <= PREFETCH_TRACK_MAX:
+                break
+            del self.handled[key]
+            if pending_use:
+                PREFETCH_OUTCOMES.labels(result="expired").inc()
+
+    def on_request(self, anime_id: int, episode: int):
+        """Учитывает запрос эпизода и планирует предзагрузку следующего"""
+        key = f"video_{anime_id}_{episode}"
+        entry = self.handled.get(key)
+        if entry is not None and entry[1]:
+            self.handled[key] = (entry[0], False)
+            PREFETCH_OUTCOMES.labels(result="used").inc()
+        self._trim()
+        if PREFETCH_ENABLED:
+            self.schedule(anime_id, episode + 1)
+
+    def schedule(self, anime_id: int, episode: int):
+        key = f"video_{anime_id}_{episode}"
+        # Повторные запросы того же эпизода (Range, перемотка) не порождают новых задач
+        if key in self.inflight or key in self.handled:
+            return
+        if len(self.inflight) >= PREFETCH_MAX_INFLIGHT:
+            PREFETCH_REQUESTS.labels(result="skipped_budget").inc()
+            return
+        if provider_health.degraded("provider"):
+            PREFETCH_REQUESTS.labels(result="skipped_degraded").inc()
+            return
+        task = spawn_background(self._prefetch(anime_id, episode, key), "prefetch", key=key)
+        self.inflight[key] = task
+        PREFETCH_INFLIGHT.set(len(self.inflight))
+        task.add_done_callback(lambda t: self._done(key))
+
+    def _done(self, key: str):
+        self.inflight.pop(key, None)
+        PREFETCH_INFLIGHT.set(len(self.inflight))
+
+    async def _known_missing(self, anime_id: int, episode: int) -> bool:
+        """По закэшированной карте релиза видно, что эпизода нет (последний вышедший)"""
+        for source in ("aniliberty", "anilibria"):
+            episodes = await cache.get(f"episodes_{source}_{anime_id}")
+            if episodes and str(episode) not in episodes:
+                return True
+        return False
+
+    async def _prefetch(self, anime_id: int, episode: int, key: str):
+        resolved = False
+        try:
+            if await resolved_cache.peek(key):
+                result = "cached"
+            elif await self._known_missing(anime_id, episode):
+                result = "no_next"
+            else:
+                video_url = await resolved_cache.get(key, lambda: resolve_video_url(anime_id, episode))
+                resolved = bool(video_url)
+                result = "resolved" if resolved else "not_found"
+                if (resolved and PREFETCH_MEDIA_SEGMENTS > 0 and MEDIA_CACHE_ENABLED and HLS_PROXY_ENABLED
+                        and is_hls_url(video_url) and hls_host_allowed(video_url)):
+                    await prewarm_hls_segments(video_url, PREFETCH_MEDIA_SEGMENTS)
+        except UpstreamUnavailableError:
+            result = "unavailable"
+        except Exception as e:
+            logger.warning("Prefetch of %s:%s failed: %s", anime_id, episode, e)
+            result = "error"
+        self.handled[key] = (time.monotonic(), resolved)
+        PREFETCH_REQUESTS.labels(result=result).inc()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": PREFETCH_ENABLED,
+            "inflight": len(self.inflight),
+            "tracked": len(self.handled),
+            "awaiting_use": sum(pending_use for _, pending_use in self.handled.values())
+        }
+
+# Глобальная предзагрузка следующих эпизодов
+next_episode_prefetcher = NextEpisodePrefetcher()
+
+# Метки метрик с ограниченным числом значений
+def endpoint_label(endpoint: str) -> str:
+    """Путь запроса к API без query и с числовыми ID, заменёнными на {id}"""
+    return re.sub(r'/\d+(?=/|$)', '/{id}', endpoint.split('?', 1)[0])
+
+def route_label(request: Request) -> str:
+    """Шаблон маршрута FastAPI (/hls/{token}/{name}) вместо фактического пути"""
+    route = request.scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+def process_rss_bytes() -> Optional[int]:
+    """Текущий RSS процесса (Linux, /proc); None, если недоступен"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Gauge, которые считаются по состоянию воркера, а не по событиям
+def refresh_process_gauges():
+    CACHE_L1_ENTRIES.set(len(cache.l1))
+    CACHE_L1_BYTES.set(cache.l1.bytes)
+    STREAM_BYTES_IN_FLIGHT.set(stream_state["bytes_in_flight"])
+    rss = process_rss_bytes()
+    if rss is not None:
+        PROCESS_RSS.set(rss)
+    for upstream in (upstream_pool, media_pool):
+        pool = upstream.stats()
+        UPSTREAM_POOL_OPEN.labels(pool=upstream.name).set(pool["open"])
+        UPSTREAM_POOL_IDLE.labels(pool=upstream.name).set(pool["idle"])
+        UPSTREAM_POOL_WAITING.labels(pool=upstream.name).set(pool["waiting"])
+
+async def metrics_refresh_task():
+    while True:
+        refresh_process_gauges()
+        await asyncio.sleep(METRICS_REFRESH_INTERVAL)
+
+class LoopMonitor:
+    """Задержка event loop и поиск блокирующих вызовов.
+
+    Задача в loop засыпает на LOOP_LAG_INTERVAL и меряет, насколько позже
+    проснулась - это время, когда loop был занят синхронным кодом. Поток-сторож
+    проверяет отметку этой задачи: если loop не отвечает дольше
+    LOOP_BLOCK_THRESHOLD, в лог один раз пишется стек потока loop, то есть
+    место, где он заблокирован (синхронный вызов, разбор большого JSON).
+    """
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.watchdog: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.loop_thread_id: Optional[int] = None
+        self.heartbeat = time.monotonic()
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.blocked = 0
+        self.tasks = 0
+
+    async def run_forever(self):
+        while True:
+            started_at = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            now = time.monotonic()
+            lag = max(0.0, now - started_at - LOOP_LAG_INTERVAL)
+            self.heartbeat = now
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.observe(lag)
+            # all_tasks() работает только в потоке loop, поэтому считаем здесь, а не в refresh_process_gauges
+            self.tasks = len(asyncio.all_tasks())
+            ASYNCIO_TASKS.set(self.tasks)
+
+    def watch(self):
+        reported_heartbeat = None
+        while not self.stopped.wait(LOOP_LAG_INTERVAL):
+            heartbeat = self.heartbeat
+            blocked_for = time.monotonic() - heartbeat - LOOP_LAG_INTERVAL
+            if blocked_for < LOOP_BLOCK_THRESHOLD or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            self.blocked += 1
+            LOOP_BLOCKED.inc()
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "<no frame>"
+            logger.warning("Event loop has been blocked for %.2fs, loop thread stack:\n%s", blocked_for, stack)
+
+    def start(self):
+        if not LOOP_MONITOR_ENABLED or self.task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self.run_forever())
+        if LOOP_BLOCK_THRESHOLD > 0:
+            self.stopped.clear()
+            self.watchdog = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+            self.watchdog.start()
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": LOOP_MONITOR_ENABLED,
+            "lag_seconds": round(self.last_lag, 4),
+            "max_lag_seconds": round(self.max_lag, 4),
+            "blocked": self.blocked,
+            "tasks": self.tasks
+        }
+
+loop_monitor = LoopMonitor()
+
+def metrics_registry():
+    """Реестр для отдачи: при PROMETHEUS_MULTIPROC_DIR - агрегат по всем воркерам"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
 # Middleware для метрик
 @app.middleware("http")
 async def metrics_middleware(request: Request, call_next):
@@ -305,15 +3370,67 @@ async def metrics_middleware(request: Request, call_next):
     
     # Записываем метрики
     duration = time.time() - start_time
-    REQUEST_DURATION.observe(duration)
+    endpoint = route_label(request)
+    REQUEST_DURATION.labels(method=request.method, endpoint=endpoint).observe(duration)
     REQUEST_COUNT.labels(
         method=request.method,
-        endpoint=request.url.path,
+        endpoint=endpoint,
         status=response.status_code
     ).inc()
     
     return response
 
+# Трассировка: корневой спан запроса и заголовок Server-Timing
+@app.middleware("http")
+async def tracing_middleware(request: Request, call_next):
+    if request.url.path == "/metrics":
+        return await call_next(request)
+    root = tracer.start_trace(
+        f"{request.method} {request.url.path}",
+        request.headers.get("traceparent"),
+        **{"http.method": request.method, "http.target": request.url.path, "request.id": request_id_var.get()}
+    )
+    if root is None:
+        return await call_next(request)
+    token = current_span_var.set(root)
+    try:
+        response = await call_next(request)
+    except BaseException as e:
+        root.fail(e)
+        root.end()
+        root.trace.closed = True
+        raise
+    finally:
+        current_span_var.reset(token)
+    route = route_label(request)
+    root.name = f"{request.method} {route}"
+    root.set(**{"http.route": route, "http.status_code": response.status_code})
+    root.end()
+    root.trace.closed = True
+    if SERVER_TIMING_ENABLED:
+        response.headers["Server-Timing"] = root.trace.server_timing(root.duration_ms)
+    return response
+
+# ID запроса: из X-Request-ID клиента (или прокси) либо новый; попадает в логи и ответ
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+@app.middleware("http")
+async def request_id_middleware(request: Request, call_next):
+    request_id = request.headers.get("X-Request-ID", "")
+    if not REQUEST_ID_PATTERN.match(request_id):
+        request_id = uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+def service_unavailable(detail: str) -> HTTPException:
+    """503 с Retry-After: источники или пул соединений временно недоступны"""
+    return HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(UPSTREAM_RETRY_AFTER)})
+
 @app.get("/video")
 @limiter.limit("100/minute")
 async def get_video(
@@ -325,82 +3442,39 @@ async def get_video(
     cache_key = f"video_{anime_id}_{episode}"
     
     try:
-        # Проверяем кэш
-        cached_url = cache.get(cache_key)
-        if cached_url:
-            logger.info(f"Cache hit for video {anime_id}:{episode}")
-        else:
-            # Пытаемся получить через основной API (AniCLI)
-            client = AnimeGo()
-            try:
-                video_url = client.get_episode_video(anime_id, episode)
-                if video_url:
-                    cache.set(cache_key, video_url)
-                    cached_url = video_url
-                    API_SOURCE_COUNT.labels(source="anicli", endpoint="video").inc()
-                    logger.info(f"Got video URL from AnimeGo for {anime_id}:{episode}")
-                else:
-                    raise Exception("No video URL from AnimeGo")
-            except Exception as e:
-                logger.warning(f"AnimeGo failed for {anime_id}:{episode}: {e}")
-                
-                # Fallback на новый Aniliberty API
-                try:
-                    aniliberty_url = await aniliberty_api.get_episode_video(anime_id, episode)
-                    if aniliberty_url:
-                        cache.set(cache_key, aniliberty_url)
-                        cached_url = aniliberty_url
-                        API_SOURCE_COUNT.labels(source="aniliberty", endpoint="video").inc()
-                        logger.info(f"Got video URL from Aniliberty API for {anime_id}:{episode}")
-                    else:
-                        raise Exception("No video URL from Aniliberty")
-                except Exception as aniliberty_error:
-                    logger.warning(f"Aniliberty API failed for {anime_id}:{episode}: {aniliberty_error}")
-                    
-                    # Fallback на старый Anilibria API
-                    fallback_url = await anilibria_fallback.get_episode_video(anime_id, episode)
-                    if fallback_url:
-                        cache.set(cache_key, fallback_url)
-                        cached_url = fallback_url
-                        API_SOURCE_COUNT.labels(source="anilibria_old", endpoint="video").inc()
-                        logger.info(f"Got video URL from Anilibria fallback for {anime_id}:{episode}")
-                    else:
-                        ERROR_COUNT.labels(error_type="no_video_source").inc()
-                        raise HTTPException(status_code=404, detail="Video not found")
+        # Кэш (устаревшая ссылка отдаётся сразу и обновляется в фоне), иначе провайдеры
+        cached_url = await resolved_cache.get(cache_key, lambda: resolve_video_url(anime_id, episode))
+        if not cached_url:
+            ERROR_COUNT.labels(error_type="no_video_source").inc()
+            raise HTTPException(status_code=404, detail="Video not found")
         
         # Записываем метрику запроса видео
-        VIDEO_REQUESTS.labels(anime_id=str(anime_id)).inc()
+        cache_warmer.record(anime_id)
+        VIDEO_REQUESTS.labels(anime_id=cache_warmer.metric_label(anime_id)).inc()
+        next_episode_prefetcher.on_request(anime_id, episode)
         
-        # Проксируем видео-поток асинхронно
-        async with aiohttp.ClientSession() as session:
-            async with session.get(cached_url, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }) as video_response:
-                if video_response.status == 200:
-                    content_type = video_response.headers.get('Content-Type', 'video/mp4')
-                    
-                    async def generate():
-                        async for chunk in video_response.content.iter_chunked(1024*1024):
-                            yield chunk
-                    
-                    return StreamingResponse(
-                        generate(),
-                        media_type=content_type,
-                        headers={
-                            'Accept-Ranges': 'bytes',
-                            'Cache-Control': 'public, max-age=3600'
-                        }
-                    )
-                else:
-                    ERROR_COUNT.labels(error_type="video_stream_error").inc()
-                    raise HTTPException(status_code=video_response.status, detail="Failed to stream video")
+        # HLS плейлист переписываем, чтобы сегменты тоже шли через сервис
+        if HLS_PROXY_ENABLED and is_hls_url(cached_url) and hls_host_allowed(cached_url):
+            return await hls_playlist_response(cached_url, prefix="hls/")
+
+        # Проксируем видео-поток асинхронно через пул соединений медиа.
+        # Range и условные заголовки клиента уходят к источнику, чтобы перемотка
+        # не начинала загрузку заново.
+        return await proxy_media(request, cached_url)
                     
     except HTTPException:
         raise
-    except Exception as e:
+    except MediaUnavailableError as e:
+        logger.error("Video source unavailable for %s:%s: %s", anime_id, episode, e)
+        raise service_unavailable("Video source is temporarily unavailable")
+    except UpstreamUnavailableError as e:
+        ERROR_COUNT.labels(error_type="providers_unavailable").inc()
+        logger.error("No provider available for video %s:%s: %s", anime_id, episode, e)
+        raise service_unavailable("Video providers are unavailable")
+    except Exception:
         ERROR_COUNT.labels(error_type="general_error").inc()
-        logger.error(f"Error in get_video: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.exception("Error in get_video")
+        raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.get("/qualities")
 @limiter.limit("100/minute")
@@ -413,56 +3487,161 @@ async def get_qualities(
     cache_key = f"qualities_{anime_id}_{episode}"
     
     try:
-        # Проверяем кэш
-        cached_qualities = cache.get(cache_key)
-        if cached_qualities:
-            logger.info(f"Cache hit for qualities {anime_id}:{episode}")
-            return {"qualities": cached_qualities}
-        
-        # Пытаемся получить через основной API (AniCLI)
-        client = AnimeGo()
-        try:
-            qualities = client.get_episode_qualities(anime_id, episode)
-            if qualities:
-                cache.set(cache_key, qualities)
-                API_SOURCE_COUNT.labels(source="anicli", endpoint="qualities").inc()
-                logger.info(f"Got qualities from AnimeGo for {anime_id}:{episode}")
-                return {"qualities": qualities}
-            else:
-                raise Exception("No qualities from AnimeGo")
-        except Exception as e:
-            logger.warning(f"AnimeGo qualities failed for {anime_id}:{episode}: {e}")
-            
-            # Fallback на новый Aniliberty API
-            try:
-                aniliberty_qualities = await aniliberty_api.get_episode_qualities(anime_id, episode)
-                if aniliberty_qualities:
-                    cache.set(cache_key, aniliberty_qualities)
-                    API_SOURCE_COUNT.labels(source="aniliberty", endpoint="qualities").inc()
-                    logger.info(f"Got qualities from Aniliberty API for {anime_id}:{episode}")
-                    return {"qualities": aniliberty_qualities}
-                else:
-                    raise Exception("No qualities from Aniliberty")
-            except Exception as aniliberty_error:
-                logger.warning(f"Aniliberty API qualities failed for {anime_id}:{episode}: {aniliberty_error}")
-                
-                # Fallback на старый Anilibria API
-                fallback_qualities = await anilibria_fallback.get_episode_qualities(anime_id, episode)
-                if fallback_qualities:
-                    cache.set(cache_key, fallback_qualities)
-                    API_SOURCE_COUNT.labels(source="anilibria_old", endpoint="qualities").inc()
-                    logger.info(f"Got qualities from Anilibria fallback for {anime_id}:{episode}")
-                    return {"qualities": fallback_qualities}
-                else:
-                    ERROR_COUNT.labels(error_type="no_qualities_source").inc()
-                    raise HTTPException(status_code=404, detail="Qualities not found")
+        # Кэш (устаревшая карта отдаётся сразу и обновляется в фоне), иначе провайдеры
+        qualities = await resolved_cache.get(cache_key, lambda: resolve_qualities(anime_id, episode))
+        if not qualities:
+            ERROR_COUNT.labels(error_type="no_qualities_source").inc()
+            raise HTTPException(status_code=404, detail="Qualities not found")
+        return {"qualities": qualities}
                 
     except HTTPException:
         raise
-    except Exception as e:
+    except UpstreamUnavailableError as e:
+        ERROR_COUNT.labels(error_type="providers_unavailable").inc()
+        logger.error("No provider available for qualities %s:%s: %s", anime_id, episode, e)
+        raise service_unavailable("Qualities providers are unavailable")
+    except Exception:
         ERROR_COUNT.labels(error_type="general_error").inc()
-        logger.error(f"Error in get_qualities: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.exception("Error in get_qualities")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.post("/resolve")
+@limiter.limit("30/minute")
+async def resolve_episodes(request: Request, batch: ResolveBatchRequest):
+    """Пакетный резолв качеств (и, по запросу, ссылок на видео) для списка эпизодов"""
+    results = await resolve_batch(batch.items, batch.video)
+    return {"results": results}
+
+@app.get("/releases/{anime_id}/episodes")
+@limiter.limit("100/minute")
+async def get_release_episodes(request: Request, anime_id: int):
+    """Карты качеств всех эпизодов релиза за одну загрузку"""
+    try:
+        source, episodes = await load_episode_map(anime_id)
+    except UpstreamUnavailableError as e:
+        ERROR_COUNT.labels(error_type="providers_unavailable").inc()
+        logger.error("No provider available for release %s: %s", anime_id, e)
+        raise service_unavailable("Release providers are unavailable")
+    if not episodes:
+        raise HTTPException(status_code=404, detail="Release not found")
+    return {
+        "anime_id": anime_id,
+        "source": source,
+        "episodes": {number: compact_qualities(qualities) for number, qualities in episodes.items()}
+    }
+
+@app.get("/voices")
+@limiter.limit("100/minute")
+async def get_voices(
+    request: Request,
+    anime_id: int = Query(..., alias="anime_id"),
+    episode: int = Query(...)
+):
+    """Озвучки эпизода по данным релиза (без обращения к медиа)"""
+    try:
+        source, meta = await load_episode_meta(anime_id, episode)
+    except UpstreamUnavailableError as e:
+        ERROR_COUNT.labels(error_type="providers_unavailable").inc()
+        logger.error("No provider available for voices %s:%s: %s", anime_id, episode, e)
+        raise service_unavailable("Release providers are unavailable")
+    if source is None:
+        raise HTTPException(status_code=404, detail="Episode not found")
+    # Все эпизоды релиза AniLibria озвучены одной командой
+    actors = meta.get("voice_actors") or []
+    return {
+        "voices": [{
+            "id": "anilibria",
+            "name": "AniLibria",
+            "language": "ru",
+            "type": "dub",
+            "quality": "high",
+            "studio": "AniLibria",
+            "description": f"Озвучивали: {', '.join(actors)}" if actors else "Русская озвучка от AniLibria",
+            "actors": actors
+        }],
+        "source": source
+    }
+
+@app.get("/subtitles")
+@limiter.limit("100/minute")
+async def get_subtitles(
+    request: Request,
+    anime_id: int = Query(..., alias="anime_id"),
+    episode: int = Query(...),
+    language: Optional[str] = Query(None)
+):
+    """Субтитры эпизода из данных релиза; пустой список, если релиз их не содержит"""
+    try:
+        source, meta = await load_episode_meta(anime_id, episode)
+    except UpstreamUnavailableError as e:
+        ERROR_COUNT.labels(error_type="providers_unavailable").inc()
+        logger.error("No provider available for subtitles %s:%s: %s", anime_id, episode, e)
+        raise service_unavailable("Release providers are unavailable")
+    if source is None:
+        raise HTTPException(status_code=404, detail="Episode not found")
+    subtitles = (meta.get("subtitles") or {}).get(str(episode), [])
+    if language:
+        subtitles = [track for track in subtitles if track["language"] == language]
+    return {"subtitles": subtitles, "source": source}
+
+@app.get("/check-availability")
+@limiter.limit("100/minute")
+async def check_availability(
+    request: Request,
+    anime_id: int = Query(..., alias="anime_id"),
+    episode: int = Query(...)
+):
+    """Есть ли эпизод: по кэшу резолвов и картам эпизодов релиза, медиа не запрашивается"""
+    qualities = await resolved_cache.peek(f"qualities_{anime_id}_{episode}")
+    source = "cache"
+    if not qualities:
+        try:
+            source, episodes = await load_episode_map(anime_id)
+        except UpstreamUnavailableError as e:
+            ERROR_COUNT.labels(error_type="providers_unavailable").inc()
+            logger.error("No provider available for availability %s:%s: %s", anime_id, episode, e)
+            raise service_unavailable("Release providers are unavailable")
+        qualities = episodes.get(str(episode))
+    if not qualities and await resolved_cache.peek(f"video_{anime_id}_{episode}"):
+        # Ссылку на эпизод уже находил провайдер без карты релиза (AnimeGo)
+        return {"success": True, "available": True, "anime_id": anime_id, "episode": episode, "qualities": [], "source": "cache"}
+    return {
+        "success": True,
+        "available": bool(qualities),
+        "anime_id": anime_id,
+        "episode": episode,
+        "qualities": list(compact_qualities(qualities)) if qualities else [],
+        "source": source if qualities else None
+    }
+
+@app.get("/hls/{token}/{name}")
+async def get_hls_resource(request: Request, token: str, name: str):
+    """Вложенный HLS плейлист или сегмент (.ts / fMP4) через прокси"""
+    try:
+        url = decode_hls_token(token)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid HLS token")
+    if not hls_host_allowed(url):
+        HLS_REQUESTS.labels(kind="segment", status="forbidden").inc()
+        raise HTTPException(status_code=403, detail="Host is not allowed")
+
+    try:
+        if is_hls_url(url):
+            # Плейлист отдаётся по /hls/{token}/{name}, до /hls/ - один уровень вверх
+            return await hls_playlist_response(url, prefix="../")
+        response = await proxy_media(request, url, default_type='video/mp2t', kind='segment')
+        HLS_REQUESTS.labels(kind="segment", status=str(response.status_code)).inc()
+        return response
+    except HTTPException:
+        raise
+    except MediaUnavailableError as e:
+        HLS_REQUESTS.labels(kind="segment", status="unavailable").inc()
+        logger.error("HLS segment source unavailable: %s", e)
+        raise service_unavailable("Segment source is temporarily unavailable")
+    except Exception:
+        ERROR_COUNT.labels(error_type="hls_proxy_error").inc()
+        logger.exception("Error in get_hls_resource")
+        raise HTTPException(status_code=502, detail="Failed to proxy HLS resource")
 
 @app.get("/health")
 def health_check():
@@ -470,60 +3649,213 @@ def health_check():
     return {
         "status": "ok",
         "timestamp": datetime.utcnow().isoformat(),
-        "cache_size": len(cache.cache),
+        "cache_size": len(cache.l1),
+        "cache": cache.stats(),
+        "upstream_pool": upstream_pool.stats(),
+        "media_pool": media_pool.stats(),
+        "anicli_executor": anicli_executor.stats(),
+        "upstream_rate_limits": upstream_limiter.stats(),
+        "tracing": tracer.stats(),
         "version": "1.0.0"
     }
 
+@app.get("/providers/status")
+def providers_status():
+    """Состояние circuit breaker'ов и EWMA-оценки провайдеров и базовых URL Aniliberty"""
+    priority = [name for name, _ in provider_attempts("video", 0, 0)]
+    order = [name for name, _ in provider_health.order("provider", [(name, None) for name in priority])]
+    return {
+        "breaker_enabled": BREAKER_ENABLED,
+        "adaptive_ordering": ADAPTIVE_ORDERING,
+        "provider_order": order,
+        "scopes": provider_health.stats()
+    }
+
 @app.get("/metrics")
 def get_metrics():
-    """Эндпоинт для метрик Prometheus"""
-    return generate_latest()
+    """Эндпоинт для метрик Prometheus (формат text exposition)"""
+    refresh_process_gauges()
+    return Response(content=generate_latest(metrics_registry()), headers={"Content-Type": CONTENT_TYPE_LATEST})
 
 @app.get("/cache/stats")
 def cache_stats():
     """Статистика кэша"""
-    cache.clear_expired()
+    cache.l1.clear_expired()
     return {
-        "cache_size": len(cache.cache),
-        "ttl_seconds": cache.ttl,
-        "keys": list(cache.cache.keys())
+        "cache_size": len(cache.l1),
+        "ttl_seconds": cache.l1.ttl,
+        "ttl_by_type": cache.key_ttls,
+        "stale_ttl_seconds": CACHE_STALE_TTL,
+        "negative_ttl_seconds": CACHE_NEGATIVE_TTL,
+        "l1_ttl_seconds": cache.l1_ttl,
+        "tiers": cache.stats(),
+        "media": media_cache.stats(),
+        "warm": cache_warmer.stats(),
+        "prefetch": next_episode_prefetcher.stats(),
+        "keys": cache.l1.keys()
     }
 
+class CacheWarmRequest(BaseModel):
+    anime_ids: Optional[List[int]] = Field(None, max_length=WARM_MAX_RELEASES)
+
+def check_admin_access(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin operations are disabled")
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.post("/cache/warm")
+@limiter.limit("5/minute")
+async def warm_cache(request: Request, body: Optional[CacheWarmRequest] = None):
+    """Прогрев кэша: переданные ID или, без них, лента свежих релизов и популярные аниме"""
+    # Один запрос порождает сотни резолвов - только с токеном и под лимитом
+    check_admin_access(request)
+    anime_ids = body.anime_ids if body is not None else None
+    return await cache_warmer.warm(anime_ids, trigger="manual")
+
 @app.delete("/cache/clear")
-def clear_cache():
-    """Очистка кэша"""
-    cache.cache.clear()
+async def clear_cache(request: Request):
+    """Очистка кэша (L1 текущего воркера, общий L2 и дисковый кэш медиа)"""
+    check_admin_access(request)
+    await cache.clear()
+    await media_cache.clear()
     return {"message": "Cache cleared successfully"}
 
-# Запуск сервера метрик Prometheus на отдельном порту
+# Диагностика воркера: снимок ресурсов, стеки, профилирование. Каждый запрос
+# обслуживает один воркер uvicorn - данные относятся к нему (pid в ответе)
+profile_lock = asyncio.Lock()
+
+def check_debug_access(request: Request):
+    if not DEBUG_ENDPOINTS_ENABLED or not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("X-Debug-Token", ""), DEBUG_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid debug token")
+
+@app.get("/debug/runtime")
+async def debug_runtime(request: Request):
+    """Задержка event loop, задачи, соединения, потоки и память воркера"""
+    check_debug_access(request)
+    return {
+        "pid": os.getpid(),
+        "event_loop": loop_monitor.stats(),
+        "asyncio_tasks": len(asyncio.all_tasks()),
+        "threads": threading.active_count(),
+        "upstream_pool": upstream_pool.stats(),
+        "media_pool": media_pool.stats(),
+        "anicli_executor": anicli_executor.stats(),
+        "streams_active": stream_state["active"],
+        "stream_bytes_in_flight": stream_state["bytes_in_flight"],
+        "memory": {
+            "rss_bytes": process_rss_bytes(),
+            "cache_l1_bytes": cache.l1.bytes,
+            "cache_l1_entries": len(cache.l1),
+            "media_cache_bytes": media_cache.total_bytes
+        }
+    }
+
+@app.get("/debug/stacks")
+async def debug_stacks(request: Request, tasks: bool = Query(True), limit: int = Query(20, ge=1, le=200)):
+    """Стеки всех потоков и (с tasks=true) всех asyncio задач воркера, текстом"""
+    check_debug_access(request)
+    out = io.StringIO()
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for thread_id, frame in sys._current_frames().items():
+        out.write(f"Thread {thread_names.get(thread_id, '?')} ({thread_id}):\n")
+        out.write("".join(traceback.format_stack(frame, limit=limit)))
+        out.write("\n")
+    if tasks:
+        for task in asyncio.all_tasks():
+            task.print_stack(limit=limit, file=out)
+            out.write("\n")
+    return PlainTextResponse(out.getvalue())
+
+@app.post("/debug/profile")
+async def debug_profile(
+    request: Request,
+    seconds: float = Query(5.0, gt=0),
+    sort: str = Query("cumulative", pattern="^(cumulative|tottime|ncalls)$"),
+    limit: int = Query(50, ge=1, le=500)
+):
+    """cProfile потока event loop в течение seconds секунд; отчёт pstats текстом.
+
+    Профилируется всё, что выполняется в loop за это окно (все запросы воркера),
+    но не потоки пула AnimeGo. Одновременно идёт только одно профилирование.
+    """
+    check_debug_access(request)
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="Profiling is already running")
+    seconds = min(seconds, PROFILE_MAX_SECONDS)
+    async with profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+    out = io.StringIO()
+    out.write(f"Profiled event loop of pid {os.getpid()} for {seconds:.1f}s\n")
+    pstats.Stats(profiler, stream=out).sort_stats(sort).print_stats(limit)
+    return PlainTextResponse(out.getvalue())
+
+# Запуск сервера метрик Prometheus на отдельном порту. Порт занимает первый
+# воркер; в режиме нескольких процессов он отдаёт агрегат по всем воркерам
 def start_metrics_server():
+    if not ENABLE_METRICS or METRICS_PORT <= 0:
+        return
     try:
-        start_http_server(8001)
-        logger.info("Prometheus metrics server started on port 8001")
+        start_http_server(METRICS_PORT, registry=metrics_registry())
+        logger.info("Prometheus metrics server started on port %s", METRICS_PORT)
+    except OSError as e:
+        logger.info("Metrics port %s is served by another worker: %s", METRICS_PORT, e)
     except Exception as e:
-        logger.error(f"Failed to start metrics server: {e}")
+        logger.error("Failed to start metrics server: %s", e)
 
 # Периодическая очистка кэша
 async def cache_cleanup_task():
     while True:
-        await asyncio.sleep(300)  # Каждые 5 минут
-        cache.clear_expired()
-        logger.info(f"Cache cleanup completed. Current size: {len(cache.cache)}")
+        await asyncio.sleep(CACHE_CLEANUP_INTERVAL)  # По умолчанию каждые 5 минут
+        expired = cache.l1.clear_expired()
+        if MEDIA_CACHE_ENABLED:
+            await media_cache.rescan()
+        logger.info("Cache cleanup completed. Expired: %s, current size: %s", expired, len(cache.l1))
 
 @app.on_event("startup")
 async def startup_event():
     """Инициализация при запуске"""
     logger.info("Starting AnidLapi Service...")
     start_metrics_server()
+    await upstream_pool.start()
+    await media_pool.start()
+    await cache.connect()
+    if MEDIA_CACHE_ENABLED:
+        await media_cache.rescan()
     # Запускаем задачу очистки кэша
     asyncio.create_task(cache_cleanup_task())
+    asyncio.create_task(metrics_refresh_task())
+    # Прогрев свежих и популярных релизов
+    cache_warmer.start()
+    tracer.start()
+    loop_monitor.start()
+    if DEBUG_ENDPOINTS_ENABLED and not DEBUG_TOKEN:
+        logger.warning("DEBUG_ENDPOINTS_ENABLED is set without DEBUG_TOKEN, /debug/* endpoints stay disabled")
     logger.info("AnidLapi Service started successfully")
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Очистка при завершении"""
     logger.info("Shutting down AnidLapi Service...")
-    cache.cache.clear()
+    await cache_warmer.stop()
+    await tracer.stop()
+    await loop_monitor.stop()
+    cache.l1.clear()
+    await cache.close()
+    await upstream_pool.close()
+    await media_pool.close()
+    anicli_executor.shutdown()
+    rate_limit_executor.shutdown(wait=False)
+    if PROMETHEUS_MULTIPROC_DIR:
+        # live-gauge завершённого воркера больше не попадают в агрегат
+        multiprocess.mark_process_dead(os.getpid())
     logger.info("AnidLapi Service shutdown completed")
 
 if __name__ == "__main__":
@@ -533,5 +3865,7 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=8000,
         reload=True,
-        log_level="info"
+        log_level="info",
+        # Логирование настраивает configure_logging, а не dictConfig uvicorn
+        log_config=None
     )
\ No newline at end of file
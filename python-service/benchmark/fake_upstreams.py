@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Локальные заглушки внешних сервисов для нагрузочного теста python-service:
+Aniliberty API v1, старый Anilibria API v3 и источник медиа (mp4 и HLS).
+
+Задержка, доля ошибок и полоса пропускания настраиваются отдельно для API и медиа.
+Чётные anime_id отдаются как HLS, нечётные - как mp4; ID больше --anime не существуют (404).
+
+Запуск отдельно (для сервиса, поднятого вручную):
+    python benchmark/fake_upstreams.py --port 18701 --api-latency 0.05
+"""
+
+import argparse
+import asyncio
+import random
+from typing import Dict, Optional
+
+from aiohttp import web
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UpstreamProfile:
+    """Поведение группы маршрутов: задержка ответа, доля ошибок и полоса на один ответ"""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, bandwidth: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.bandwidth = bandwidth  # байт/с на ответ, 0 - без ограничения
+
+    async def delay(self):
+        latency = self.latency + random.uniform(0, self.jitter) if self.jitter else self.latency
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def failed(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+    def as_dict(self) -> Dict[str, float]:
+        return {"latency": self.latency, "jitter": self.jitter, "error_rate": self.error_rate, "bandwidth": self.bandwidth}
+
+
+class FakeUpstreams:
+    """aiohttp-приложение со всеми заглушками на одном порту"""
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 18701,
+        api: Optional[UpstreamProfile] = None,
+        media: Optional[UpstreamProfile] = None,
+        anime_count: int = 200,
+        episodes: int = 12,
+        media_size: int = 2 * 1024 * 1024,
+        hls_segments: int = 6,
+        segment_size: int = 512 * 1024
+    ):
+        self.host = host
+        self.port = port
+        self.api = api or UpstreamProfile()
+        self.media = media or UpstreamProfile()
+        self.anime_count = anime_count
+        self.episodes = episodes
+        self.media_payload = bytes(range(256)) * (media_size // 256 + 1)
+        self.media_payload = self.media_payload[:media_size]
+        self.hls_segments = hls_segments
+        self.segment_payload = b"G" * segment_size
+        self.calls: Dict[str, int] = {}
+        self.runner: Optional[web.AppRunner] = None
+
+    @property
+    def origin(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def count(self, route: str):
+        self.calls[route] = self.calls.get(route, 0) + 1
+
+    def exists(self, anime_id: int) -> bool:
+        return 1 <= anime_id <= self.anime_count
+
+    def episode_urls(self, anime_id: int, episode: int) -> Dict[str, str]:
+        """Ссылки на качества эпизода: HLS для чётных ID, mp4 для нечётных"""
+        if anime_id % 2 == 0:
+            return {quality: f"{self.origin}/hls/{anime_id}/{episode}/{quality}/master.m3u8" for quality in ("fhd", "hd", "sd")}
+        return {quality: f"{self.origin}/media/{anime_id}/{episode}/{quality}.mp4" for quality in ("fhd", "hd", "sd")}
+
+    def release(self, anime_id: int) -> dict:
+        """Релиз в формате Aniliberty API v1"""
+        episodes = []
+        for number in range(1, self.episodes + 1):
+            urls = self.episode_urls(anime_id, number)
+            episodes.append({
+                "ordinal": number,
+                "hls_1080": urls["fhd"],
+                "hls_720": urls["hd"],
+                "hls_480": urls["sd"]
+            })
+        return {
+            "id": anime_id,
+            "name": {"main": f"Benchmark {anime_id}"},
+            "episodes": episodes,
+            "members": [{"role": {"value": "voicing"}, "nickname": "Bench"}]
+        }
+
+    def title(self, anime_id: int) -> dict:
+        """Тайтл в формате старого Anilibria API v3"""
+        player_list = {
+            str(number): {"episode": number, "hls": self.episode_urls(anime_id, number)}
+            for number in range(1, self.episodes + 1)
+        }
+        return {"id": anime_id, "player": {"list": player_list}, "team": {"voice": ["Bench"]}}
+
+    async def api_response(self, route: str, payload_factory) -> web.Response:
+        self.count(route)
+        await self.api.delay()
+        if self.api.failed():
+            return web.json_response({"error": "injected failure"}, status=503)
+        payload = payload_factory()
+        if payload is None:
+            return web.json_response({"error": "not found"}, status=404)
+        return web.json_response(payload)
+
+    async def handle_release(self, request: web.Request) -> web.Response:
+        anime_id = int(request.match_info["anime_id"])
+        return await self.api_response("aniliberty_release", lambda: self.release(anime_id) if self.exists(anime_id) else None)
+
+    async def handle_catalog(self, request: web.Request) -> web.Response:
+        return await self.api_response("aniliberty_catalog", lambda: {"data": []})
+
+    async def handle_latest(self, request: web.Request) -> web.Response:
+        return await self.api_response("aniliberty_latest", lambda: [])
+
+    async def handle_schedule(self, request: web.Request) -> web.Response:
+        return await self.api_response("aniliberty_schedule", lambda: {"today": [], "yesterday": []})
+
+    async def handle_title(self, request: web.Request) -> web.Response:
+        anime_id = int(request.query.get("id", "0"))
+        return await self.api_response("anilibria_title", lambda: self.title(anime_id) if self.exists(anime_id) else None)
+
+    async def send_bytes(self, request: web.Request, payload: bytes, content_type: str) -> web.StreamResponse:
+        """Отдаёт payload с поддержкой Range, If-Range, If-None-Match и ограничением полосы"""
+        start, end, status = 0, len(payload) - 1, 200
+        etag = f'"{len(payload)}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        range_header = request.headers.get("Range")
+        # If-Range с чужим ETag: объект изменился, отдаём его целиком
+        if request.headers.get("If-Range", etag) != etag:
+            range_header = None
+        if range_header and range_header.startswith("bytes="):
+            first, _, last = range_header[6:].partition("-")
+            start = int(first) if first else 0
+            end = min(int(last), end) if last else end
+            if start > end:
+                return web.Response(status=416, headers={"Content-Range": f"bytes */{len(payload)}"})
+            status = 206
+
+        response = web.StreamResponse(status=status, headers={
+            "Content-Type": content_type,
+            "Content-Length": str(end - start + 1),
+            "Accept-Ranges": "bytes",
+            "ETag": etag
+        })
+        if status == 206:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{len(payload)}"
+        await response.prepare(request)
+        view = memoryview(payload)[start:end + 1]
+        for offset in range(0, len(view), CHUNK_SIZE):
+            chunk = view[offset:offset + CHUNK_SIZE]
+            await response.write(chunk)
+            if self.media.bandwidth > 0:
+                await asyncio.sleep(len(chunk) / self.media.bandwidth)
+        await response.write_eof()
+        return response
+
+    async def handle_media(self, request: web.Request) -> web.StreamResponse:
+        self.count("media")
+        await self.media.delay()
+        if self.media.failed():
+            return web.Response(status=502, text="injected failure")
+        return await self.send_bytes(request, self.media_payload, "video/mp4")
+
+    async def handle_hls(self, request: web.Request) -> web.StreamResponse:
+        name = request.match_info["name"]
+        await self.media.delay()
+        if self.media.failed():
+            self.count("hls_error")
+            return web.Response(status=502, text="injected failure")
+        if name == "master.m3u8":
+            self.count("hls_master")
+            text = "#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=2500000,RESOLUTION=1280x720\nindex.m3u8\n"
+            return web.Response(text=text, content_type="application/vnd.apple.mpegurl")
+        if name == "index.m3u8":
+            self.count("hls_playlist")
+            lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:6", "#EXT-X-MEDIA-SEQUENCE:0"]
+            for index in range(self.hls_segments):
+                lines += ["#EXTINF:6.0,", f"seg{index}.ts"]
+            lines.append("#EXT-X-ENDLIST")
+            return web.Response(text="\n".join(lines) + "\n", content_type="application/vnd.apple.mpegurl")
+        self.count("hls_segment")
+        return await self.send_bytes(request, self.segment_payload, "video/mp2t")
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.calls)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get(r"/api/v1/anime/releases/{anime_id:\d+}", self.handle_release)
+        app.router.add_get("/api/v1/anime/releases/latest", self.handle_latest)
+        app.router.add_get("/api/v1/anime/schedule/now", self.handle_schedule)
+        app.router.add_post("/api/v1/anime/catalog/releases", self.handle_catalog)
+        app.router.add_get("/v3/title", self.handle_title)
+        app.router.add_get("/media/{path:.*}", self.handle_media)
+        app.router.add_get("/hls/{anime_id}/{episode}/{quality}/{name}", self.handle_hls)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    async def start(self):
+        self.runner = web.AppRunner(self.make_app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """Общие аргументы заглушек для этого скрипта и run_benchmark.py"""
+    parser.add_argument("--anime", type=int, default=200, help="Сколько релизов существует (ID 1..N)")
+    parser.add_argument("--episodes", type=int, default=12, help="Эпизодов в каждом релизе")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Задержка ответа API, сек")
+    parser.add_argument("--api-jitter", type=float, default=0.02, help="Случайная добавка к задержке API, сек")
+    parser.add_argument("--api-error-rate", type=float, default=0.0, help="Доля ответов API с 503")
+    parser.add_argument("--media-latency", type=float, default=0.01, help="Задержка первого байта медиа, сек")
+    parser.add_argument("--media-error-rate", type=float, default=0.0, help="Доля ответов медиа с 502")
+    parser.add_argument("--media-bandwidth", type=float, default=0.0, help="Полоса на один медиа-ответ, МБ/с (0 - без ограничения)")
+    parser.add_argument("--media-size", type=int, default=2 * 1024 * 1024, help="Размер mp4 эпизода, байт")
+    parser.add_argument("--hls-segments", type=int, default=6, help="Сегментов в HLS плейлисте")
+    parser.add_argument("--segment-size", type=int, default=512 * 1024, help="Размер HLS сегмента, байт")
+
+
+def upstreams_from_args(args: argparse.Namespace, host: str, port: int) -> FakeUpstreams:
+    return FakeUpstreams(
+        host=host,
+        port=port,
+        api=UpstreamProfile(args.api_latency, args.api_jitter, args.api_error_rate),
+        media=UpstreamProfile(args.media_latency, 0.0, args.media_error_rate, args.media_bandwidth * 1024 * 1024),
+        anime_count=args.anime,
+        episodes=args.episodes,
+        media_size=args.media_size,
+        hls_segments=args.hls_segments,
+        segment_size=args.segment_size
+    )
+
+
+async def serve_forever(upstreams: FakeUpstreams):
+    await upstreams.start()
+    print(f"Fake upstreams listening on {upstreams.origin}")
+    print(f"  ANILIBERTY_API_URLS={upstreams.origin}/api/v1")
+    print(f"  ANILIBRIA_API_URL={upstreams.origin}/v3")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await upstreams.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Aniliberty/Anilibria APIs and media origin for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18701)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve_forever(upstreams_from_args(args, args.host, args.port)))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест python-service без внешней сети.
+
+Поднимает заглушки внешних API и источника медиа (fake_upstreams.py), запускает
+сервис через uvicorn с адресами заглушек и гоняет сценарии /health, /qualities,
+/video (mp4) и HLS (/video + плейлисты и сегменты через /hls) с заданной
+конкурентностью. Для каждого сценария считает RPS, p50/p95/p99, долю попаданий
+в кэш и скорость отдачи медиа; результат сохраняется в JSON и может сравниваться
+с предыдущим прогоном.
+
+Примеры:
+    python benchmark/run_benchmark.py --concurrency 32 --duration 20 --output bench.json
+    python benchmark/run_benchmark.py --scenarios qualities,video --baseline bench.json --fail-on-regression 15
+    python benchmark/run_benchmark.py --workers 4 --env CACHE_L1_TTL=0 --media-bandwidth 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+import aiohttp
+
+from fake_upstreams import FakeUpstreams, add_profile_arguments, upstreams_from_args
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("health", "qualities", "video", "hls")
+METRIC_LINE = re.compile(r'^(?P<name>[a-zA-Z_:][\w:]*)(?:\{(?P<labels>[^}]*)\})?\s+(?P<value>\S+)$')
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Перцентиль методом ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    """Сводка задержек в миллисекундах"""
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0, "max": 0.0}
+    return {
+        "p50": round(percentile(values, 50) * 1000, 2),
+        "p95": round(percentile(values, 95) * 1000, 2),
+        "p99": round(percentile(values, 99) * 1000, 2),
+        "mean": round(sum(values) / len(values) * 1000, 2),
+        "max": round(max(values) * 1000, 2)
+    }
+
+
+def parse_metrics(text: str) -> Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float]:
+    """Разбор text exposition Prometheus: (имя, метки) -> значение"""
+    samples = {}
+    for line in text.splitlines():
+        match = METRIC_LINE.match(line)
+        if not match:
+            continue
+        labels = tuple(sorted(re.findall(r'(\w+)="([^"]*)"', match.group("labels") or "")))
+        try:
+            samples[(match.group("name"), labels)] = float(match.group("value"))
+        except ValueError:
+            continue
+    return samples
+
+
+def metric_delta(before: Dict, after: Dict, name: str, **labels: str) -> float:
+    """Прирост суммы серий метрики name, у которых совпадают переданные метки"""
+    def total(samples: Dict) -> float:
+        return sum(
+            value for (sample_name, sample_labels), value in samples.items()
+            if sample_name == name and all((key, expected) in sample_labels for key, expected in labels.items())
+        )
+    return total(after) - total(before)
+
+
+def ratio(hits: float, total: float) -> Optional[float]:
+    return round(hits / total, 4) if total > 0 else None
+
+
+class KeyPicker:
+    """Выбор (anime_id, episode) с распределением Ципфа: немного популярных релизов и длинный хвост"""
+
+    def __init__(self, anime_count: int, episodes: int, skew: float, missing_rate: float, seed: int):
+        self.random = random.Random(seed)
+        self.anime_count = anime_count
+        self.episodes = episodes
+        self.missing_rate = missing_rate
+        weights = [1 / rank ** skew for rank in range(1, anime_count + 1)]
+        self.ids = list(range(1, anime_count + 1))
+        self.random.shuffle(self.ids)
+        total = sum(weights)
+        self.cumulative = []
+        acc = 0.0
+        for weight in weights:
+            acc += weight / total
+            self.cumulative.append(acc)
+
+    def pick(self, parity: Optional[int] = None) -> Tuple[int, int]:
+        if self.missing_rate and self.random.random() < self.missing_rate:
+            return self.anime_count + 1 + self.random.randrange(1000) * 2 + (parity or 0), 1
+        while True:
+            point = self.random.random()
+            low, high = 0, len(self.cumulative) - 1
+            while low < high:
+                middle = (low + high) // 2
+                if self.cumulative[middle] < point:
+                    low = middle + 1
+                else:
+                    high = middle
+            anime_id = self.ids[low]
+            if parity is None or anime_id % 2 == parity:
+                return anime_id, self.random.randint(1, self.episodes)
+
+
+class ScenarioStats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.ttfb: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.bytes = 0
+        self.errors = 0
+
+    def record(self, status: Any, latency: float, ttfb: float, size: int):
+        key = str(status)
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        self.latencies.append(latency)
+        self.ttfb.append(ttfb)
+        self.bytes += size
+        if not isinstance(status, int) or status >= 500 or status in (0, 429):
+            self.errors += 1
+
+
+async def fetch(session: aiohttp.ClientSession, url: str, stats: ScenarioStats, timeout: float) -> Tuple[int, bytes]:
+    """GET с учётом задержки до первого байта и полной загрузки тела"""
+    started_at = time.perf_counter()
+    try:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout), allow_redirects=False) as response:
+            ttfb = time.perf_counter() - started_at
+            body = await response.read()
+            stats.record(response.status, time.perf_counter() - started_at, ttfb, len(body))
+            return response.status, body
+    except asyncio.TimeoutError:
+        elapsed = time.perf_counter() - started_at
+        stats.record("timeout", elapsed, elapsed, 0)
+    except aiohttp.ClientError as e:
+        elapsed = time.perf_counter() - started_at
+        stats.record(type(e).__name__, elapsed, elapsed, 0)
+    return 0, b""
+
+
+def playlist_uris(text: str) -> List[str]:
+    return [line.strip() for line in text.splitlines() if line.strip() and not line.startswith("#")]
+
+
+def make_request(scenario: str, base_url: str, picker: KeyPicker, args: argparse.Namespace) -> Callable:
+    """Корутина одного 'действия' пользователя в сценарии"""
+    async def health(session, stats):
+        await fetch(session, f"{base_url}/health", stats, args.timeout)
+
+    async def qualities(session, stats):
+        anime_id, episode = picker.pick()
+        await fetch(session, f"{base_url}/qualities?anime_id={anime_id}&episode={episode}", stats, args.timeout)
+
+    async def video(session, stats):
+        anime_id, episode = picker.pick(parity=1)
+        await fetch(session, f"{base_url}/video?anime_id={anime_id}&episode={episode}", stats, args.timeout)
+
+    async def hls(session, stats):
+        # Мастер-плейлист, плейлист первого варианта и первые --hls-fetch-segments сегментов
+        anime_id, episode = picker.pick(parity=0)
+        url = f"{base_url}/video?anime_id={anime_id}&episode={episode}"
+        status, body = await fetch(session, url, stats, args.timeout)
+        if status != 200:
+            return
+        variants = playlist_uris(body.decode(errors="replace"))
+        if not variants:
+            return
+        url = urljoin(url, variants[0])
+        status, body = await fetch(session, url, stats, args.timeout)
+        if status != 200:
+            return
+        for segment in playlist_uris(body.decode(errors="replace"))[:args.hls_fetch_segments]:
+            await fetch(session, urljoin(url, segment), stats, args.timeout)
+
+    return {"health": health, "qualities": qualities, "video": video, "hls": hls}[scenario]
+
+
+async def run_scenario(scenario: str, base_url: str, upstreams: FakeUpstreams, args: argparse.Namespace) -> Dict[str, Any]:
+    picker = KeyPicker(args.anime, args.episodes, args.skew, args.missing_rate, args.seed)
+    action = make_request(scenario, base_url, picker, args)
+    stats = ScenarioStats()
+    connector = aiohttp.TCPConnector(limit=args.concurrency, force_close=False)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        metrics_before = await scrape_metrics(session, base_url)
+        upstream_before = dict(upstreams.calls)
+        started_at = time.perf_counter()
+        deadline = started_at + args.duration
+        issued = 0
+
+        async def user():
+            nonlocal issued
+            while time.perf_counter() < deadline and (not args.requests or issued < args.requests):
+                issued += 1
+                await action(session, stats)
+
+        await asyncio.gather(*(user() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started_at
+        metrics_after = await scrape_metrics(session, base_url)
+
+    resolved_hits = sum(
+        metric_delta(metrics_before, metrics_after, "anidlapi_resolved_cache_lookups_total", result=result)
+        for result in ("fresh", "stale", "negative")
+    )
+    resolved_total = resolved_hits + metric_delta(metrics_before, metrics_after, "anidlapi_resolved_cache_lookups_total", result="miss")
+    media_hits = metric_delta(metrics_before, metrics_after, "anidlapi_media_cache_requests_total", result="hit")
+    media_total = metric_delta(metrics_before, metrics_after, "anidlapi_media_cache_requests_total")
+    upstream_calls = {
+        route: count - upstream_before.get(route, 0)
+        for route, count in upstreams.calls.items() if count - upstream_before.get(route, 0)
+    }
+    return {
+        "requests": len(stats.latencies),
+        "errors": stats.errors,
+        "error_rate": ratio(stats.errors, len(stats.latencies)) or 0.0,
+        "statuses": stats.statuses,
+        "duration_seconds": round(elapsed, 3),
+        "rps": round(len(stats.latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": latency_summary(stats.latencies),
+        "ttfb_ms": latency_summary(stats.ttfb),
+        "bytes": stats.bytes,
+        "mb_per_second": round(stats.bytes / elapsed / 1024 / 1024, 3) if elapsed else 0.0,
+        "cache_hit_ratio": ratio(resolved_hits, resolved_total),
+        "media_cache_hit_ratio": ratio(media_hits, media_total),
+        "upstream_calls": upstream_calls
+    }
+
+
+async def scrape_metrics(session: aiohttp.ClientSession, base_url: str) -> Dict:
+    try:
+        async with session.get(f"{base_url}/metrics", timeout=aiohttp.ClientTimeout(total=10)) as response:
+            return parse_metrics(await response.text()) if response.status == 200 else {}
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return {}
+
+
+def service_env(args: argparse.Namespace, upstreams: FakeUpstreams, workdir: str) -> Dict[str, str]:
+    """Окружение сервиса: все провайдеры - заглушки, AnimeGo и фоновые задачи без сети отключены"""
+    env = {key: value for key, value in os.environ.items() if key != "REDIS_URL"}
+    env.update({
+        "ANILIBERTY_API_URLS": f"{upstreams.origin}/api/v1",
+        "ANILIBRIA_API_URL": f"{upstreams.origin}/v3",
+        "RESOLVE_PROVIDERS": "aniliberty,anilibria_old",
+        "HLS_ALLOWED_HOSTS": upstreams.host,
+        "RATE_LIMIT_ENABLED": "false",
+        "RATE_LIMIT_STORAGE_URI": "memory://",
+        "WARM_ENABLED": "false",
+        "ENABLE_METRICS": "false",
+        "MEDIA_CACHE_DIR": os.path.join(workdir, "media"),
+        "LOG_LEVEL": "warning"
+    })
+    if args.workers > 1:
+        env["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(workdir, "prometheus")
+        os.makedirs(env["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+    if args.redis_url:
+        env["REDIS_URL"] = args.redis_url
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+async def wait_healthy(base_url: str, process: Optional[subprocess.Popen], timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process is not None and process.poll() is not None:
+                raise RuntimeError(f"Service exited with code {process.returncode}")
+            try:
+                async with session.get(f"{base_url}/health", timeout=aiohttp.ClientTimeout(total=2)) as response:
+                    if response.status == 200:
+                        return
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Service at {base_url} did not become healthy in {timeout}s")
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Печатает разницу с базовым прогоном; возвращает регрессии сверх threshold процентов"""
+    regressions = []
+    print("\nComparison with baseline:")
+    for scenario, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(scenario)
+        if not previous:
+            continue
+        rps_change = (current["rps"] - previous["rps"]) / previous["rps"] * 100 if previous["rps"] else 0.0
+        p95_change = (
+            (current["latency_ms"]["p95"] - previous["latency_ms"]["p95"]) / previous["latency_ms"]["p95"] * 100
+            if previous["latency_ms"]["p95"] else 0.0
+        )
+        print(f"  {scenario:<10} rps {previous['rps']:>9.1f} -> {current['rps']:>9.1f} ({rps_change:+.1f}%)   "
+              f"p95 {previous['latency_ms']['p95']:>8.1f} -> {current['latency_ms']['p95']:>8.1f} ms ({p95_change:+.1f}%)")
+        if threshold and rps_change < -threshold:
+            regressions.append(f"{scenario}: rps {rps_change:+.1f}%")
+        if threshold and p95_change > threshold:
+            regressions.append(f"{scenario}: p95 {p95_change:+.1f}%")
+    return regressions
+
+
+def print_summary(name: str, result: Dict[str, Any]):
+    latency = result["latency_ms"]
+    hit_ratio = result["cache_hit_ratio"]
+    print(f"  {name:<10} {result['requests']:>7} req  {result['rps']:>9.1f} rps  "
+          f"p50 {latency['p50']:>8.1f}  p95 {latency['p95']:>8.1f}  p99 {latency['p99']:>8.1f} ms  "
+          f"err {result['error_rate'] * 100:>5.1f}%  "
+          f"cache {'-' if hit_ratio is None else f'{hit_ratio * 100:.1f}%':>6}  "
+          f"{result['mb_per_second']:>8.2f} MB/s")
+
+
+async def run(args: argparse.Namespace) -> int:
+    upstreams = upstreams_from_args(args, "127.0.0.1", args.upstream_port)
+    await upstreams.start()
+    process = None
+    base_url = args.service_url.rstrip("/") if args.service_url else f"http://127.0.0.1:{args.port}"
+    with tempfile.TemporaryDirectory(prefix="anidlapi-bench-") as workdir:
+        service_log = args.service_log or os.path.join(workdir, "service.log")
+        try:
+            if not args.service_url:
+                command = [
+                    sys.executable, "-m", "uvicorn", "anidLapi_service:app",
+                    "--host", "127.0.0.1", "--port", str(args.port),
+                    "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"
+                ]
+                with open(service_log, "ab") as log_file:
+                    process = subprocess.Popen(
+                        command, cwd=SERVICE_DIR, env=service_env(args, upstreams, workdir),
+                        stdout=log_file, stderr=subprocess.STDOUT
+                    )
+            try:
+                await wait_healthy(base_url, process)
+            except RuntimeError:
+                if process is not None:
+                    with open(service_log, encoding="utf-8", errors="replace") as log_file:
+                        print("".join(log_file.readlines()[-30:]), file=sys.stderr)
+                raise
+
+            results = {
+                "started_at": datetime.utcnow().isoformat(),
+                "config": {key: value for key, value in vars(args).items() if key not in ("baseline", "output")},
+                "upstream": {"api": upstreams.api.as_dict(), "media": upstreams.media.as_dict()},
+                "scenarios": {}
+            }
+            print(f"Benchmarking {base_url}: concurrency {args.concurrency}, {args.duration}s per scenario")
+            for scenario in args.scenarios:
+                result = await run_scenario(scenario, base_url, upstreams, args)
+                results["scenarios"][scenario] = result
+                print_summary(scenario, result)
+        finally:
+            if process is not None:
+                process.terminate()
+                try:
+                    process.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+            await upstreams.stop()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+        print(f"\nResults saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.fail_on_regression)
+        if regressions:
+            print("Regressions: " + "; ".join(regressions))
+            return 1
+    return 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load test for the AnidLapi python-service")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda value: [item.strip() for item in value.split(",") if item.strip()],
+                        help=f"Сценарии через запятую из {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=32, help="Одновременных виртуальных пользователей")
+    parser.add_argument("--duration", type=float, default=15.0, help="Длительность сценария, сек")
+    parser.add_argument("--requests", type=int, default=0, help="Ограничение числа действий на сценарий (0 - только по времени)")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Таймаут одного запроса, сек")
+    parser.add_argument("--skew", type=float, default=1.1, help="Параметр распределения Ципфа для популярности релизов")
+    parser.add_argument("--missing-rate", type=float, default=0.0, help="Доля запросов к несуществующим релизам")
+    parser.add_argument("--hls-fetch-segments", type=int, default=3, help="Сколько сегментов загружает HLS сценарий")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--port", type=int, default=18700, help="Порт запускаемого сервиса")
+    parser.add_argument("--upstream-port", type=int, default=18701, help="Порт заглушек")
+    parser.add_argument("--workers", type=int, default=1, help="Воркеров uvicorn")
+    parser.add_argument("--service-url", help="Не запускать сервис, а нагружать уже запущенный (его провайдеры должны смотреть на заглушки)")
+    parser.add_argument("--service-log", help="Куда писать вывод запущенного сервиса (по умолчанию во временный файл)")
+    parser.add_argument("--redis-url", help="Redis для L2 кэша сервиса (по умолчанию без Redis)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Дополнительные переменные окружения сервиса")
+    parser.add_argument("--output", help="Куда сохранить результаты (JSON)")
+    parser.add_argument("--baseline", help="JSON предыдущего прогона для сравнения")
+    parser.add_argument("--fail-on-regression", type=float, default=0.0, metavar="PCT",
+                        help="Код выхода 1, если RPS упал или p95 вырос больше чем на PCT процентов")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
@@ -0,0 +1,210 @@
+"""Общие настройки тестов: сервис импортируется без Redis и внешней сети.
+
+Тесты эндпоинтов ходят в локальные заглушки из benchmark/fake_upstreams.py.
+"""
+
+import asyncio
+import fnmatch
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+
+import httpx
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+
+from benchmark.fake_upstreams import FakeUpstreams, UpstreamProfile  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+UPSTREAM_PORT = free_port()
+UPSTREAM_ORIGIN = f"http://127.0.0.1:{UPSTREAM_PORT}"
+MEDIA_CACHE_DIR = tempfile.mkdtemp(prefix="anidlapi-tests-")
+
+# Настройки читаются при импорте модуля, поэтому задаются до него
+os.environ.pop("REDIS_URL", None)
+os.environ.update({
+    "ANILIBERTY_API_URLS": f"{UPSTREAM_ORIGIN}/api/v1",
+    "ANILIBRIA_API_URL": f"{UPSTREAM_ORIGIN}/v3",
+    "RESOLVE_PROVIDERS": "aniliberty,anilibria_old",
+    "HLS_ALLOWED_HOSTS": "libria.fun,127.0.0.1",
+    "RATE_LIMIT_STORAGE_URI": "memory://",
+    "MEDIA_CACHE_DIR": MEDIA_CACHE_DIR,
+    "WARM_ENABLED": "false",
+    "PREFETCH_ENABLED": "false",
+    "LOOP_MONITOR_ENABLED": "false",
+    "ENABLE_METRICS": "false",
+    "LOG_LEVEL": "warning",
+})
+
+import anidLapi_service as service  # noqa: E402
+
+
+class ServiceClient:
+    """Синхронный клиент сервиса в духе TestClient.
+
+    TestClient из starlette 0.27 несовместим с httpx>=0.28 из requirements.txt,
+    поэтому запросы идут через httpx.ASGITransport. Приложение и заглушки живут
+    в отдельном потоке со своим event loop - один на всю сессию, как у воркера.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="service-loop", daemon=True)
+        self.thread.start()
+        self.upstreams = FakeUpstreams(
+            port=UPSTREAM_PORT,
+            anime_count=10,
+            episodes=3,
+            media_size=256 * 1024,
+            hls_segments=2,
+            segment_size=16 * 1024
+        )
+        self.call(self.upstreams.start)
+        self.call(service.app.router.startup)
+        self.http = self.client()
+
+    def call(self, func, *args, **kwargs):
+        """Выполняет корутину func(*args, **kwargs) в потоке сервиса"""
+        return asyncio.run_coroutine_threadsafe(func(*args, **kwargs), self.loop).result(timeout=30)
+
+    def client(self, address=("127.0.0.1", 50000)) -> httpx.AsyncClient:
+        """HTTP-клиент, подключённый к приложению с адреса address"""
+        transport = httpx.ASGITransport(app=service.app, client=address)
+        return httpx.AsyncClient(transport=transport, base_url="http://testserver")
+
+    def request(self, method: str, url: str, client: httpx.AsyncClient = None, **kwargs) -> httpx.Response:
+        return self.call((client or self.http).request, method, url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("DELETE", url, **kwargs)
+
+    async def reset(self):
+        """Чистые кэши, лимиты и счётчики заглушек перед тестом"""
+        await service.cache.clear()
+        await service.media_cache.clear()
+        service.limiter.reset()
+        self.upstreams.calls.clear()
+        self.upstreams.api = UpstreamProfile()
+        self.upstreams.media = UpstreamProfile()
+
+    async def cancel_tasks(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        self.call(self.http.aclose)
+        self.call(service.app.router.shutdown)
+        self.call(self.upstreams.stop)
+        self.call(self.cancel_tasks)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+        self.loop.close()
+
+
+class FakeRedis:
+    """Redis в памяти для L2 кэша и блокировок single-flight.
+
+    Из Lua-скриптов понимает только снятие блокировки SingleFlight. Исключение в
+    error бросает каждая команда, в eval_error - только eval.
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.error = None
+        self.eval_error = None
+
+    def _check(self):
+        if self.error is not None:
+            raise self.error
+
+    async def get(self, key):
+        self._check()
+        return self.data.get(key)
+
+    async def set(self, key, value, ex=None, px=None, nx=False):
+        self._check()
+        if nx and key in self.data:
+            return None
+        self.data[key] = value.encode() if isinstance(value, str) else value
+        return True
+
+    async def delete(self, *keys):
+        self._check()
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    async def exists(self, key):
+        self._check()
+        return int(key in self.data)
+
+    async def scan_iter(self, match="*", count=None):
+        self._check()
+        for key in list(self.data):
+            if fnmatch.fnmatchcase(key, match):
+                yield key
+
+    async def eval(self, script, numkeys, *args):
+        self._check()
+        if self.eval_error is not None:
+            raise self.eval_error
+        if script != service.SingleFlight.RELEASE_SCRIPT:
+            raise NotImplementedError("FakeRedis runs only the single-flight release script")
+        key, token = args
+        if self.data.get(key) == token.encode():
+            return await self.delete(key)
+        return 0
+
+
+@pytest.fixture
+def svc():
+    return service
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """Подключает FakeRedis как L2 общего кэша"""
+    redis = FakeRedis()
+    monkeypatch.setattr(service.cache, "redis", redis)
+    monkeypatch.setattr(service.cache, "redis_down_until", 0.0)
+    return redis
+
+
+@pytest.fixture(autouse=True)
+def fresh_provider_health():
+    """Реестр circuit breaker'ов глобальный - каждый тест начинает с чистого"""
+    service.provider_health.breakers.clear()
+    yield
+    service.provider_health.breakers.clear()
+
+
+@pytest.fixture(scope="session")
+def service_client():
+    client = ServiceClient()
+    yield client
+    client.close()
+    shutil.rmtree(MEDIA_CACHE_DIR, ignore_errors=True)
+
+
+@pytest.fixture
+def client(service_client):
+    """Клиент сервиса с чистыми кэшами, лимитами и заглушками"""
+    service_client.call(service_client.reset)
+    return service_client
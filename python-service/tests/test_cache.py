@@ -0,0 +1,229 @@
+"""Кэш резолвов: single-flight, L1 LRU/TTL, L2 и устаревшие записи"""
+
+import asyncio
+import json
+import time
+
+import pytest
+from redis.exceptions import ResponseError
+
+
+# SingleFlight (без Redis - только внутри воркера)
+
+@pytest.mark.asyncio
+async def test_single_flight_coalesces_concurrent_calls(svc):
+    single_flight = svc.SingleFlight(svc.cache)
+    calls = 0
+
+    async def resolver():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"url": "x"}
+
+    results = await asyncio.gather(*(single_flight.do("video_1_1", resolver) for _ in range(5)))
+
+    assert results == [{"url": "x"}] * 5
+    assert calls == 1
+    assert single_flight.inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_single_flight_survives_cancelled_waiter(svc):
+    single_flight = svc.SingleFlight(svc.cache)
+    release = asyncio.Event()
+
+    async def resolver():
+        await release.wait()
+        return "done"
+
+    first = asyncio.create_task(single_flight.do("video_1_1", resolver))
+    second = asyncio.create_task(single_flight.do("video_1_1", resolver))
+    await asyncio.sleep(0)
+    first.cancel()
+    release.set()
+
+    assert await second == "done"
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+
+@pytest.mark.asyncio
+async def test_single_flight_propagates_errors_and_forgets_key(svc):
+    single_flight = svc.SingleFlight(svc.cache)
+
+    async def resolver():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        await single_flight.do("video_1_1", resolver)
+    await asyncio.sleep(0)
+    assert single_flight.inflight == {}
+
+    async def recovered():
+        return "ok"
+
+    assert await single_flight.do("video_1_1", recovered) == "ok"
+
+
+# SingleFlight между воркерами: Redis-блокировка (FakeRedis)
+
+@pytest.mark.asyncio
+async def test_single_flight_releases_lock_without_script(svc, fake_redis):
+    fake_redis.eval_error = ResponseError("NOSCRIPT No matching script")
+    single_flight = svc.SingleFlight(svc.cache)
+
+    async def resolver():
+        return "ok"
+
+    assert await single_flight.do("video_1_1", resolver) == "ok"
+    # Блокировка снята GET + DEL, L2 остаётся включённым
+    assert fake_redis.data == {}
+    assert svc.cache.l2_client() is fake_redis
+
+
+@pytest.mark.asyncio
+async def test_single_flight_keeps_foreign_lock(svc, fake_redis):
+    fake_redis.eval_error = ResponseError("NOSCRIPT No matching script")
+    single_flight = svc.SingleFlight(svc.cache)
+    lock_key = f"{svc.REDIS_KEY_PREFIX}lock:video_1_1"
+
+    async def resolver():
+        # Наша блокировка истекла, её занял другой воркер
+        fake_redis.data[lock_key] = b"other-worker"
+        return "ok"
+
+    assert await single_flight.do("video_1_1", resolver) == "ok"
+    assert fake_redis.data[lock_key] == b"other-worker"
+
+
+@pytest.mark.asyncio
+async def test_single_flight_follower_wait_capped_by_resolve_budget(svc, fake_redis, monkeypatch):
+    monkeypatch.setattr(svc, "SINGLEFLIGHT_WAIT_TIMEOUT", 30)
+    monkeypatch.setattr(svc, "RESOLVE_BUDGET", 0.2)
+    # Блокировку держит воркер, который так и не запишет результат
+    fake_redis.data[f"{svc.REDIS_KEY_PREFIX}lock:video_1_1"] = b"stuck-worker"
+    single_flight = svc.SingleFlight(svc.cache)
+
+    async def resolver():
+        return "own"
+
+    started = time.monotonic()
+    assert await single_flight.do("video_1_1", resolver) == "own"
+    assert time.monotonic() - started < 1
+
+
+# LRUTTLCache
+
+def test_lru_ttl_cache_expires_entries(svc):
+    lru = svc.LRUTTLCache(ttl=3600)
+    lru.set("fresh", 1)
+    lru.set("expired", 2, ttl=0)
+
+    assert lru.get("fresh") == 1
+    assert lru.get("expired") is None
+    assert len(lru) == 1
+
+
+def test_lru_ttl_cache_evicts_least_recently_used(svc):
+    lru = svc.LRUTTLCache(ttl=3600, max_entries=2)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)
+
+    assert lru.keys() == ["a", "c"]
+    assert lru.get("b") is None
+
+
+def test_lru_ttl_cache_skips_values_over_byte_limit(svc):
+    lru = svc.LRUTTLCache(ttl=3600, max_bytes=svc.LRUTTLCache.ENTRY_OVERHEAD + 16)
+    lru.set("big", "x" * 1024)
+
+    assert lru.get("big") is None
+    assert lru.bytes == 0
+
+
+# ResolvedCache через эндпоинты: stale-while-revalidate и негативный кэш
+
+QUALITIES_URL = "/qualities?anime_id=3&episode=1"
+
+
+async def finish_revalidation(svc):
+    await asyncio.gather(*list(svc.resolved_cache.revalidating.values()))
+
+
+def test_stale_entry_served_and_revalidated(client, svc):
+    stale = {"fhd": "https://stale.example.com/3/1.mp4"}
+    client.call(svc.cache.set, "qualities_3_1", {"value": stale, "fresh_until": 0}, 300)
+
+    response = client.get(QUALITIES_URL)
+    assert response.status_code == 200
+    assert response.json()["qualities"] == stale
+
+    client.call(finish_revalidation, svc)
+    entry = client.call(svc.cache.get, "qualities_3_1")
+    assert entry["fresh_until"] > 0
+    assert entry["value"]["fhd"] == f"{client.upstreams.origin}/media/3/1/fhd.mp4"
+    assert client.get(QUALITIES_URL).json()["qualities"] == entry["value"]
+    assert client.upstreams.calls["aniliberty_release"] == 1
+
+
+def test_not_found_is_cached(client, svc):
+    assert client.get("/qualities?anime_id=99&episode=1").status_code == 404
+    calls = dict(client.upstreams.calls)
+    assert calls
+
+    assert client.get("/qualities?anime_id=99&episode=1").status_code == 404
+    assert client.upstreams.calls == calls
+    assert client.call(svc.cache.get, "qualities_99_1")["value"] is None
+
+
+def test_unavailable_providers_are_not_cached(client, svc):
+    client.upstreams.api.error_rate = 1.0
+    assert client.get(QUALITIES_URL).status_code == 503
+    assert client.call(svc.cache.get, "qualities_3_1") is None
+
+    client.upstreams.api.error_rate = 0.0
+    assert client.get(QUALITIES_URL).status_code == 200
+
+
+# L2 (Redis): недоступный или битый L2 не ломает ответы
+
+def test_l2_outage_degrades_to_l1(client, svc, fake_redis):
+    fake_redis.error = ConnectionError("redis is down")
+
+    response = client.get(QUALITIES_URL)
+    assert response.status_code == 200
+    assert response.json()["qualities"]["fhd"] == f"{client.upstreams.origin}/media/3/1/fhd.mp4"
+    assert svc.cache.l2_client() is None
+
+    # Повтор отвечает из L1, не дожидаясь Redis и не обращаясь к провайдерам
+    assert client.get(QUALITIES_URL).status_code == 200
+    assert client.upstreams.calls == {"aniliberty_release": 1}
+
+
+def test_corrupt_l2_entry_is_a_miss(client, svc, fake_redis):
+    key = svc.REDIS_KEY_PREFIX + "qualities_3_1"
+    fake_redis.data[key] = b'{"value": {"fhd": '
+
+    response = client.get(QUALITIES_URL)
+    assert response.status_code == 200
+    assert response.json()["qualities"]["fhd"] == f"{client.upstreams.origin}/media/3/1/fhd.mp4"
+    # Битая запись заменена свежим резолвом, L2 остаётся включённым
+    assert svc.cache.l2_client() is fake_redis
+    assert json.loads(fake_redis.data[key])["value"] == response.json()["qualities"]
+
+
+# DELETE /cache/clear - только с токеном администратора
+
+def test_cache_clear_requires_admin_token(client, svc, monkeypatch):
+    assert client.get(QUALITIES_URL).status_code == 200
+    assert client.delete("/cache/clear").status_code == 403
+
+    monkeypatch.setattr(svc, "ADMIN_TOKEN", "secret")
+    assert client.delete("/cache/clear", headers={"X-Admin-Token": "wrong"}).status_code == 403
+    assert client.call(svc.cache.get, "qualities_3_1") is not None
+
+    assert client.delete("/cache/clear", headers={"X-Admin-Token": "secret"}).status_code == 200
+    assert client.call(svc.cache.get, "qualities_3_1") is None
@@ -0,0 +1,18 @@
+"""Диагностика: доступ к /debug/*"""
+
+
+def test_debug_endpoints_disabled_without_token(client, svc, monkeypatch):
+    monkeypatch.setattr(svc, "DEBUG_ENDPOINTS_ENABLED", True)
+    monkeypatch.setattr(svc, "DEBUG_TOKEN", "")
+    assert client.get("/debug/runtime").status_code == 404
+
+
+def test_debug_endpoints_require_token(client, svc, monkeypatch):
+    monkeypatch.setattr(svc, "DEBUG_ENDPOINTS_ENABLED", True)
+    monkeypatch.setattr(svc, "DEBUG_TOKEN", "secret")
+    assert client.get("/debug/runtime").status_code == 403
+    assert client.get("/debug/runtime", headers={"X-Debug-Token": "wrong"}).status_code == 403
+
+    response = client.get("/debug/runtime", headers={"X-Debug-Token": "secret"})
+    assert response.status_code == 200
+    assert "pid" in response.json()
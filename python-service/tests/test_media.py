@@ -0,0 +1,160 @@
+"""Медиа: переписывание HLS плейлистов, разбор Range и проксирование /video"""
+
+import asyncio
+import os
+
+import pytest
+
+
+# rewrite_hls_playlist
+
+def test_rewrite_hls_playlist(svc):
+    base_url = "https://cache.libria.fun/videos/1/master.m3u8"
+    playlist = "\n".join([
+        "#EXTM3U",
+        '#EXT-X-KEY:METHOD=AES-128,URI="key.bin"',
+        "#EXTINF:10.0,",
+        "segment-1.ts",
+        "",
+        "https://evil.example.com/segment-2.ts",
+    ])
+
+    lines = svc.rewrite_hls_playlist(playlist, base_url, "../hls/").splitlines()
+
+    key_url = "https://cache.libria.fun/videos/1/key.bin"
+    segment_url = "https://cache.libria.fun/videos/1/segment-1.ts"
+    assert lines[0] == "#EXTM3U"
+    assert lines[1] == f'#EXT-X-KEY:METHOD=AES-128,URI="../hls/{svc.encode_hls_token(key_url)}/key.bin"'
+    assert lines[3] == f"../hls/{svc.encode_hls_token(segment_url)}/segment-1.ts"
+    assert lines[4] == ""
+    # Чужие хосты не проксируются
+    assert lines[5] == "https://evil.example.com/segment-2.ts"
+
+
+def test_hls_token_round_trip(svc):
+    url = "https://cache.libria.fun/videos/1/seg.ts?sign=abc"
+    assert svc.decode_hls_token(svc.encode_hls_token(url)) == url
+
+
+# parse_byte_range
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=500-", (500, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=1000-", None),
+    ("bytes=10-5", None),
+    ("bytes=-0", None),
+])
+def test_parse_byte_range(svc, header, expected):
+    assert svc.parse_byte_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["items=0-10", "bytes=0-1,5-6", "bytes=a-b"])
+def test_parse_byte_range_unsupported(svc, header):
+    with pytest.raises(ValueError):
+        svc.parse_byte_range(header, 1000)
+
+
+# /video: Range и условные заголовки проксируются к источнику
+
+VIDEO_URL = "/video?anime_id=1&episode=1"
+
+
+@pytest.fixture
+def no_media_cache(svc, monkeypatch):
+    monkeypatch.setattr(svc, "MEDIA_CACHE_ENABLED", False)
+
+
+def test_video_full_response(client, no_media_cache):
+    response = client.get(VIDEO_URL)
+    assert response.status_code == 200
+    assert response.content == client.upstreams.media_payload
+    assert response.headers["accept-ranges"] == "bytes"
+
+
+def test_video_range_returns_partial_content(client, no_media_cache):
+    payload = client.upstreams.media_payload
+    response = client.get(VIDEO_URL, headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 100-199/{len(payload)}"
+    assert response.content == payload[100:200]
+
+
+def test_video_if_range_with_stale_etag_returns_full_body(client, no_media_cache):
+    payload = client.upstreams.media_payload
+    response = client.get(VIDEO_URL, headers={"Range": "bytes=100-199", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.content == payload
+
+    etag = response.headers["etag"]
+    response = client.get(VIDEO_URL, headers={"Range": "bytes=100-199", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.content == payload[100:200]
+
+
+def test_video_if_none_match_returns_not_modified(client, no_media_cache):
+    etag = client.get(VIDEO_URL).headers["etag"]
+    response = client.get(VIDEO_URL, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+
+# /video: повторные запросы отдаются из дискового кэша
+
+def test_video_served_from_disk_cache(client, svc):
+    payload = client.upstreams.media_payload
+    assert client.get(VIDEO_URL).content == payload
+    assert client.upstreams.calls["media"] == 1
+    hits = svc.media_cache.hits
+
+    response = client.get(VIDEO_URL)
+    assert response.status_code == 200
+    assert response.content == payload
+    assert response.headers["etag"] == f'"{len(payload)}"'
+    assert svc.media_cache.hits == hits + 1
+
+    response = client.get(VIDEO_URL, headers={"Range": "bytes=-100"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes {len(payload) - 100}-{len(payload) - 1}/{len(payload)}"
+    assert response.content == payload[-100:]
+
+    etag = response.headers["etag"]
+    assert client.get(VIDEO_URL, headers={"If-None-Match": etag}).status_code == 304
+    response = client.get(VIDEO_URL, headers={"Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.content == payload
+    assert client.get(VIDEO_URL, headers={"Range": f"bytes={len(payload)}-"}).status_code == 416
+    # Источник больше не запрашивался
+    assert client.upstreams.calls["media"] == 1
+
+
+# Отключение клиента до первого куска: генератор тела не запускался
+
+def test_stream_cleaned_up_when_client_leaves_before_first_chunk(client, svc):
+    # Медленный источник: тело не успевает целиком осесть в буфере aiohttp
+    client.upstreams.media.bandwidth = 64 * 1024
+
+    async def disconnect_early():
+        url = f"{client.upstreams.origin}/media/1/1/fhd.mp4"
+        upstream_response = await svc.media_pool.get_session().get(url)
+        writer = svc.media_cache.writer_for(url, upstream_response)
+        response = svc.ProxyStreamingResponse(svc.UpstreamStream(upstream_response, "video", writer), media_type="video/mp4")
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            # Клиент уходит, пока отправляются заголовки
+            await asyncio.sleep(0.05)
+
+        await response({"type": "http"}, receive, send)
+        return upstream_response, writer
+
+    upstream_response, writer = client.call(disconnect_early)
+    assert upstream_response.closed
+    assert writer.key not in svc.media_cache.writing
+    assert writer.failed
+    assert not os.path.exists(writer.tmp_path)
@@ -0,0 +1,95 @@
+"""Лимиты: token bucket исходящих запросов и входящие лимиты эндпоинтов"""
+
+import pytest
+from redis.exceptions import ResponseError
+
+
+# TokenBucket
+
+def test_token_bucket_burst_then_wait(svc):
+    bucket = svc.TokenBucket(rate=10, burst=2)
+
+    assert bucket.reserve(max_wait=0) == 0
+    assert bucket.reserve(max_wait=0) == 0
+    assert bucket.reserve(max_wait=0) is None
+    # Следующий токен занимается наперёд: ждать около 1/rate
+    assert bucket.reserve(max_wait=1) == pytest.approx(0.1, abs=0.02)
+    assert bucket.reserve(max_wait=0.15) is None
+
+
+def test_token_bucket_refills(svc):
+    bucket = svc.TokenBucket(rate=10, burst=1)
+    assert bucket.reserve(max_wait=0) == 0
+    bucket.updated_at -= 0.1
+
+    assert bucket.reserve(max_wait=0) == 0
+
+
+
+# UpstreamRateLimiter: ведро воркера, если общее в Redis недоступно
+
+@pytest.mark.asyncio
+async def test_upstream_limiter_script_error_keeps_l2(svc, fake_redis):
+    fake_redis.eval_error = ResponseError("NOSCRIPT No matching script")
+    limiter = svc.UpstreamRateLimiter({"example.com": (10, 1)}, max_wait=0)
+
+    await limiter.acquire("example.com")
+    with pytest.raises(svc.UpstreamThrottledError):
+        await limiter.acquire("example.com")
+    assert svc.cache.l2_client() is fake_redis
+
+
+@pytest.mark.asyncio
+async def test_upstream_limiter_connection_error_disables_l2(svc, fake_redis):
+    fake_redis.error = ConnectionError("redis is down")
+    limiter = svc.UpstreamRateLimiter({"example.com": (10, 1)}, max_wait=0)
+
+    await limiter.acquire("example.com")
+    assert svc.cache.l2_client() is None
+
+# Входящие лимиты: POST /resolve - 30 запросов в минуту на клиента
+
+RESOLVE_BODY = {"items": [{"anime_id": 3, "episode": 1}]}
+
+
+def exhaust_resolve_limit(client, **kwargs):
+    statuses = [client.post("/resolve", json=RESOLVE_BODY, **kwargs).status_code for _ in range(30)]
+    assert statuses == [200] * 30
+
+
+def test_resolve_limit_returns_429(client):
+    exhaust_resolve_limit(client)
+    response = client.post("/resolve", json=RESOLVE_BODY)
+    assert response.status_code == 429
+    assert "30 per 1 minute" in response.json()["error"]
+
+
+def test_forwarded_clients_get_own_buckets_behind_trusted_proxy(client):
+    # Запросы идут с 127.0.0.1 - доверенного прокси по умолчанию
+    exhaust_resolve_limit(client, headers={"X-Forwarded-For": "198.51.100.1"})
+    assert client.post("/resolve", json=RESOLVE_BODY, headers={"X-Forwarded-For": "198.51.100.1"}).status_code == 429
+    # Адрес клиента берётся справа налево до первого недоверенного хопа
+    headers = {"X-Forwarded-For": "198.51.100.1, 198.51.100.2, 127.0.0.1"}
+    assert client.post("/resolve", json=RESOLVE_BODY, headers=headers).status_code == 200
+
+
+def test_forwarded_header_ignored_from_untrusted_peer(client):
+    untrusted = client.client(address=("203.0.113.9", 50000))
+    try:
+        for number in range(30):
+            headers = {"X-Forwarded-For": f"198.51.100.{number}"}
+            assert client.post("/resolve", json=RESOLVE_BODY, headers=headers, client=untrusted).status_code == 200
+        headers = {"X-Forwarded-For": "198.51.100.200"}
+        assert client.post("/resolve", json=RESOLVE_BODY, headers=headers, client=untrusted).status_code == 429
+    finally:
+        client.call(untrusted.aclose)
+
+
+def test_route_limit_checker_finds_limited_endpoints(svc):
+    # Сторож внутренностей slowapi, на которые опирается RouteLimitChecker
+    def request(method, path):
+        return svc.Request({"type": "http", "method": method, "path": path, "root_path": "", "query_string": b"", "headers": []})
+
+    assert svc.route_limit_checker.handler_for(request("POST", "/resolve")) is svc.resolve_episodes
+    assert svc.route_limit_checker.handler_for(request("GET", "/releases/1/episodes")) is svc.get_release_episodes
+    assert svc.route_limit_checker.handler_for(request("GET", "/health")) is None
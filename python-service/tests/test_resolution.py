@@ -0,0 +1,265 @@
+"""Опрос провайдеров: first_successful и circuit breaker"""
+
+import asyncio
+
+import pytest
+
+
+def result_after(delay, value, calls=None, name=None):
+    async def attempt():
+        if calls is not None:
+            calls.append(name)
+        await asyncio.sleep(delay)
+        return value
+    return attempt
+
+
+def failing(calls=None, name=None):
+    async def attempt():
+        if calls is not None:
+            calls.append(name)
+        raise RuntimeError("upstream is down")
+    return attempt
+
+
+def run(svc, attempts, strategy="race", hedge_delay=1.0, budget=5.0, **options):
+    return svc.first_successful(
+        attempts, scope="test", strategy=strategy, hedge_delay=hedge_delay,
+        timeouts={}, budget=budget, **options
+    )
+
+
+# first_successful
+
+@pytest.mark.asyncio
+async def test_winner_cancels_losers(svc):
+    cancelled = asyncio.Event()
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        return "slow"
+
+    name, result = await run(svc, [("slow", slow), ("fast", result_after(0.01, "fast"))])
+
+    assert (name, result) == ("fast", "fast")
+    await asyncio.wait_for(cancelled.wait(), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_sequential_skips_empty_result(svc):
+    calls = []
+    name, result = await run(svc, [
+        ("empty", result_after(0, None, calls, "empty")),
+        ("full", result_after(0, {"url": "x"}, calls, "full")),
+    ], strategy="sequential")
+
+    assert (name, result) == ("full", {"url": "x"})
+    assert calls == ["empty", "full"]
+
+
+@pytest.mark.asyncio
+async def test_hedged_starts_next_after_delay(svc):
+    calls = []
+    name, _ = await run(svc, [
+        ("slow", result_after(1, "slow", calls, "slow")),
+        ("hedge", result_after(0, "hedge", calls, "hedge")),
+    ], strategy="hedged", hedge_delay=0.05)
+
+    assert name == "hedge"
+    assert calls == ["slow", "hedge"]
+
+
+@pytest.mark.asyncio
+async def test_all_failed_returns_none(svc):
+    assert await run(svc, [("a", failing()), ("b", failing())]) == (None, None)
+
+
+@pytest.mark.asyncio
+async def test_budget_exhausted_returns_none(svc):
+    assert await run(svc, [("slow", result_after(1, "slow"))], budget=0.05) == (None, None)
+
+
+@pytest.mark.asyncio
+async def test_all_failed_with_breaker_scope_raises_unavailable(svc):
+    with pytest.raises(svc.UpstreamUnavailableError):
+        await run(svc, [("a", failing()), ("b", failing())], breaker_scope="test")
+
+
+@pytest.mark.asyncio
+async def test_open_breaker_is_skipped(svc):
+    calls = []
+    svc.provider_health.breaker("test", "broken")._transition("open")
+
+    name, result = await run(svc, [
+        ("broken", result_after(0, "broken", calls, "broken")),
+        ("healthy", result_after(0, "healthy", calls, "healthy")),
+    ], strategy="sequential", breaker_scope="test")
+
+    assert (name, result) == ("healthy", "healthy")
+    assert calls == ["healthy"]
+
+
+# CircuitBreaker
+
+def open_breaker(svc):
+    breaker = svc.CircuitBreaker("test", "provider")
+    for _ in range(svc.BREAKER_MIN_CALLS):
+        breaker.record(failed=True, latency=0.01)
+    return breaker
+
+
+def test_breaker_opens_on_error_rate(svc):
+    breaker = svc.CircuitBreaker("test", "provider")
+    for _ in range(svc.BREAKER_MIN_CALLS - 1):
+        breaker.record(failed=True, latency=0.01)
+    assert breaker.state == "closed"
+
+    breaker.record(failed=True, latency=0.01)
+    assert breaker.state == "open"
+    assert not breaker.acquire()
+
+
+def test_breaker_counts_slow_calls_as_failures(svc):
+    breaker = svc.CircuitBreaker("test", "provider")
+    for _ in range(svc.BREAKER_MIN_CALLS):
+        breaker.record(failed=False, latency=svc.BREAKER_SLOW_CALL_SECONDS + 1)
+    assert breaker.state == "open"
+
+
+
+@pytest.mark.asyncio
+async def test_not_found_does_not_lower_success_ewma(svc):
+    # Источник ответил "нет такого эпизода" - он исправен и не должен уходить в конец очереди
+    for _ in range(3):
+        await run(svc, [("empty", result_after(0, None))], strategy="sequential", breaker_scope="test")
+    breaker = svc.provider_health.breaker("test", "empty")
+    assert breaker.ewma_success == 1.0
+    assert breaker.state == "closed"
+
+    with pytest.raises(svc.UpstreamUnavailableError):
+        await run(svc, [("empty", failing())], breaker_scope="test")
+    assert breaker.ewma_success < 1.0
+
+def test_breaker_half_open_probe_closes(svc):
+    breaker = open_breaker(svc)
+    breaker.opened_at -= svc.BREAKER_OPEN_SECONDS
+
+    assert breaker.acquire()
+    assert breaker.state == "half_open"
+    # Пробных вызовов не больше BREAKER_HALF_OPEN_PROBES
+    for _ in range(svc.BREAKER_HALF_OPEN_PROBES - 1):
+        assert breaker.acquire()
+    assert not breaker.acquire()
+
+    breaker.record(failed=False, latency=0.01)
+    assert breaker.state == "closed"
+    assert breaker.acquire()
+
+
+def test_breaker_half_open_probe_failure_reopens(svc):
+    breaker = open_breaker(svc)
+    breaker.opened_at -= svc.BREAKER_OPEN_SECONDS
+    assert breaker.acquire()
+
+    breaker.record(failed=True, latency=0.01)
+    assert breaker.state == "open"
+    assert not breaker.acquire()
+
+
+def test_breaker_release_frees_probe_slot(svc):
+    breaker = open_breaker(svc)
+    breaker.opened_at -= svc.BREAKER_OPEN_SECONDS
+    for _ in range(svc.BREAKER_HALF_OPEN_PROBES):
+        assert breaker.acquire()
+
+    breaker.release()
+    assert breaker.acquire()
+
+
+# POST /resolve и /releases/{id}/episodes: один запрос релиза на все эпизоды
+
+def test_resolve_batch_loads_release_once(client):
+    items = [{"anime_id": 3, "episode": number} for number in (1, 2, 3)]
+    response = client.post("/resolve", json={"items": items, "video": True})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == ["ok", "ok", "ok"]
+    assert results[1]["qualities"]["hd"] == f"{client.upstreams.origin}/media/3/2/hd.mp4"
+    assert client.upstreams.calls == {"aniliberty_release": 1}
+
+    # Качества и ссылки на видео уже в кэше
+    assert client.get("/qualities?anime_id=3&episode=2").status_code == 200
+    assert client.get("/video?anime_id=3&episode=2", headers={"Range": "bytes=0-0"}).status_code == 206
+    assert client.upstreams.calls["aniliberty_release"] == 1
+
+
+def test_resolve_batch_reports_missing_episodes(client):
+    items = [{"anime_id": 3, "episode": 1}, {"anime_id": 3, "episode": 9}, {"anime_id": 99, "episode": 1}]
+    results = client.post("/resolve", json={"items": items}).json()["results"]
+    assert [result["status"] for result in results] == ["ok", "not_found", "not_found"]
+
+
+def test_resolve_batch_validates_items(client):
+    assert client.post("/resolve", json={"items": []}).status_code == 422
+
+
+def test_release_episodes(client):
+    response = client.get("/releases/4/episodes")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["source"] == "aniliberty"
+    assert sorted(body["episodes"]) == ["1", "2", "3"]
+    assert body["episodes"]["2"]["fhd"] == f"{client.upstreams.origin}/hls/4/2/fhd/master.m3u8"
+
+    assert client.get("/releases/4/episodes").json() == body
+    assert client.upstreams.calls == {"aniliberty_release": 1}
+
+
+def test_release_episodes_not_found(client):
+    assert client.get("/releases/99/episodes").status_code == 404
+
+
+# /voices, /subtitles, /check-availability: данные релиза без обращения к медиа
+
+def test_voices_from_release_members(client):
+    response = client.get("/voices?anime_id=3&episode=1")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["source"] == "aniliberty"
+    assert body["voices"][0]["actors"] == ["Bench"]
+    assert client.get("/voices?anime_id=3&episode=9").status_code == 404
+
+
+def test_subtitles_empty_when_release_has_none(client):
+    response = client.get("/subtitles?anime_id=3&episode=1&language=en")
+    assert response.status_code == 200
+    assert response.json() == {"subtitles": [], "source": "aniliberty"}
+    assert client.get("/subtitles?anime_id=99&episode=1").status_code == 404
+
+
+def test_check_availability_without_media_requests(client):
+    body = client.get("/check-availability?anime_id=3&episode=2").json()
+    assert body["available"] is True
+    assert body["qualities"] == ["fhd", "hd", "sd"]
+
+    body = client.get("/check-availability?anime_id=3&episode=9").json()
+    assert body["available"] is False
+    assert body["source"] is None
+
+    assert client.get("/check-availability?anime_id=99&episode=1").json()["available"] is False
+    # Вся информация - из карты эпизодов релиза, медиа не запрашивается
+    assert "media" not in client.upstreams.calls
+    assert client.upstreams.calls["aniliberty_release"] == 2
+
+
+def test_check_availability_from_resolved_cache(client, svc):
+    qualities = {"fhd": "https://cache.libria.fun/3/1.mp4"}
+    client.call(svc.cache.set, "qualities_3_1", {"value": qualities, "fresh_until": 0}, 300)
+    body = client.get("/check-availability?anime_id=3&episode=1").json()
+    assert body["available"] is True
+    assert body["source"] == "cache"
+    assert client.upstreams.calls == {}
@@ -268,6 +268,20 @@ exports.checkVideoAvailability = async (req, res) => {
       return res.json(JSON.parse(cached));
     }
 
+    // Пробуем Python сервис (AniLiberty) - проверка по данным релиза, без загрузки видео
+    try {
+      const pythonResponse = await axios.get(`${PYTHON_SERVICE_URL}/check-availability`, {
+        params: { anime_id, episode }
+      });
+
+      if (pythonResponse.status === 200 && pythonResponse.data.available) {
+        await set(cacheKey, JSON.stringify(pythonResponse.data), 'EX', CACHE_TTL);
+        return res.json(pythonResponse.data);
+      }
+    } catch (pythonError) {
+      console.log('Python service availability check failed, trying fallback:', pythonError.message);
+    }
+
     const response = await axios.get(`${ANICLI_API_URL}/check-availability`, {
       params: { anime_id, episode }
     });